@@ -0,0 +1,30 @@
+import argparse
+import json
+
+from sim.batch_runner import BatchRunner, load_batch
+from sim.fuzzy_surface import default_cache_dir
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Run a batch of scenarios, reusing results that are already cached. '
+                                                 'The batch file is JSON or JSON lines, see batch_runner.load_batch')
+    parser.add_argument('batch', help='file of scenarios')
+    parser.add_argument('--cache-dir', default=default_cache_dir,
+                        help='directory results are cached in, under runs/')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, by default one per core')
+    parser.add_argument('--output', default=None,
+                        help='write the name, seed and results directory of every run to a JSON file')
+    args = parser.parse_args()
+
+    runner = BatchRunner(load_batch(args.batch), args.cache_dir, args.workers)
+    records = runner.run()
+    for r in records:
+        status = 'cached' if r['cached'] else f"ran in {r['elapsed']:.2f} s"
+        print(f"{r['name']:>20} seed={r['seed']:<6} {r['key']} {status}")
+    print(f"{sum(not r['cached'] for r in records)} of {len(records)} runs simulated, "
+          f"results in {args.cache_dir}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(records, f, indent=1)
@@ -0,0 +1,70 @@
+import argparse
+import sys
+
+from utils.benchmark import (Benchmark, benchmark_stages, check_surface_accuracy, compare_benchmarks,
+                             measure_import_times, measure_node_footprint)
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Time the stages of the simulation pipeline')
+    parser.add_argument('--nodes', type=int, nargs='+', default=None)
+    parser.add_argument('--timesteps', type=int, nargs='+', default=None)
+    parser.add_argument('--attackers', type=int, nargs='+', default=None)
+    parser.add_argument('--stages', nargs='+', default=list(benchmark_stages), choices=benchmark_stages)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--shards', type=int, default=None,
+                        help='worker processes of the sharded stage, by default one per core')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--imports', action='store_true',
+                        help='only check the import time budgets')
+    parser.add_argument('--footprint', type=int, default=None, metavar='NODES',
+                        help='only check the memory per node object of a network of this size')
+    parser.add_argument('--surface', action='store_true',
+                        help='only check that the fuzzy surface keeps the fuzzy categories of exact inference')
+    args = parser.parse_args()
+
+    if args.imports:
+        records = measure_import_times()
+        for r in records:
+            status = 'ok' if r['passed'] else 'FAILED'
+            loaded = f" (loaded {', '.join(r['loaded'])})" if r['loaded'] else ''
+            print(f"{r['module']:>24}: {r['seconds']:.3f} s of {r['budget']:.3f} s {status}{loaded}")
+        sys.exit(0 if all(r['passed'] for r in records) else 1)
+
+    if args.footprint is not None:
+        r = measure_node_footprint(args.footprint)
+        status = 'ok' if r['passed'] else 'FAILED'
+        print(f"{r['nodes']} nodes: {r['bytes_per_node']:.0f} bytes per node of {r['budget']} {status}")
+        sys.exit(0 if r['passed'] else 1)
+
+    if args.surface:
+        r = check_surface_accuracy()
+        status = 'ok' if r['passed'] else 'FAILED'
+        print(f"Surface {tuple(r['shape'])}: max error {r['max_error']:.3g} "
+              f"(grid {r['grid_max_error']:.3g}), category changes {r['category_changes']:.3%} "
+              f"of {r['budget']:.3%} {status}")
+        sys.exit(0 if r['passed'] else 1)
+
+    grid = {name: values for name, values in (('nodes', args.nodes),
+                                               ('timesteps', args.timesteps),
+                                               ('attackers', args.attackers)) if values}
+    benchmark = Benchmark(grid, args.stages, args.repeats, shards=args.shards)
+    benchmark.run()
+    benchmark.save(args.output)
+    print(f'Results written to {args.output}')
+    for r in benchmark.records:
+        if 'speedup' in r:
+            print(f"Sharded speedup nodes={r['nodes']} timesteps={r['timesteps']} attackers={r['attackers']}: "
+                  f"{r['speedup']:.2f}x with {r['shards']} shards")
+
+    if args.compare is not None:
+        regressions = compare_benchmarks(args.compare, args.output, args.tolerance)
+        for r in regressions:
+            change = r['error'] if r['metric'] == 'error' else f"{r['baseline']:.4g} -> {r['current']:.4g}"
+            print(f"Regression: {r['stage']} nodes={r['nodes']} timesteps={r['timesteps']} "
+                  f"attackers={r['attackers']} {r['metric']} {change}")
+        if regressions:
+            sys.exit(1)
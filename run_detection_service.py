@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import sys
+
+from sim.detection_service import (DetectionService, csv_writer, feed_lines, load_replay,
+                                   read_stdin, replay, serve_socket, tail_file)
+from sim.fuzzy_detector import get_fuzzy_detector
+from sim.fuzzy_surface import get_fuzzy_surface
+
+
+async def main(args):
+    fuzzy_engine = get_fuzzy_surface() if args.fuzzy_mode == 'surface' else get_fuzzy_detector()
+    output = open(args.output, 'w') if args.output else sys.stdout
+    service = DetectionService(csv_writer(output), fuzzy_engine, args.max_batch, args.max_delay, args.queue_size)
+    worker = asyncio.create_task(service.run())
+
+    if args.replay:
+        await replay(service, load_replay(args.replay), args.step_interval)
+    elif args.file:
+        await feed_lines(service, tail_file(args.file, follow=args.follow))
+    elif args.socket:
+        host, port = args.socket.rsplit(':', 1)
+        server = await serve_socket(service, host, int(port))
+        print(f'Listening on {host}:{port}', file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    else:
+        await feed_lines(service, read_stdin())
+
+    await service.close()
+    await worker
+    if output is not sys.stdout:
+        output.close()
+    print(service.get_statistics(), file=sys.stderr)
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Run the compromise checks on a live feed of node metrics. '
+                                                 'Records are "node,timestamp,packet_rate,bandwidth,response_time" '
+                                                 'CSV lines or JSON objects; reads stdin by default')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--file', help='read records from a file')
+    source.add_argument('--socket', help='listen for records on HOST:PORT')
+    source.add_argument('--replay', help='replay the node results of a report directory')
+    parser.add_argument('--follow', action='store_true', help='keep reading lines appended to --file')
+    parser.add_argument('--step-interval', type=float, default=0., help='seconds between replayed timesteps')
+    parser.add_argument('--max-batch', type=int, default=4096)
+    parser.add_argument('--max-delay', type=float, default=0.)
+    parser.add_argument('--queue-size', type=int, default=65536)
+    parser.add_argument('--fuzzy-mode', choices=['batch', 'surface'], default='batch')
+    parser.add_argument('--output', default=None, help='write flags to a file instead of stdout')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,25 +1,25 @@
-import sys
-sys.path.append('./sim')
-sys.path.append('./utils')
-import pandas as pd
-import plotly.express as px
+import argparse
 
-from network_sim import Simulation 
-from network_node import NetworkNode
-from attacker import Attacker
-from generate_report import Report
+from sim.network_sim import Simulation
+from sim.attacker import Attacker
+from utils.generate_report import Report
 
 if __name__=='__main__':
     
+    parser = argparse.ArgumentParser(description='Simulate the 9-node network with an attacker on node 0')
+    parser.add_argument('--results-dir', default='results',
+                        help='directory the report is written to')
+    parser.add_argument('--timesteps', type=int, default=200)
+    args = parser.parse_args()
+    
     # Run the simulation with onboard attacker
     sim2 = Simulation('sim2')
     sim2.establish_nodes(9)
     sim2.set_v1_structure()
     attacker = Attacker('attacker_0', 0)
     sim2.add_attacker(attacker)
-    compromised_results = sim2.run_simulation(t=200)
+    compromised_results = sim2.run_simulation(t=args.timesteps)
     
-    results_dir = '/Users/carleen/Documents/grad_school/fuzzy-defender/results'
     report_c = Report('compromised', compromised_results)
-    report_c.generate_report(results_dir)
+    report_c.generate_report(args.results_dir)
     
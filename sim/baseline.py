@@ -0,0 +1,170 @@
+import numpy as np
+
+from .metric_generator import metric_names, metric_values
+from .detectors import basic_thresholds, basic_threshold_metrics
+
+baseline_methods = ('welford', 'ewma')
+
+# The basic check's cutoffs as (metric, multiple of std) pairs, measured
+# from the default mu and std in metric_values. Baselines turn these
+# back into per-node cutoffs
+basic_threshold_deviations = {key: (name, (basic_thresholds[key] - metric_values[f'{name}_mu'])
+                                    / metric_values[f'{name}_std'])
+                              for key, name in basic_threshold_metrics.items()}
+
+
+class MetricBaseline:
+    '''
+    Running mean and variance of every metric of every node, updated in
+    constant time and memory per observation so no history is kept. The
+    detectors use the baselines instead of fixed numbers:
+
+        - the basic check's cutoffs are the baseline mean plus the
+          multiple of the baseline std in basic_threshold_deviations
+        - the fuzzy check's membership breakpoints move and stretch with
+          the baseline. normalize() maps a metric onto the scale the
+          fuzzy universes were designed for (default mu and std), which
+          is the same as shifting and scaling every breakpoint by the
+          node's mean and std
+
+    With a node's baseline at the default mu and std both checks give
+    the results of the fixed thresholds (up to rounding).
+
+    Baselines start from a prior (by default the metric generator's mu
+    and std of each node) counted as prior_weight observations, so the
+    checks work from the first timestep.
+
+    --------------
+    Attributes
+    --------------
+        num_nodes: int
+            Number of nodes
+        method: str
+            'welford' for the mean and variance of every observation so
+            far, 'ewma' for exponentially weighted ones that follow drift
+        alpha: float
+            Weight of a new observation with 'ewma'
+        count: array, float
+            Observations (including the prior) behind each node's baseline
+        mean: dict
+            (metric name, per-node array) pairs of running means
+        var: dict
+            (metric name, per-node array) pairs of running variances
+
+    --------------
+    Methods
+    --------------
+        update(metrics, mask)
+            Adds one observation of every metric for the masked nodes
+        get_std(name)
+            Per-node standard deviation of a metric
+        get_basic_thresholds()
+            Per-node cutoffs for the basic check
+        normalize(name, values)
+            Maps metric values onto the fuzzy detector's scale
+        get_shard(start, stop) / merge_shard(start, shard)
+            Baselines of a range of nodes, and copying them back
+    --------------
+
+    '''
+
+    def __init__(self, num_nodes, method='ewma', alpha=0.01, prior=None, prior_weight=30):
+        if method not in baseline_methods:
+            raise ValueError(f'Unknown baseline method: {method}')
+        self.num_nodes = num_nodes
+        self.method = method
+        self.alpha = alpha
+
+        # prior holds per-node or single values of the <metric>_mu/_std keys
+        prior = metric_values if prior is None else prior
+        self.count = np.full(num_nodes, float(prior_weight))
+        self.mean = {name: np.array(np.broadcast_to(prior[f'{name}_mu'], num_nodes), dtype=np.float64)
+                     for name in metric_names}
+        self.var = {name: np.array(np.broadcast_to(prior[f'{name}_std'], num_nodes), dtype=np.float64) ** 2
+                    for name in metric_names}
+
+    def update(self, metrics, mask=None):
+        ''' Adds the current metrics of the nodes to their baselines
+
+        --------------
+        Parameters
+        --------------
+            metrics: dict
+                (metric name, per-node array) pairs
+            mask: array, bool
+                Nodes to update, e.g. the ones that are not flagged, so an
+                attack isn't learned as normal. None updates every node
+
+        '''
+        index = slice(None) if mask is None else np.flatnonzero(mask)
+        count = self.count[index] + 1
+        self.count[index] = count
+        for name in metric_names:
+            x = np.asarray(metrics[name])[index]
+            mean = self.mean[name][index]
+            var = self.var[name][index]
+            delta = x - mean
+            if self.method == 'welford':
+                # Variance is kept rather than the sum of squares, using
+                # the population form of the Welford update
+                mean = mean + delta / count
+                var = var + (delta * (x - mean) - var) / count
+            else:
+                mean = mean + self.alpha * delta
+                var = (1 - self.alpha) * (var + self.alpha * delta ** 2)
+            self.mean[name][index] = mean
+            self.var[name][index] = var
+
+    def get_std(self, name):
+        return np.sqrt(self.var[name])
+
+    def get_basic_thresholds(self):
+        ''' Cutoffs for detectors.basic_compromise_flags, one per node
+
+        --------------
+        Returns
+        --------------
+            thresholds: dict
+                Per-node arrays with the keys of detectors.basic_thresholds
+
+        '''
+        return {key: self.mean[name] + deviations * self.get_std(name)
+                for key, (name, deviations) in basic_threshold_deviations.items()}
+
+    def normalize(self, name, values):
+        ''' Maps metric values from a node's baseline onto the default
+        baseline the fuzzy universes were designed for, keeping the
+        number of standard deviations from the mean
+
+        --------------
+        Parameters
+        --------------
+            name: str
+                Metric name
+            values: array
+                One value per node
+        --------------
+        Returns
+        --------------
+            values: array
+                Values to pass to the fuzzy detector
+
+        '''
+        z = (np.asarray(values) - self.mean[name]) / self.get_std(name)
+        return metric_values[f'{name}_mu'] + z * metric_values[f'{name}_std']
+
+    def get_shard(self, start, stop):
+        ''' Returns a copy of the baselines of the nodes start..stop-1 '''
+        shard = MetricBaseline(stop - start, self.method, self.alpha)
+        shard.count = self.count[start:stop].copy()
+        shard.mean = {name: values[start:stop].copy() for name, values in self.mean.items()}
+        shard.var = {name: values[start:stop].copy() for name, values in self.var.items()}
+        return shard
+
+    def merge_shard(self, start, shard):
+        ''' Copies the baselines of a shard from get_shard back in '''
+        nodes = slice(start, start + shard.num_nodes)
+        self.count[nodes] = shard.count
+        for name in metric_names:
+            self.mean[name][nodes] = shard.mean[name]
+            self.var[name][nodes] = shard.var[name]
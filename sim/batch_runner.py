@@ -0,0 +1,287 @@
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from .scenario import build_simulation, get_scenario
+from .result_store import ColumnarSink, ResultReader
+from .evaluation import evaluate, stack_results
+from .rule_compiler import load_rules, rules_key
+from .fuzzy_surface import default_cache_dir
+
+sim_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Entries of a batch file that describe the run rather than the scenario
+batch_keys = ('name', 'seed', 'seeds')
+
+
+def get_code_version():
+    ''' Hash of the simulation code, every .py file in sim/ and every rule
+    file in sim/rules. Cached results of an older version of the code are
+    not used.
+
+    --------------
+    Returns
+    --------------
+        version: str
+
+    '''
+    paths = sorted(glob.glob(os.path.join(sim_dir, '*.py')) + glob.glob(os.path.join(sim_dir, 'rules', '*.json')))
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.relpath(path, sim_dir).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def run_key(scenario, seed, version):
+    ''' Hash identifying the results of a scenario and seed run with one
+    version of the code
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Scenario, completed with default_scenario
+        seed: int
+        version: str
+            See get_code_version
+    --------------
+    Returns
+    --------------
+        key: str
+
+    '''
+    if seed is None:
+        raise ValueError('Runs can only be cached for a fixed seed')
+    scenario = get_scenario(scenario)
+    payload = json.dumps({'scenario': scenario, 'seed': seed, 'version': version,
+                          'files': get_file_hashes(scenario)},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def get_file_hashes(scenario):
+    ''' Hashes of the contents of the files a scenario refers to, its rule
+    file and edge list, so that editing one of them changes the key of
+    the runs that use it
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Complete scenario
+    --------------
+    Returns
+    --------------
+        hashes: dict
+            ('detector_rules' and/or 'edge_list', hash) pairs
+
+    '''
+    hashes = {}
+    if scenario['detector_rules'] is not None:
+        hashes['detector_rules'] = rules_key(load_rules(scenario['detector_rules']))
+    if scenario['structure'] == 'edge_list':
+        with open(scenario['structure_options']['path'], 'rb') as f:
+            hashes['edge_list'] = hashlib.sha256(f.read()).hexdigest()[:16]
+    return hashes
+
+
+def load_batch(path):
+    ''' Reads the runs of a batch file. The file is JSON, either one entry
+    or a list of entries, or JSON lines with one entry per line. An entry
+    is a scenario (any of the keys of default_scenario, so the structure,
+    detectors, thresholds and timesteps) together with:
+        - name: label of the entry, by default scenario_[i]
+        - seed or seeds: seed or list of seeds, one run each. Default 0
+
+    --------------
+    Parameters
+    --------------
+        path: str
+            Batch file
+    --------------
+    Returns
+    --------------
+        runs: list, dict
+            'name', 'scenario' (complete) and 'seed' of every run
+
+    '''
+    with open(path) as f:
+        text = f.read()
+    try:
+        entries = json.loads(text)
+    except json.JSONDecodeError:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(entries, dict):
+        entries = [entries]
+
+    runs = []
+    for i, entry in enumerate(entries):
+        scenario = get_scenario({key: value for key, value in entry.items() if key not in batch_keys})
+        seeds = entry['seeds'] if 'seeds' in entry else [entry.get('seed', 0)]
+        for seed in seeds:
+            runs.append({'name': entry.get('name', f'scenario_{i}'), 'scenario': scenario, 'seed': seed})
+    return runs
+
+
+def run_cached(scenario, seed, path):
+    ''' Runs a scenario and stores its results in path, unless they are
+    already stored there. Used by the worker processes of BatchRunner.
+
+    The results are streamed into a columnar store (see ColumnarSink)
+    with the run's summary (see evaluation.evaluate) in summary.npz and
+    the scenario, seed and run time in run.json. They are written to a
+    temporary directory that is renamed once complete, so a store that
+    is being written is never used.
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Complete scenario
+        seed: int
+        path: str
+            Directory of the stored results
+    --------------
+    Returns
+    --------------
+        elapsed: float
+            Seconds spent running, 0 if the results were stored already
+
+    '''
+    if os.path.exists(os.path.join(path, 'run.json')):
+        return 0.
+
+    start = time.perf_counter()
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    sim = build_simulation(scenario, seed)
+    sink = ColumnarSink(tmp_path, [n.name for n in sim.node_list])
+    reader = sim.run_simulation(scenario['timesteps'], sink=sink)
+
+    times, columns = stack_results(reader)
+    np.savez(os.path.join(tmp_path, 'summary.npz'), **evaluate(columns, times))
+    elapsed = time.perf_counter() - start
+    with open(os.path.join(tmp_path, 'run.json'), 'w') as f:
+        json.dump({'scenario': scenario, 'seed': seed, 'elapsed': elapsed}, f, default=str)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same run first
+        shutil.rmtree(tmp_path)
+    return elapsed
+
+
+class BatchRunner:
+    '''
+    Runs a batch of scenarios across a pool of worker processes, with a
+    content-addressed cache of their results. Every run is stored under
+    the hash of its complete scenario, the contents of the rule file and
+    edge list it refers to, its seed and the code version, so a run that
+    is repeated in the same batch, in an overlapping sweep or in a later
+    batch is only simulated once, and changing the code or those files
+    starts a fresh cache.
+
+    --------------
+    Attributes
+    --------------
+        runs: list, dict
+            'name', 'scenario' and 'seed' of every run, see load_batch
+        cache_dir: str
+            Directory the results are stored in, under runs/
+        max_workers: int
+            Number of worker processes. 1 runs everything in this process
+        version: str
+            Code version the results are cached for
+
+    --------------
+    Methods
+    --------------
+        get_path(run)
+            Directory of the stored results of a run
+        run()
+            Runs every run whose results are not stored yet
+    --------------
+
+    '''
+
+    def __init__(self, runs, cache_dir=default_cache_dir, max_workers=None):
+        self.runs = [dict(run, scenario=get_scenario(run['scenario'])) for run in runs]
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers or os.cpu_count()
+        self.version = get_code_version()
+
+    def get_path(self, run):
+        return os.path.join(self.cache_dir, 'runs', run_key(run['scenario'], run['seed'], self.version))
+
+    def run(self):
+        ''' Runs the batch. Runs with stored results and repeats of another
+        run in the batch are not simulated again.
+
+        --------------
+        Returns
+        --------------
+            records: list, dict
+                For each run: 'name', 'seed', 'key', 'path' of its
+                results (open with ResultReader), 'cached' and the
+                'elapsed' seconds of its simulation
+
+        '''
+        os.makedirs(os.path.join(self.cache_dir, 'runs'), exist_ok=True)
+        paths = [self.get_path(run) for run in self.runs]
+        cached = [os.path.exists(os.path.join(path, 'run.json')) for path in paths]
+
+        jobs = {}
+        for run, path, hit in zip(self.runs, paths, cached):
+            if not hit and path not in jobs:
+                jobs[path] = (run['scenario'], run['seed'], path)
+        if self.max_workers == 1 or len(jobs) < 2:
+            elapsed = [run_cached(*job) for job in jobs.values()]
+        else:
+            with ProcessPoolExecutor(min(self.max_workers, len(jobs))) as pool:
+                elapsed = list(pool.map(run_cached, *zip(*jobs.values())))
+        elapsed = dict(zip(jobs, elapsed))
+
+        records = []
+        for run, path, hit in zip(self.runs, paths, cached):
+            records.append({'name': run['name'],
+                            'seed': run['seed'],
+                            'key': os.path.basename(path),
+                            'path': path,
+                            'cached': hit or path not in elapsed,
+                            'elapsed': elapsed.pop(path, 0.)})
+        return records
+
+
+def load_run(path):
+    ''' Opens stored results of a run
+
+    --------------
+    Parameters
+    --------------
+        path: str
+            Directory of the results, see BatchRunner.get_path
+    --------------
+    Returns
+    --------------
+        results: ResultReader
+            Results of every node, like run_simulation's
+        summary: dict
+            (name, (num_nodes,) array) pairs, see evaluation.evaluate
+        run: dict
+            Scenario, seed and run time
+
+    '''
+    with np.load(os.path.join(path, 'summary.npz')) as summary:
+        summary = dict(summary)
+    with open(os.path.join(path, 'run.json')) as f:
+        run = json.load(f)
+    return ResultReader(path), summary, run
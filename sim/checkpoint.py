@@ -0,0 +1,245 @@
+import os
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+from .attacker import Attacker
+from .sim_state import state_columns
+
+# Every record in a checkpoint file is the marker, the payload length and
+# the payload's CRC32, followed by the pickled payload
+record_marker = b'FDCK'
+record_header = struct.Struct('<4sQI')
+
+
+class Checkpointer:
+    '''
+    Periodic checkpoints of a running simulation in an append-only binary
+    file, so an interrupted run can be resumed and give exactly the output
+    of an uninterrupted one.
+
+    Each checkpoint appends one record holding the rows recorded since the
+    previous checkpoint and the current dynamic state: compromise truth,
+    fuzzy hysteresis flags, security thresholds, running attacks, the
+    state of every random generator, the position in the current block of
+    metric noise (which is drawn again on resume), and the baselines. The size of a record depends on the number of nodes and
+    timesteps since the last checkpoint, not on the length of the run.
+
+    When results are streamed to a sink, the sink already holds the
+    history, so a record holds the rows kept in memory and the sink's row
+    count instead; on resume the sink is cut back to that count.
+
+    A record that was only partly written when the run stopped fails its
+    length or CRC check and is ignored, so the run resumes from the
+    previous checkpoint.
+
+    --------------
+    Attributes
+    --------------
+        path: str
+            Checkpoint file
+        every: int
+            Number of timesteps between checkpoints
+        sync: bool
+            fsync the file after each checkpoint
+        last_time: int or None
+            Timestep of the latest row that is in the file
+
+    --------------
+    Methods
+    --------------
+        is_due(timestep)
+            Whether a checkpoint is due after a timestep
+        write(sim, sink)
+            Appends a checkpoint of a simulation
+        restore(sim, sink)
+            Loads the latest checkpoint into a freshly built simulation
+    --------------
+
+    '''
+
+    def __init__(self, path, every=1000, sync=True):
+        self.path = path
+        self.every = every
+        self.sync = sync
+        self.last_time = None
+
+    def is_due(self, timestep):
+        return (timestep + 1) % self.every == 0
+
+    def write(self, sim, sink=None):
+        ''' Appends a checkpoint of the simulation's current state
+
+        --------------
+        Parameters
+        --------------
+            sim: Simulation
+                Simulation being run
+            sink: ColumnarSink
+                Store the simulation streams results into, if any
+
+        '''
+        state = sim.state
+        times = state.get_times()
+        if sink is None:
+            # Only the rows recorded since the last checkpoint
+            start = 0 if self.last_time is None else int(np.searchsorted(times, self.last_time, side='right'))
+        else:
+            start = 0
+        rows = slice(start, state.rows)
+
+        payload = {'num_nodes': state.num_nodes,
+                   'time': times[rows].copy(),
+                   'columns': {name: values[rows].copy() for name, values in state.columns.items()},
+                   'persisted': state.persisted if sink is not None else None,
+                   'sink_rows': sink.rows if sink is not None else None,
+                   'is_compromised': state.is_compromised.copy(),
+                   'fuzzy_flagged_malicious': state.fuzzy_flagged_malicious.copy(),
+                   'security_threshold': state.security_threshold.copy(),
+                   'attackers': [(a.name, a.get_target_node()) for a in sim.attacker_list],
+                   'attack_rng': sim.attack_rng.bit_generator.state,
+                   'metric_generator': _generator_state(sim.metric_generator),
+                   'propagation': _propagation_state(sim.propagation),
+                   'baseline': _baseline_state(sim.baseline)}
+        data = pickle.dumps(payload, protocol=5)
+
+        with open(self.path, 'ab') as f:
+            f.write(record_header.pack(record_marker, len(data), zlib.crc32(data)))
+            f.write(data)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        if state.rows:
+            self.last_time = int(times[-1])
+
+    def restore(self, sim, sink=None):
+        ''' Loads the latest complete checkpoint into a simulation that has
+        been built the same way as the checkpointed one (same nodes,
+        structure and seed), but not run. Damaged records at the end of
+        the file are removed, so later checkpoints follow on cleanly.
+
+        --------------
+        Parameters
+        --------------
+            sim: Simulation
+                Freshly built simulation
+            sink: ColumnarSink
+                Store the checkpointed run streamed into, opened with
+                resume=True
+        --------------
+        Returns
+        --------------
+            timesteps: int
+                Number of timesteps the checkpointed run had completed,
+                0 if there is no checkpoint
+
+        '''
+        records, end = _read_records(self.path)
+        if not records:
+            return 0
+        with open(self.path, 'r+b') as f:
+            f.truncate(end)
+
+        latest = records[-1]
+        state = sim.state
+        if latest['num_nodes'] != state.num_nodes:
+            raise ValueError(f"Checkpoint has {latest['num_nodes']} nodes, simulation has {state.num_nodes}")
+
+        # Rows: the history of every record, or the kept rows when streaming
+        if latest['sink_rows'] is None:
+            time = np.concatenate([r['time'] for r in records])
+            columns = {name: np.concatenate([r['columns'][name] for r in records]) for name in state_columns}
+            persisted = 0
+        else:
+            if sink is None:
+                raise ValueError('The checkpointed run streamed its results; pass its sink')
+            sink.truncate(latest['sink_rows'])
+            time, columns, persisted = latest['time'], latest['columns'], latest['persisted']
+
+        state.reserve(len(time))
+        state.rows = len(time)
+        state.persisted = persisted
+        state.time[:len(time)] = time
+        for name, values in columns.items():
+            state.columns[name][:len(time)] = values
+        state.is_compromised[:] = latest['is_compromised']
+        state.fuzzy_flagged_malicious[:] = latest['fuzzy_flagged_malicious']
+        state.security_threshold[:] = latest['security_threshold']
+
+        sim.attacker_list = [Attacker(name, target) for name, target in latest['attackers']]
+        _set_generator_state(sim.metric_generator, latest['metric_generator'])
+        if latest['propagation'] is not None:
+            # Creating the engine starts the attackers' attacks, which is
+            # undone by loading the engine's and generator's saved state
+            propagation = sim.get_propagation_engine()
+            propagation.timestep, propagation.active, propagation._events = latest['propagation']
+        sim.attack_rng.bit_generator.state = latest['attack_rng']
+        if latest['baseline'] is not None:
+            baseline = sim.get_baseline()
+            baseline.count[:], mean, var = latest['baseline']
+            for name in mean:
+                baseline.mean[name][:] = mean[name]
+                baseline.var[name][:] = var[name]
+
+        self.last_time = int(time[-1]) if len(time) else None
+        return state.get_next_timestep()
+
+
+def _read_records(path):
+    # Complete records of a checkpoint file and the offset where they end
+    records = []
+    end = 0
+    if not os.path.exists(path):
+        return records, end
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                break
+            marker, length, crc = record_header.unpack(header)
+            data = f.read(length)
+            if marker != record_marker or len(data) < length or zlib.crc32(data) != crc:
+                break
+            records.append(pickle.loads(data))
+            end = f.tell()
+    return records, end
+
+
+def _generator_state(generator):
+    # A partly used noise block is saved as the stream states it was drawn
+    # from and the position in it, and drawn again on restore, instead of
+    # saving up to max_block_bytes of noise in every record
+    if generator._position < generator.block_size:
+        streams, position = generator._block_states, generator._position
+    else:
+        streams, position = generator.get_stream_states(), generator.block_size
+    return {'params': {key: values.copy() for key, values in generator.params.items()},
+            'streams': streams,
+            'position': position}
+
+
+def _set_generator_state(generator, saved):
+    for key, values in saved['params'].items():
+        generator.params[key][:] = values
+    generator.set_stream_states(saved['streams'])
+    if saved['position'] < generator.block_size:
+        generator._fill_block()
+    else:
+        generator._normal = generator._uniform = generator._block_states = None
+    generator._position = saved['position']
+
+
+def _propagation_state(propagation):
+    if propagation is None:
+        return None
+    return propagation.timestep, dict(propagation.active), list(propagation._events)
+
+
+def _baseline_state(baseline):
+    if baseline is None:
+        return None
+    return (baseline.count.copy(),
+            {name: values.copy() for name, values in baseline.mean.items()},
+            {name: values.copy() for name, values in baseline.var.items()})
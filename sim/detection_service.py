@@ -0,0 +1,462 @@
+import asyncio
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from .detectors import basic_compromise_flags, fuzzy_category
+from .fuzzy_detector import get_fuzzy_detector
+from .instrumentation import null_profiler
+
+# Fields of an incoming record, in the order of a CSV line
+record_fields = ('node', 'timestamp', 'packet_rate', 'bandwidth', 'response_time')
+
+# Fields of an emitted flag record
+flag_fields = ('node', 'timestamp', 'flagged_malicious', 'fuzzy_compromised_value',
+               'fuzzy_compromised_category', 'latency')
+
+
+class DetectionService:
+    '''
+    Runs the basic and fuzzy compromise checks on live metric records
+    instead of simulated ones. Sources put (node, timestamp, packet_rate,
+    bandwidth, response_time) records on a bounded queue; when the queue
+    is full, submit() waits, which slows the source down instead of
+    letting records pile up. The service takes whatever records are
+    waiting, up to max_batch, and checks them with one vectorized call per
+    detector, so batches grow with load and a record arriving on an idle
+    service is checked straight away.
+
+    The fuzzy category keeps its previous value for questionable results,
+    so the service stores each node's last category. Records of a node
+    are checked in the order they arrive, even within one batch.
+
+    Lines that can't be parsed are counted and logged by the sources and
+    skipped. If checking or emitting a batch fails, run() stops with the
+    error and submit() and close() raise it instead of waiting on a queue
+    nobody empties.
+
+    --------------
+    Attributes
+    --------------
+        emit: function
+            Called with the list of flag records (tuples of flag_fields)
+            of each batch. May be a coroutine function
+        fuzzy_engine: FuzzyDetector or FuzzySurface
+            Engine with compute_batch used for the fuzzy check
+        max_batch: int
+            Largest number of records checked at once
+        max_delay: float
+            Seconds to wait for more records before checking a batch that
+            isn't full. 0 checks whatever is waiting immediately
+        queue: asyncio.Queue
+            Records waiting to be checked
+        node_index: dict
+            (node name, index into the per-node state) pairs
+        fuzzy_flag: array, int8
+            Last fuzzy category of each node
+        records, batches: int
+            Numbers of records and batches checked
+        rejected: int
+            Number of input lines that could not be parsed
+        error: Exception or None
+            Error that stopped run()
+        total_latency, max_latency: float
+            Sum and maximum of the seconds from submit() to emit
+        profiler: Profiler
+            Records the time spent checking each batch
+
+    --------------
+    Methods
+    --------------
+        submit(record)
+            Puts a record on the queue, waiting while the queue is full
+        reject(line, error)
+            Counts and logs an input line that could not be parsed
+        close()
+            Ends the stream once the queued records are checked
+        run()
+            Checks records until the stream is closed
+        check(batch)
+            Runs the detectors on a list of records
+        get_statistics()
+            Record, batch and latency counts
+    --------------
+
+    '''
+
+    def __init__(self, emit, fuzzy_engine=None, max_batch=4096, max_delay=0., queue_size=65536, profiler=None):
+        self.emit = emit
+        self.fuzzy_engine = fuzzy_engine if fuzzy_engine is not None else get_fuzzy_detector()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(queue_size)
+        self.node_index = {}
+        self.fuzzy_flag = np.zeros(64, dtype=np.int8)
+        self.records = 0
+        self.batches = 0
+        self.rejected = 0
+        self.error = None
+        self._failed = asyncio.Event()
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.profiler = profiler if profiler is not None else null_profiler
+
+    async def submit(self, record):
+        ''' Puts a record on the queue, waiting while the queue is full
+
+        --------------
+        Parameters
+        --------------
+            record: tuple
+                (node, timestamp, packet_rate, bandwidth, response_time)
+
+        '''
+        await self._put((*record, time.perf_counter()))
+
+    async def close(self):
+        await self._put(None)
+
+    async def _put(self, item):
+        # Puts an item on the queue, raising the worker's error instead of
+        # waiting forever if the worker has stopped
+        if self.error is not None:
+            raise RuntimeError('Detection service stopped') from self.error
+        if not self.queue.full():
+            self.queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(self.queue.put(item))
+        failed = asyncio.ensure_future(self._failed.wait())
+        await asyncio.wait((put, failed), return_when=asyncio.FIRST_COMPLETED)
+        failed.cancel()
+        if not put.done():
+            put.cancel()
+            raise RuntimeError('Detection service stopped') from self.error
+
+    def reject(self, line, error):
+        ''' Counts an input line that could not be parsed and logs it to
+        stderr
+        '''
+        self.rejected += 1
+        print(f'Skipped record {line.strip()!r}: {error}', file=sys.stderr)
+
+    async def run(self):
+        ''' Checks records as they arrive until close() is called and the
+        records before it have been checked. An error checking or emitting
+        a batch stops the service and is raised, and waiting producers
+        are released.
+
+        '''
+        try:
+            await self._run()
+        except Exception as error:
+            self.error = error
+            self._failed.set()
+            raise
+
+    async def _run(self):
+        queue = self.queue
+        done = False
+        while not done:
+            item = await queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.max_delay
+            while len(batch) < self.max_batch:
+                if queue.empty():
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = queue.get_nowait()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+
+            flags = self.check(batch)
+            result = self.emit(flags)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def _get_indices(self, nodes):
+        node_index = self.node_index
+        indices = np.empty(len(nodes), dtype=np.int64)
+        for i, node in enumerate(nodes):
+            index = node_index.get(node)
+            if index is None:
+                index = node_index[node] = len(node_index)
+            indices[i] = index
+        if len(node_index) > len(self.fuzzy_flag):
+            grown = np.zeros(2 * len(node_index), dtype=np.int8)
+            grown[:len(self.fuzzy_flag)] = self.fuzzy_flag
+            self.fuzzy_flag = grown
+        return indices
+
+    def check(self, batch):
+        ''' Runs the basic and fuzzy checks on a batch of records
+
+        --------------
+        Parameters
+        --------------
+            batch: list, tuple
+                Records as put on the queue by submit()
+        --------------
+        Returns
+        --------------
+            flags: list, tuple
+                One tuple of flag_fields per record, in batch order
+
+        '''
+        with self.profiler.stage('detect'):
+            nodes, timestamps, packet_rate, bandwidth, response_time, arrival = zip(*batch)
+            packet_rate = np.array(packet_rate, dtype=np.float64)
+            bandwidth = np.array(bandwidth, dtype=np.float64)
+            response_time = np.array(response_time, dtype=np.float64)
+            indices = self._get_indices(nodes)
+
+            flagged = basic_compromise_flags(packet_rate, bandwidth, response_time)
+            values = self.fuzzy_engine.compute_batch(packet_rate, bandwidth, response_time)
+
+            # Categories depend on the node's previous one, so a node's
+            # records are handled one round at a time: round k holds the
+            # k-th record of each node in the batch
+            category = np.empty(len(batch), dtype=np.int8)
+            order = np.argsort(indices, kind='stable')
+            sorted_indices = indices[order]
+            starts = np.flatnonzero(np.r_[True, sorted_indices[1:] != sorted_indices[:-1]])
+            rank = np.empty(len(batch), dtype=np.int64)
+            rank[order] = np.arange(len(batch)) - np.repeat(starts, np.diff(np.r_[starts, len(batch)]))
+            fuzzy_flag = self.fuzzy_flag
+            for k in range(rank.max() + 1):
+                members = np.flatnonzero(rank == k)
+                category[members] = fuzzy_category(values[members], fuzzy_flag[indices[members]])
+                fuzzy_flag[indices[members]] = category[members]
+
+            now = time.perf_counter()
+            latency = now - np.array(arrival)
+            flags = list(zip(nodes, timestamps, flagged.tolist(), values.tolist(),
+                             category.tolist(), latency.tolist()))
+
+        self.records += len(batch)
+        self.batches += 1
+        self.total_latency += float(latency.sum())
+        self.max_latency = max(self.max_latency, float(latency.max()))
+        self.profiler.count('records', len(batch))
+        self.profiler.end_step(self.batches)
+        return flags
+
+    def get_statistics(self):
+        return {'records': self.records,
+                'batches': self.batches,
+                'rejected': self.rejected,
+                'nodes': len(self.node_index),
+                'mean_batch_size': self.records / self.batches if self.batches else 0.,
+                'mean_latency': self.total_latency / self.records if self.records else 0.,
+                'max_latency': self.max_latency}
+
+
+def parse_record(line):
+    ''' Parses one input line, either a JSON object with the keys in
+    record_fields or a CSV line with the fields in that order. Raises
+    ValueError, KeyError or TypeError for a malformed line
+
+    --------------
+    Parameters
+    --------------
+        line: str
+    --------------
+    Returns
+    --------------
+        record: tuple or None
+            (node, timestamp, packet_rate, bandwidth, response_time), or
+            None for blank lines, comments and headers
+
+    '''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('{'):
+        values = json.loads(line)
+        values = [values[field] for field in record_fields]
+    else:
+        values = line.split(',')
+        if len(values) != len(record_fields):
+            raise ValueError(f'Expected {len(record_fields)} fields: {line}')
+        if values[0] == 'node':
+            return None
+    node, timestamp, packet_rate, bandwidth, response_time = values
+    return str(node), float(timestamp), float(packet_rate), float(bandwidth), float(response_time)
+
+
+async def feed_lines(service, lines):
+    ''' Parses lines from an async iterator and submits the records '''
+    async for line in lines:
+        try:
+            record = parse_record(line)
+        except (ValueError, KeyError, TypeError) as error:
+            service.reject(line, error)
+            continue
+        if record is not None:
+            await service.submit(record)
+
+
+async def tail_file(path, follow=True, poll_interval=0.1):
+    ''' Yields the lines of a file. With follow, waits for lines appended
+    to the file after its end is reached, like tail -f, until cancelled
+
+    --------------
+    Parameters
+    --------------
+        path: str
+            File to read
+        follow: bool
+            Keep waiting for new lines at the end of the file
+        poll_interval: float
+            Seconds between checks for new lines
+
+    '''
+    with open(path) as f:
+        partial = ''
+        while True:
+            line = f.readline()
+            if line.endswith('\n'):
+                yield partial + line
+                partial = ''
+            elif not follow:
+                if partial + line:
+                    yield partial + line
+                return
+            else:
+                partial += line
+                await asyncio.sleep(poll_interval)
+
+
+async def read_stdin():
+    ''' Yields lines from standard input until it is closed. Lines are
+    read in a worker thread, which works whether stdin is a terminal, a
+    pipe or a redirected file
+
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            return
+        yield line
+
+
+async def serve_socket(service, host='127.0.0.1', port=9000):
+    ''' Listens on a local TCP socket and submits the lines every client
+    sends. A client isn't read from while the queue is full, so TCP flow
+    control slows the client down.
+
+    --------------
+    Parameters
+    --------------
+        service: DetectionService
+        host: str
+        port: int
+    --------------
+    Returns
+    --------------
+        server: asyncio.Server
+
+    '''
+    async def handle_client(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    record = parse_record(line.decode())
+                except (ValueError, KeyError, TypeError) as error:
+                    service.reject(line.decode(errors='replace'), error)
+                    continue
+                if record is not None:
+                    await service.submit(record)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_client, host, port)
+
+
+def load_replay(path):
+    ''' Loads the node results of a report directory as records in time
+    order, with all nodes of a timestep together. Reads results.npz when
+    the report has one and the node_*.csv tables otherwise.
+
+    --------------
+    Parameters
+    --------------
+        path: str
+            Report directory, e.g. results/2023-11-01_1633_compromised
+    --------------
+    Returns
+    --------------
+        records: list, tuple
+            (node, timestamp, packet_rate, bandwidth, response_time)
+
+    '''
+    npz_path = os.path.join(path, 'results.npz')
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as data:
+            node_names = [str(n) for n in data['node_names']]
+            times = data['time']
+            metrics = [data['packet_rate'], data['bandwidth'], data['response_time']]
+        return [(node, float(times[row]), float(metrics[0][row, i]), float(metrics[1][row, i]), float(metrics[2][row, i]))
+                for row in range(len(times)) for i, node in enumerate(node_names)]
+
+    # Nodes in index order (node_2 before node_10), then a stable sort by time
+    records = []
+    csv_paths = sorted(glob.glob(os.path.join(path, 'node_*.csv')), key=lambda p: (len(p), p))
+    for csv_path in csv_paths:
+        node = os.path.splitext(os.path.basename(csv_path))[0]
+        with open(csv_path, newline='') as f:
+            for row in csv.DictReader(f):
+                records.append((node, float(row['time']), float(row['packet_rate']),
+                                float(row['bandwidth']), float(row['response_time'])))
+    if not records:
+        raise ValueError(f'No results.npz or node_*.csv files in {path}')
+    records.sort(key=lambda r: r[1])
+    return records
+
+
+async def replay(service, records, step_interval=0.):
+    ''' Submits recorded results as if they were a live feed
+
+    --------------
+    Parameters
+    --------------
+        service: DetectionService
+        records: list, tuple
+            Records in time order, from load_replay
+        step_interval: float
+            Seconds to wait between timesteps. 0 submits as fast as the
+            service takes them
+
+    '''
+    previous = None
+    for record in records:
+        if step_interval and previous is not None and record[1] != previous:
+            await asyncio.sleep(step_interval)
+        previous = record[1]
+        await service.submit(record)
+
+
+def csv_writer(stream=sys.stdout):
+    ''' Emitter writing flag records to a text stream as CSV lines '''
+    def write(flags):
+        stream.write(''.join(f'{n},{t:g},{b},{v:.6g},{c},{l:.6f}\n' for n, t, b, v, c, l in flags))
+        stream.flush()
+    return write
@@ -0,0 +1,112 @@
+import numpy as np
+
+# Cutoffs of the basic check. A node is flagged when it is slow and either
+# its bandwidth is below 'bandwidth' and packet rate below 'packet_rate',
+# or its packet rate is below 'packet_rate_high' and bandwidth below
+# 'bandwidth_low'
+basic_thresholds = {'response_time': 130,
+                    'bandwidth': 32,
+                    'packet_rate': 0.905,
+                    'bandwidth_low': 27,
+                    'packet_rate_high': 0.91}
+
+# Metric each cutoff applies to
+basic_threshold_metrics = {'response_time': 'response_time',
+                           'bandwidth': 'bandwidth',
+                           'packet_rate': 'packet_rate',
+                           'bandwidth_low': 'bandwidth',
+                           'packet_rate_high': 'packet_rate'}
+
+
+def basic_compromise_flags(packet_rate, bandwidth, response_time, thresholds=None):
+    ''' Basic compromise check for any number of nodes at once. A node is
+    flagged when its metrics cross the rough thresholds for normal,
+    non-attacked behavior.
+
+    --------------
+    Parameters
+    --------------
+        packet_rate: float or array
+        bandwidth: float or array
+        response_time: float or array
+            Current metrics of the node(s)
+        thresholds: dict
+            Cutoffs with the keys of basic_thresholds, either single
+            values or one per node. Defaults to basic_thresholds
+    --------------
+    Returns
+    --------------
+        flagged_malicious: int or array, int8
+            1 where the node is flagged as malicious, 0 otherwise
+
+    '''
+    t = basic_thresholds if thresholds is None else thresholds
+    slow = np.asarray(response_time) > t['response_time']
+    packet_rate = np.asarray(packet_rate)
+    bandwidth = np.asarray(bandwidth)
+    flagged = (slow & (bandwidth < t['bandwidth']) & (packet_rate < t['packet_rate'])) \
+        | (slow & (packet_rate < t['packet_rate_high']) & (bandwidth < t['bandwidth_low']))
+    return flagged.astype(np.int8)
+
+
+def fuzzy_category(result, prev_flag, low=5, high=6):
+    ''' Categorises fuzzy output for any number of nodes at once:
+        - result <= low : not compromised (0)
+        - low < result < high : questionable, keeps the previous flag
+        - otherwise : compromised (1)
+
+    --------------
+    Parameters
+    --------------
+        result: float or array
+            Resulting value(s) from fuzzy compromised logic
+        prev_flag: int or array
+            Category of each node at the previous timestep
+        low, high: float
+            Edges of the questionable band, 5 and 6 by default
+    --------------
+    Returns
+    --------------
+        category: int or array, int8
+
+    '''
+    result = np.asarray(result)
+    questionable = (result > low) & (result < high)
+    category = np.where(result <= low, 0, np.where(questionable, prev_flag, 1))
+    return category.astype(np.int8)
+
+
+def fuzzy_category_scan(values, initial=0, low=5, high=6):
+    ''' Categorises a whole series of fuzzy outputs at once. Gives the same
+    result as applying fuzzy_category one timestep after another, starting
+    from the initial category: every value outside the questionable band
+    decides the category, and questionable values repeat the last decided
+    one, so the series is a forward fill of the decisive values.
+
+    --------------
+    Parameters
+    --------------
+        values: array
+            (timesteps,) or (timesteps, nodes) fuzzy compromised values
+        initial: int or array
+            Category of each node before the first timestep
+        low, high: float
+            Edges of the questionable band
+    --------------
+    Returns
+    --------------
+        category: array, int8
+            Shaped like values
+
+    '''
+    values = np.asarray(values)
+    questionable = (values > low) & (values < high)
+    decided = np.where(values <= low, 0, 1).astype(np.int8)
+
+    # Index of the last decisive timestep at or before each timestep
+    steps = np.arange(len(values)).reshape((-1,) + (1,) * (values.ndim - 1))
+    last = np.maximum.accumulate(np.where(questionable, -1, steps), axis=0)
+
+    filled = np.take_along_axis(decided, np.maximum(last, 0), axis=0)
+    initial = np.broadcast_to(np.asarray(initial, dtype=np.int8), values.shape[1:])
+    return np.where(last >= 0, filled, initial).astype(np.int8)
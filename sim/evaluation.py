@@ -0,0 +1,356 @@
+from statistics import NormalDist
+
+import numpy as np
+
+from .result_store import ResultReader
+
+# Recorded columns holding each detector's decision
+detector_columns = {'basic': 'flagged_malicious',
+                    'fuzzy': 'fuzzy_compromised_category'}
+
+
+def first_true(mask):
+    ''' Index of the first True along the timestep axis (second to last),
+    -1 where there is none
+
+    --------------
+    Parameters
+    --------------
+        mask: array, bool
+            (..., timesteps, nodes)
+    --------------
+    Returns
+    --------------
+        index: array, int
+            (..., nodes)
+
+    '''
+    return np.where(mask.any(axis=-2), np.argmax(mask, axis=-2), -1)
+
+
+def confusion_counts(flags, truth, valid=None):
+    ''' Confusion matrix of a detector against the truth for every node,
+    counted over the timestep axis (second to last)
+
+    --------------
+    Parameters
+    --------------
+        flags: array
+            (..., timesteps, nodes) detector decisions, nonzero if flagged
+        truth: array
+            (..., timesteps, nodes) compromise truth
+        valid: array, bool
+            Timesteps to count, broadcastable to flags, e.g. to leave out
+            the initial row or the padding of shorter runs
+    --------------
+    Returns
+    --------------
+        counts: dict
+            'tp', 'fp', 'tn', 'fn': (..., nodes) arrays
+
+    '''
+    flags = np.asarray(flags).astype(bool)
+    truth = np.asarray(truth).astype(bool)
+    if valid is not None:
+        valid = np.broadcast_to(valid, flags.shape)
+        flags = flags & valid
+        truth = truth & valid
+    tp = (flags & truth).sum(axis=-2)
+    fp = flags.sum(axis=-2) - tp
+    fn = truth.sum(axis=-2) - tp
+    total = flags.shape[-2] if valid is None else valid.sum(axis=-2)
+    return {'tp': tp, 'fp': fp, 'tn': total - tp - fp - fn, 'fn': fn}
+
+
+def detection_rates(tp, fp, tn, fn):
+    ''' Detection quality from confusion counts. Counts can be per node,
+    per run or pooled; rates are NaN where they are undefined.
+
+    --------------
+    Returns
+    --------------
+        rates: dict
+            'precision', 'recall', 'false_positive_rate', 'accuracy' and
+            'f1' arrays shaped like the counts
+
+    '''
+    tp, fp, tn, fn = [np.asarray(c) for c in (tp, fp, tn, fn)]
+    return {'precision': _ratio(tp, tp + fp),
+            'recall': _ratio(tp, tp + fn),
+            'false_positive_rate': _ratio(fp, fp + tn),
+            'accuracy': _ratio(tp + tn, tp + fp + tn + fn),
+            'f1': _ratio(2 * tp, 2 * tp + fp + fn)}
+
+
+def detection_delay(flags, truth, valid=None):
+    ''' Timesteps from each node's first true compromise until a detector
+    first flags it
+
+    --------------
+    Parameters
+    --------------
+        flags, truth, valid: array
+            As for confusion_counts
+    --------------
+    Returns
+    --------------
+        delay: array, int
+            (..., nodes), -1 where the node was never compromised or never
+            flagged after its compromise
+
+    '''
+    flags = np.asarray(flags).astype(bool)
+    truth = np.asarray(truth).astype(bool)
+    if valid is not None:
+        valid = np.broadcast_to(valid, flags.shape)
+        flags = flags & valid
+        truth = truth & valid
+    first = first_true(truth)
+    after = np.arange(flags.shape[-2])[:, None] >= first[..., None, :]
+    hits = flags & after & (first >= 0)[..., None, :]
+    return np.where(hits.any(axis=-2), np.argmax(hits, axis=-2) - first, -1)
+
+
+def evaluate(columns, time=None, valid=None):
+    ''' Evaluates every detector against the truth for every node, over
+    whole result arrays. Leading axes (e.g. runs) are kept, so thousands
+    of runs stacked into one array are evaluated at once.
+
+    --------------
+    Parameters
+    --------------
+        columns: dict
+            (column name, (..., timesteps, nodes) array) pairs holding
+            compromised_truth and the columns of detector_columns
+        time: array, int
+            Simulation time of each timestep, used for compromise_time.
+            Defaults to the timestep index
+        valid: array, bool
+            Timesteps to evaluate, broadcastable to the columns
+    --------------
+    Returns
+    --------------
+        summary: dict
+            (name, (..., nodes) array) pairs:
+            - compromise_time: first time the node was compromised, -1 if
+              it never was
+            - [detector]_tp/fp/tn/fn: confusion counts of each detector
+            - [detector]_detect_delay: timesteps from compromise until the
+              detector first flagged the node, -1 if it never did
+
+    '''
+    truth = np.asarray(columns['compromised_truth']).astype(bool)
+    if valid is not None:
+        truth = truth & np.broadcast_to(valid, truth.shape)
+    first = first_true(truth)
+    time = np.arange(truth.shape[-2]) if time is None else np.asarray(time)
+    summary = {'compromise_time': np.where(first >= 0, time[first], -1)}
+
+    for detector, column in detector_columns.items():
+        flags = columns[column]
+        for name, counts in confusion_counts(flags, truth, valid).items():
+            summary[f'{detector}_{name}'] = counts
+        summary[f'{detector}_detect_delay'] = detection_delay(flags, truth, valid)
+    return summary
+
+
+def aggregate(summary, axis=0):
+    ''' Pools the summaries of many runs into per-node statistics
+
+    --------------
+    Parameters
+    --------------
+        summary: dict
+            Output of evaluate with runs along axis
+        axis: int
+            Axis of the runs
+    --------------
+    Returns
+    --------------
+        statistics: dict
+            (name, per-node array) pairs:
+            - compromise_probability: fraction of runs where the node
+              was compromised
+            - mean_time_to_compromise: mean compromise time over the
+              runs where the node was compromised (NaN if never)
+            - [detector]_recall, _precision, _false_positive_rate,
+              _accuracy, _f1: from the counts pooled over all runs
+            - [detector]_detection_probability: fraction of compromised
+              runs in which the detector flagged the node
+            - [detector]_mean_time_to_detect: mean detection delay over
+              the runs where the node was detected
+
+    '''
+    compromised = summary['compromise_time'] >= 0
+    statistics = {'compromise_probability': compromised.mean(axis=axis),
+                  'mean_time_to_compromise': _masked_mean(summary['compromise_time'], compromised, axis)}
+
+    for detector in detector_columns:
+        counts = [summary[f'{detector}_{c}'].sum(axis=axis) for c in ('tp', 'fp', 'tn', 'fn')]
+        for name, rate in detection_rates(*counts).items():
+            statistics[f'{detector}_{name}'] = rate
+
+        delay = summary[f'{detector}_detect_delay']
+        detected = delay >= 0
+        statistics[f'{detector}_detection_probability'] = _ratio(detected.sum(axis=axis), compromised.sum(axis=axis))
+        statistics[f'{detector}_mean_time_to_detect'] = _masked_mean(delay, detected, axis)
+    return statistics
+
+
+def get_ratio_terms(summary, statistic):
+    ''' Every statistic of aggregate is a ratio of two sums over the runs.
+    Returns the per-run terms of both sums.
+
+    --------------
+    Parameters
+    --------------
+        summary: dict
+            Output of evaluate with runs along the first axis
+        statistic: str
+            Name of a statistic of aggregate, e.g. 'fuzzy_false_positive_rate'
+    --------------
+    Returns
+    --------------
+        numerator, denominator: array
+            (runs, nodes) terms, so that the statistic is
+            numerator.sum(axis=0) / denominator.sum(axis=0)
+
+    '''
+    compromised = summary['compromise_time'] >= 0
+    if statistic == 'compromise_probability':
+        return compromised, np.ones(compromised.shape)
+    if statistic == 'mean_time_to_compromise':
+        return np.where(compromised, summary['compromise_time'], 0), compromised
+
+    for detector in detector_columns:
+        if not statistic.startswith(f'{detector}_'):
+            continue
+        name = statistic[len(detector) + 1:]
+        tp, fp, tn, fn = [summary[f'{detector}_{c}'] for c in ('tp', 'fp', 'tn', 'fn')]
+        delay = summary[f'{detector}_detect_delay']
+        detected = delay >= 0
+        terms = {'precision': (tp, tp + fp),
+                 'recall': (tp, tp + fn),
+                 'false_positive_rate': (fp, fp + tn),
+                 'accuracy': (tp + tn, tp + fp + tn + fn),
+                 'f1': (2 * tp, 2 * tp + fp + fn),
+                 'detection_probability': (detected, compromised),
+                 'mean_time_to_detect': (np.where(detected, delay, 0), detected)}
+        if name in terms:
+            return terms[name]
+    raise ValueError(f'Unknown statistic: {statistic}')
+
+
+def confidence_interval(summary, statistic, node=None, confidence=0.95):
+    ''' Confidence interval of a statistic of aggregate over the runs of a
+    summary. The runs are independent, so the statistic is a ratio of two
+    means over the runs and its standard error comes from the delta
+    method, with a normal approximation for the interval.
+
+    --------------
+    Parameters
+    --------------
+        summary: dict
+            Output of evaluate with runs along the first axis
+        statistic: str
+            Name of a statistic of aggregate
+        node: int or None
+            Index of the node, or None to pool the statistic over all
+            nodes
+        confidence: float
+            Coverage of the interval
+    --------------
+    Returns
+    --------------
+        interval: dict
+            'estimate', 'low', 'high' and 'width' of the interval, NaN
+            estimate and infinite width while it is undefined, and 'runs'
+            the number of runs it is based on
+
+    '''
+    numerator, denominator = [np.asarray(t, dtype=float) for t in get_ratio_terms(summary, statistic)]
+    if node is None:
+        numerator, denominator = numerator.sum(axis=1), denominator.sum(axis=1)
+    else:
+        numerator, denominator = numerator[:, node], denominator[:, node]
+
+    n = len(numerator)
+    if n < 2 or denominator.sum() == 0:
+        return {'estimate': float('nan'), 'low': float('nan'), 'high': float('nan'),
+                'width': float('inf'), 'runs': n}
+    estimate = numerator.sum() / denominator.sum()
+    residual = numerator - estimate * denominator
+    error = np.sqrt((residual ** 2).sum() / (n * (n - 1))) / denominator.mean()
+    half_width = NormalDist().inv_cdf(0.5 + confidence / 2) * error
+    return {'estimate': float(estimate),
+            'low': float(estimate - half_width),
+            'high': float(estimate + half_width),
+            'width': float(2 * half_width),
+            'runs': n}
+
+
+def stack_results(results):
+    ''' Gathers sim_results (a dict or ResultReader) into (timesteps, nodes)
+    arrays, leaving out the initial row (time -1)
+
+    --------------
+    Parameters
+    --------------
+        results: dict or ResultReader
+            Results returned by run_simulation
+    --------------
+    Returns
+    --------------
+        time: array, int
+        columns: dict
+            (column name, (timesteps, nodes) array) pairs for the truth
+            and detector columns
+
+    '''
+    names = ['compromised_truth'] + list(detector_columns.values())
+    if isinstance(results, ResultReader):
+        time = np.asarray(results.get_times())
+        columns = {name: results.get_column(name) for name in names}
+    else:
+        node_results = list(results.values())
+        time = np.asarray(node_results[0]['time'])
+        columns = {name: np.column_stack([r[name] for r in node_results]) for name in names}
+    steps = time >= 0
+    return time[steps], {name: np.asarray(values[steps]) for name, values in columns.items()}
+
+
+def evaluate_results(results):
+    ''' Evaluates the detectors on the results of one simulation
+
+    --------------
+    Parameters
+    --------------
+        results: dict or ResultReader
+            Results returned by run_simulation
+    --------------
+    Returns
+    --------------
+        evaluation: dict
+            Node name: dict of the counts and delays of evaluate and the
+            rates of detection_rates for each detector
+
+    '''
+    time, columns = stack_results(results)
+    summary = evaluate(columns, time)
+    for detector in detector_columns:
+        counts = [summary[f'{detector}_{c}'] for c in ('tp', 'fp', 'tn', 'fn')]
+        for name, rate in detection_rates(*counts).items():
+            summary[f'{detector}_{name}'] = rate
+    return {node: {name: values[i].item() for name, values in summary.items()}
+            for i, node in enumerate(results)}
+
+
+def _ratio(numerator, denominator):
+    # Element-wise ratio, NaN where the denominator is 0
+    numerator = np.asarray(numerator, dtype=float)
+    return np.divide(numerator, denominator, out=np.full(numerator.shape, np.nan), where=np.asarray(denominator) > 0)
+
+
+def _masked_mean(values, mask, axis=0):
+    # Means along axis over the entries selected by mask, NaN where empty
+    return _ratio(np.where(mask, values, 0).sum(axis=axis), mask.sum(axis=axis))
@@ -0,0 +1,353 @@
+from functools import reduce
+import operator
+
+import numpy as np
+
+# The antecedent universes are laid out for the default metrics of
+# metric_generator.metric_values; nodes with other baselines are mapped
+# onto them by MetricBaseline.normalize rather than moving the universes
+fuzzy_values = {'response_time_universe': (0, 600, 10),
+                'packet_rate_universe': (0.83, 0.93, 0.005),
+                'bandwidth_universe': (5, 35, 1),
+                'compromised_universe': (0, 11, 1),
+                'response_time_ceiling': 600,
+                'green': (0, 0, 4),
+                'yellow': (2, 8, 11),
+                'red': (7, 11, 11)}
+
+# Rules 2-6 of the original fuzzy_compromise_check, as
+# (operator, ((antecedent, term), ...), consequent term)
+fuzzy_rules = (('or', (('response_time', 'poor'), ('packet_rate', 'poor'), ('bandwidth', 'poor')), 'red'),
+               ('and', (('packet_rate', 'average'), ('response_time', 'average')), 'yellow'),
+               ('and', (('packet_rate', 'average'), ('bandwidth', 'average')), 'yellow'),
+               ('and', (('response_time', 'good'), ('bandwidth', 'good')), 'green'),
+               ('and', (('response_time', 'good'), ('packet_rate', 'good')), 'green'))
+
+antecedent_names = ('response_time', 'packet_rate', 'bandwidth')
+consequent_terms = ('green', 'yellow', 'red')
+
+# Detectors that have already been created, keyed by their parameter set
+_detector_cache = {}
+
+
+class FuzzyDetector:
+    '''
+    Fuzzy logic system used to calculate the likelihood that a node is
+    compromised. The antecedents, consequent, rules and control system are
+    only built once, the first time the detector is used, and are then
+    shared by every node that calls into the detector.
+
+    --------------
+    Attributes
+    --------------
+        params: dict
+            Universes of the antecedents and consequent, the value that
+            response time is inverted against, and the trimf breakpoints
+            of the green/yellow/red consequent terms
+
+    --------------
+    Methods
+    --------------
+        get_simulation()
+            Builds the control system if needed and returns the
+            ControlSystemSimulation used for evaluation
+        compute(packet_rate, bandwidth, response_time)
+            Calculates the fuzzy compromised value for a set of metrics
+        get_tables()
+            Builds the NumPy membership tables used by compute_batch
+        compute_batch(packet_rate, bandwidth, response_time)
+            Calculates the fuzzy compromised values for arrays of metrics
+            in one vectorized pass
+    --------------
+
+    '''
+
+    def __init__(self, params=None):
+        self.params = dict(fuzzy_values)
+        if params is not None:
+            self.params.update(params)
+        self._compromised_sim = None
+        self._tables = None
+
+    def get_simulation(self):
+        ''' Sets up the fuzzy logic system the first time it is needed.
+        Implements antecedents and consequent, establishes universe and
+        rules.
+
+        --------------
+        Returns
+        --------------
+            compromised_sim: ControlSystemSimulation
+                Simulation object that the inputs are passed to
+
+        '''
+        if self._compromised_sim is not None:
+            return self._compromised_sim
+
+        # scikit-fuzzy is slow to import and only needed by this exact
+        # path, so it is loaded on first use
+        import skfuzzy as fuzz
+        from skfuzzy import control as ctrl
+
+        p = self.params
+        response_time = ctrl.Antecedent(np.arange(*p['response_time_universe']), 'response_time')
+        packet_rate = ctrl.Antecedent(np.arange(*p['packet_rate_universe']), 'packet_rate')
+        bandwidth = ctrl.Antecedent(np.arange(*p['bandwidth_universe']), 'bandwidth')
+
+        compromised = ctrl.Consequent(np.arange(*p['compromised_universe']), 'compromised')
+
+        response_time.automf(3)
+        packet_rate.automf(3)
+        bandwidth.automf(3)
+
+        compromised['green'] = fuzz.trimf(compromised.universe, list(p['green']))
+        compromised['yellow'] = fuzz.trimf(compromised.universe, list(p['yellow']))
+        compromised['red'] = fuzz.trimf(compromised.universe, list(p['red']))
+
+        antecedents = {'response_time': response_time,
+                       'packet_rate': packet_rate,
+                       'bandwidth': bandwidth}
+        rules = []
+        for op, terms, consequent_term in fuzzy_rules:
+            combine = operator.or_ if op == 'or' else operator.and_
+            antecedent = reduce(combine, [antecedents[name][term] for name, term in terms])
+            rules.append(ctrl.Rule(antecedent, compromised[consequent_term]))
+
+        compromised_ctrl = ctrl.ControlSystem(rules)
+
+        # Inputs are continuous and almost never repeat, so the result
+        # cache would only grow without ever being hit
+        self._compromised_sim = ctrl.ControlSystemSimulation(compromised_ctrl, cache=False)
+        return self._compromised_sim
+
+    def compute(self, packet_rate, bandwidth, response_time):
+        ''' Calculates fuzzy logic output for whether or not a node
+        is compromised.
+
+        --------------
+        Parameters
+        --------------
+            - packet_rate: float
+                Current packet rate of the node
+            - bandwidth: float
+                Current bandwidth of the node
+            - response_time: float
+                Current response time of the node. This is inverted against
+                the response time ceiling so that higher values are better
+        --------------
+        Returns
+        --------------
+            - result: float
+                Defuzzified compromised value
+
+        '''
+        compromised_sim = self.get_simulation()
+
+        compromised_sim.input['packet_rate'] = packet_rate
+        compromised_sim.input['bandwidth'] = bandwidth
+        compromised_sim.input['response_time'] = self.params['response_time_ceiling'] - response_time
+
+        compromised_sim.compute()
+
+        return compromised_sim.output['compromised']
+
+    def get_tables(self):
+        ''' Builds the universes and sampled membership functions of the
+        antecedents and consequent the first time they are needed. These
+        are the same automf(3) and trimf memberships used by the
+        scikit-fuzzy system.
+
+        --------------
+        Returns
+        --------------
+            tables: dict
+                (universe, {term: membership}) for each antecedent and
+                for the compromised consequent
+
+        '''
+        if self._tables is not None:
+            return self._tables
+
+        p = self.params
+        tables = {}
+        for name in antecedent_names:
+            universe = np.arange(*p[f'{name}_universe'])
+            tables[name] = (universe, _automf3(universe))
+
+        universe = np.arange(*p['compromised_universe'])
+        tables['compromised'] = (universe, {term: _trimf(universe, p[term])
+                                            for term in consequent_terms})
+        self._tables = tables
+        return tables
+
+    def compute_batch(self, packet_rate, bandwidth, response_time, chunk_size=65536):
+        ''' Calculates fuzzy logic output for arrays of node metrics using
+        Mamdani inference written in NumPy: min/max rule aggregation, min
+        activation, max accumulation and centroid defuzzification over the
+        consequent universe upsampled at the activation cuts. This mirrors
+        what scikit-fuzzy does for a single input, so results agree with
+        compute() to floating point precision.
+
+        --------------
+        Parameters
+        --------------
+            - packet_rate: array
+                Packet rates, any shape (e.g. nodes or timesteps x nodes)
+            - bandwidth: array
+                Bandwidths, same shape as packet_rate
+            - response_time: array
+                Response times, same shape as packet_rate
+            - chunk_size: int
+                Number of values evaluated together, bounding the size of
+                the intermediate (values x upsampled universe) arrays
+        --------------
+        Returns
+        --------------
+            - result: array
+                Defuzzified compromised values, same shape as the inputs.
+                NaN where no rule fires
+
+        '''
+        tables = self.get_tables()
+        inputs = {'packet_rate': np.asarray(packet_rate, dtype=float),
+                  'bandwidth': np.asarray(bandwidth, dtype=float),
+                  'response_time': self.params['response_time_ceiling'] - np.asarray(response_time, dtype=float)}
+        shape = inputs['packet_rate'].shape
+        for name in antecedent_names:
+            universe = tables[name][0]
+            inputs[name] = np.clip(inputs[name].ravel(), universe.min(), universe.max())
+
+        result = np.empty(inputs['packet_rate'].size)
+        for start in range(0, result.size, chunk_size):
+            chunk = {name: values[start:start + chunk_size] for name, values in inputs.items()}
+            result[start:start + chunk_size] = _infer(tables, chunk)
+        return result.reshape(shape)
+
+
+def get_fuzzy_detector(params=None):
+    ''' Returns the shared detector for a parameter set, creating it the
+    first time the parameter set is seen.
+
+    --------------
+    Parameters
+    --------------
+        params: dict
+            Overrides for the values in fuzzy_values
+    --------------
+    Returns
+    --------------
+        detector: FuzzyDetector
+
+    '''
+    full_params = dict(fuzzy_values)
+    if params is not None:
+        full_params.update(params)
+    key = tuple(sorted(full_params.items()))
+
+    detector = _detector_cache.get(key)
+    if detector is None:
+        detector = FuzzyDetector(full_params)
+        _detector_cache[key] = detector
+    return detector
+
+
+def _trimf(x, abc):
+    ''' Triangular membership function, sampled on universe x. Matches
+    skfuzzy.trimf, including the handling of shoulders where a == b or
+    b == c.
+    '''
+    a, b, c = abc
+    y = np.zeros(len(x))
+    if a != b:
+        idx = np.nonzero((a < x) & (x < b))[0]
+        y[idx] = (x[idx] - a) / float(b - a)
+    if b != c:
+        idx = np.nonzero((b < x) & (x < c))[0]
+        y[idx] = (c - x[idx]) / float(c - b)
+    y[x == b] = 1
+    return y
+
+
+def _automf3(universe):
+    ''' Poor/average/good triangular terms spread over the universe, the
+    same way Antecedent.automf(3) builds them.
+    '''
+    low, high = universe.min(), universe.max()
+    width = (high - low) / ((3 - 1) / 2.)
+    centers = np.linspace(low, high, 3)
+    return {name: _trimf(universe, [c - width / 2, c, c + width / 2])
+            for name, c in zip(('poor', 'average', 'good'), centers)}
+
+
+def _infer(tables, inputs):
+    ''' Runs the fuzzy rules for 1-D arrays of clipped inputs and returns
+    the centroid of the accumulated consequent.
+    '''
+    membership = {}
+    for name in antecedent_names:
+        universe, terms = tables[name]
+        for term, mf in terms.items():
+            membership[(name, term)] = np.interp(inputs[name], universe, mf)
+
+    # Rule firing strengths, accumulated per consequent term with max
+    cuts = {}
+    for op, terms, consequent_term in fuzzy_rules:
+        combine = np.fmax if op == 'or' else np.fmin
+        firing = reduce(combine, [membership[t] for t in terms])
+        if consequent_term in cuts:
+            firing = np.fmax(firing, cuts[consequent_term])
+        cuts[consequent_term] = firing
+    return _defuzzify(tables['compromised'], cuts)
+
+
+def _defuzzify(consequent, cuts):
+    ''' Centroid of the consequent terms, each cut at the firing strength
+    of its rules, for 1-D arrays of firing strengths. NaN where no rule
+    fires.
+
+    --------------
+    Parameters
+    --------------
+        consequent: tuple
+            (universe, {term: membership}) of the consequent
+        cuts: dict
+            (term, firing strength array) pairs
+    --------------
+    Returns
+    --------------
+        result: array
+
+    '''
+    # Upsample the consequent universe with the points where each term's
+    # membership crosses its cut. Segments without a crossing contribute a
+    # duplicate universe point, which adds a zero-width segment only.
+    universe, terms = consequent
+    size = len(next(iter(cuts.values())))
+    x1, x2 = universe[:-1], universe[1:]
+    points = [np.broadcast_to(universe, (size, len(universe)))]
+    for term, cut in cuts.items():
+        mf = terms[term]
+        y1, y2 = mf[:-1], mf[1:]
+        y = cut[:, None]
+        above1 = np.where(y == 0, y1 > y, y1 >= y)
+        above2 = np.where(y == 0, y2 > y, y2 >= y)
+        crossing = above1 != above2
+        slope = np.where(y2 != y1, y2 - y1, 1.)
+        crossed_at = x1 + (y - y1) * (x2 - x1) / slope
+        points.append(np.where(crossing, crossed_at, x1))
+    points = np.sort(np.concatenate(points, axis=1), axis=1)
+
+    output_mf = np.zeros_like(points)
+    for term, cut in cuts.items():
+        np.maximum(output_mf, np.minimum(cut[:, None], np.interp(points, universe, terms[term])), output_mf)
+
+    # Centroid of the piecewise linear output membership
+    dx = np.diff(points, axis=1)
+    m1, m2 = output_mf[:, :-1], output_mf[:, 1:]
+    area = 0.5 * dx * (m1 + m2)
+    height = np.where(m1 + m2 > 0, m1 + m2, 1.)
+    moment = 2.0 / 3.0 * dx * (m2 + 0.5 * m1) / height + points[:, :-1]
+    sum_area = area.sum(axis=1)
+    result = (moment * area).sum(axis=1) / np.fmax(sum_area, np.finfo(float).eps)
+    result[output_mf.sum(axis=1) == 0] = np.nan
+    return result
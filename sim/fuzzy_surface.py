@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .fuzzy_detector import fuzzy_rules, get_fuzzy_detector
+from .detectors import fuzzy_category
+
+# Grid points along the response time, packet rate and bandwidth axes: 4
+# points per step of the default universes. Interpolation error with the
+# default detector, as max error over the whole grid (the build check)
+# and max error / category changes on 200000 draws of the default metrics
+# (half compromised), for 2, 4 and 8 points per universe step:
+#
+#   shape             grid max error   draws max error   category changes   build
+#   (121, 41, 61)         1.41             0.12              0.11 %         4 s
+#   (241, 81, 121)        0.86             0.070             0.018 %       24 s
+#   (481, 161, 241)       0.41             0.033             0.004 %      160 s
+#
+# The largest errors are where the rules stop firing, away from where the
+# metrics fall. Category changes are draws whose fuzzy category differs
+# from exact inference's for either previous category (cutoffs 5 and 6 on
+# the 0-11 output scale)
+default_surface_shape = (241, 81, 121)
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'fuzzy_defender')
+
+# Surfaces that have already been loaded, keyed by their config hash
+_surface_cache = {}
+
+
+class FuzzySurface:
+    '''
+    Precomputed output of a fuzzy detector on a regular 3-D grid of
+    (response_time, packet_rate, bandwidth) spanning the antecedent
+    universes. Values between grid points are found by trilinear
+    interpolation, so a lookup costs a handful of array operations
+    regardless of how many nodes are checked.
+
+    --------------
+    Attributes
+    --------------
+        detector: FuzzyDetector
+            Detector the surface was computed from
+        shape: tuple, int
+            Number of grid points along the response time, packet rate
+            and bandwidth axes
+        key: str
+            Hash of the membership/rule config and grid shape, used as
+            the file name of the stored surface
+        axes: list, arrays
+            Grid coordinates along each axis, in detector input units
+            (response time is inverted against the ceiling)
+        values: array
+            Defuzzified output at every grid point
+        max_error: float
+            Largest absolute difference from exact inference found when
+            the surface was built
+        category_changes: float
+            Fraction of the check points of the build whose fuzzy
+            category differs from exact inference's, for either previous
+            category
+
+    --------------
+    Methods
+    --------------
+        build(n_check)
+            Computes the surface and measures its interpolation error
+        save(cache_dir) / load(cache_dir)
+            Stores or restores the surface on disk
+        compute_batch(packet_rate, bandwidth, response_time)
+            Interpolates the fuzzy compromised values for arrays of metrics
+    --------------
+
+    '''
+
+    def __init__(self, detector, shape=default_surface_shape):
+        self.detector = detector
+        self.shape = tuple(int(n) for n in shape)
+        self.key = surface_key(detector.params, self.shape)
+
+        tables = detector.get_tables()
+        self.axes = [np.linspace(tables[name][0].min(), tables[name][0].max(), n)
+                     for name, n in zip(('response_time', 'packet_rate', 'bandwidth'), self.shape)]
+        self.values = None
+        self.max_error = None
+        self.category_changes = None
+
+    def build(self, n_check=100000, seed=0):
+        ''' Evaluates the detector at every grid point, then compares the
+        interpolated surface against exact inference at every cell centre
+        and at n_check random points.
+
+        --------------
+        Parameters
+        --------------
+            - n_check: int
+                Number of random points used to measure the error
+            - seed: int
+                Seed for the random check points
+
+        '''
+        ceiling = self.detector.params['response_time_ceiling']
+        r, p, b = np.meshgrid(*self.axes, indexing='ij')
+        self.values = self.detector.compute_batch(p, b, ceiling - r)
+
+        centers = [0.5 * (a[1:] + a[:-1]) for a in self.axes]
+        r, p, b = [c.ravel() for c in np.meshgrid(*centers, indexing='ij')]
+
+        rng = np.random.default_rng(seed)
+        r = np.concatenate([r, rng.uniform(self.axes[0][0], self.axes[0][-1], n_check)])
+        p = np.concatenate([p, rng.uniform(self.axes[1][0], self.axes[1][-1], n_check)])
+        b = np.concatenate([b, rng.uniform(self.axes[2][0], self.axes[2][-1], n_check)])
+
+        exact = self.detector.compute_batch(p, b, ceiling - r)
+        approx = self.compute_batch(p, b, ceiling - r)
+        self.max_error = float(np.nanmax(np.abs(approx - exact)))
+        changed = np.zeros(len(exact), dtype=bool)
+        for previous in (0, 1):
+            changed |= fuzzy_category(exact, previous) != fuzzy_category(approx, previous)
+        self.category_changes = float(changed.mean())
+        return self
+
+    def get_path(self, cache_dir=default_cache_dir):
+        return os.path.join(cache_dir, f'fuzzy_surface_{self.key}.npz')
+
+    def save(self, cache_dir=default_cache_dir):
+        ''' Writes the surface to cache_dir, named by its config hash
+
+        --------------
+        Parameters
+        --------------
+            cache_dir: str
+                Directory the surface is stored in
+
+        '''
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(self.get_path(cache_dir), values=self.values, max_error=self.max_error,
+                 category_changes=self.category_changes)
+
+    def load(self, cache_dir=default_cache_dir):
+        ''' Reads a previously saved surface for the same config
+
+        --------------
+        Returns
+        --------------
+            loaded: bool
+                False if no surface has been stored for this config, or
+                it was stored without its accuracy
+
+        '''
+        path = self.get_path(cache_dir)
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            if 'category_changes' not in data.files:
+                return False
+            self.values = data['values']
+            self.max_error = float(data['max_error'])
+            self.category_changes = float(data['category_changes'])
+        return True
+
+    def compute_batch(self, packet_rate, bandwidth, response_time):
+        ''' Looks up fuzzy compromised values by trilinear interpolation.
+        Inputs outside the universes are clipped, as in exact inference.
+
+        --------------
+        Parameters
+        --------------
+            - packet_rate: array
+            - bandwidth: array
+            - response_time: array
+                Node metrics, all of the same shape
+        --------------
+        Returns
+        --------------
+            - result: array
+                Interpolated compromised values, same shape as the inputs
+
+        '''
+        ceiling = self.detector.params['response_time_ceiling']
+        coords = [ceiling - np.asarray(response_time, dtype=float),
+                  np.asarray(packet_rate, dtype=float),
+                  np.asarray(bandwidth, dtype=float)]
+        shape = coords[0].shape
+
+        index = []
+        weight = []
+        for axis, values in zip(self.axes, coords):
+            pos = (np.clip(values.ravel(), axis[0], axis[-1]) - axis[0]) / (axis[1] - axis[0])
+            i = np.minimum(pos.astype(np.intp), len(axis) - 2)
+            index.append(i)
+            weight.append(pos - i)
+
+        flat = self.values.ravel()
+        n_p, n_b = self.shape[1], self.shape[2]
+        result = np.zeros(index[0].shape)
+        for dr in (0, 1):
+            wr = weight[0] if dr else 1 - weight[0]
+            for dp in (0, 1):
+                wp = weight[1] if dp else 1 - weight[1]
+                for db in (0, 1):
+                    wb = weight[2] if db else 1 - weight[2]
+                    corner = ((index[0] + dr) * n_p + index[1] + dp) * n_b + index[2] + db
+                    result += wr * wp * wb * flat[corner]
+        return result.reshape(shape)
+
+
+def surface_key(params, shape):
+    ''' Hash of everything that determines a surface: the membership
+    parameters, the rules and the grid shape.
+    '''
+    config = {'params': sorted((k, list(v) if isinstance(v, tuple) else v) for k, v in params.items()),
+              'rules': fuzzy_rules,
+              'shape': list(shape)}
+    return hashlib.sha256(json.dumps(config).encode()).hexdigest()[:16]
+
+
+def get_fuzzy_surface(params=None, shape=default_surface_shape, cache_dir=default_cache_dir):
+    ''' Returns the precomputed surface for a parameter set, loading it from
+    cache_dir or building and storing it the first time it is needed. The
+    surface's max_error and category_changes give its accuracy.
+
+    --------------
+    Parameters
+    --------------
+        params: dict
+            Overrides for the values in fuzzy_values
+        shape: tuple, int
+            Grid points along the response time, packet rate and bandwidth axes
+        cache_dir: str
+            Directory surfaces are stored in. None keeps the surface in
+            memory only
+    --------------
+    Returns
+    --------------
+        surface: FuzzySurface
+
+    '''
+    surface = FuzzySurface(get_fuzzy_detector(params), shape)
+    if surface.key in _surface_cache:
+        return _surface_cache[surface.key]
+
+    if cache_dir is None or not surface.load(cache_dir):
+        surface.build()
+        if cache_dir is not None:
+            surface.save(cache_dir)
+    _surface_cache[surface.key] = surface
+    return surface
@@ -0,0 +1,272 @@
+import json
+import time
+import tracemalloc
+
+
+class Profiler:
+    '''
+    Opt-in instrumentation for the stages of a simulation or report. Code
+    wraps each stage in `with profiler.stage(name):` and the profiler adds
+    up the wall time, number of calls and, optionally, memory allocated
+    by the stage. At the end of every timestep the timings of that step
+    are sent to the sinks, and the totals are kept for summary().
+
+    Stages must not be nested. When no profiler is given, code uses
+    null_profiler, whose stages do nothing, so disabled instrumentation
+    costs one method call per stage.
+
+    --------------
+    Attributes
+    --------------
+        sinks: list
+            Objects with write(record) and close() methods that receive a
+            record for every timestep
+        allocations: bool
+            Trace memory allocations with tracemalloc. Slows down the
+            stages being measured
+        totals: dict
+            stage name: {'seconds', 'calls', 'allocated_bytes',
+            'peak_bytes'} over the whole run
+        counters: dict
+            counter name: total count over the whole run
+
+    --------------
+    Methods
+    --------------
+        stage(name)
+            Context manager measuring one call of a stage
+        count(name, n)
+            Adds to a counter
+        end_step(step)
+            Sends the measurements since the last step to the sinks
+        summary()
+            Totals of all stages and counters
+        close()
+            Ends the last step and closes the sinks
+    --------------
+
+    '''
+
+    enabled = True
+
+    def __init__(self, sinks=None, allocations=False):
+        self.sinks = list(sinks) if sinks is not None else [SummarySink()]
+        self.allocations = allocations
+        self.totals = {}
+        self.counters = {}
+        self._step = {}
+        self._step_counters = {}
+        self._stages = {}
+        self._started_tracing = allocations and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    def stage(self, name):
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages[name] = _Stage(self, name)
+        return stage
+
+    def count(self, name, n=1):
+        self._step_counters[name] = self._step_counters.get(name, 0) + n
+
+    def _add(self, name, seconds, allocated, peak):
+        entry = self._step.get(name)
+        if entry is None:
+            entry = self._step[name] = {'seconds': 0., 'calls': 0, 'allocated_bytes': 0, 'peak_bytes': 0}
+        entry['seconds'] += seconds
+        entry['calls'] += 1
+        entry['allocated_bytes'] += allocated
+        entry['peak_bytes'] = max(entry['peak_bytes'], peak)
+
+    def end_step(self, step=None):
+        ''' Adds the measurements since the last step to the totals and
+        sends them to the sinks
+
+        --------------
+        Parameters
+        --------------
+            step: int or str
+                Timestep or label the measurements belong to
+
+        '''
+        if not self._step and not self._step_counters:
+            return
+        for name, entry in self._step.items():
+            total = self.totals.setdefault(name, {'seconds': 0., 'calls': 0, 'allocated_bytes': 0, 'peak_bytes': 0})
+            total['seconds'] += entry['seconds']
+            total['calls'] += entry['calls']
+            total['allocated_bytes'] += entry['allocated_bytes']
+            total['peak_bytes'] = max(total['peak_bytes'], entry['peak_bytes'])
+        for name, n in self._step_counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+        record = {'step': step, 'stages': self._step, 'counters': self._step_counters}
+        for sink in self.sinks:
+            sink.write(record)
+        self._step = {}
+        self._step_counters = {}
+
+    def summary(self):
+        ''' Totals of every stage and counter, with each stage's share of
+        the total measured time
+
+        --------------
+        Returns
+        --------------
+            summary: dict
+                {'stages': {name: totals}, 'counters': {name: count}}
+
+        '''
+        measured = sum(t['seconds'] for t in self.totals.values()) or 1.
+        stages = {name: dict(total, share=total['seconds'] / measured,
+                             seconds_per_call=total['seconds'] / total['calls'])
+                  for name, total in self.totals.items()}
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+    def print_summary(self):
+        summary = self.summary()
+        for name, s in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+            line = f"{name:>16}: {s['seconds']:9.4f} s {100 * s['share']:5.1f}% {s['calls']:8d} calls"
+            if self.allocations:
+                line += f"  {s['allocated_bytes'] / 2**20:9.2f} MiB allocated, peak {s['peak_bytes'] / 2**20:8.2f} MiB"
+            print(line)
+        for name, n in summary['counters'].items():
+            print(f'{name:>16}: {n}')
+
+    def close(self):
+        self.end_step('end')
+        for sink in self.sinks:
+            sink.close()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+
+class _Stage:
+    # Reusable context manager for one stage of a Profiler
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.allocations:
+            self._memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        allocated = peak = 0
+        if self.profiler.allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            allocated = max(current - self._memory, 0)
+            peak = max(peak - self._memory, 0)
+        self.profiler._add(self.name, seconds, allocated, peak)
+        return False
+
+
+class _NullStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullProfiler:
+    '''
+    Profiler used when instrumentation is off. All methods do nothing.
+
+    '''
+
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, n=1):
+        pass
+
+    def end_step(self, step=None):
+        pass
+
+    def close(self):
+        pass
+
+
+null_profiler = NullProfiler()
+
+
+class SummarySink:
+    '''
+    Keeps the per-step records in memory
+
+    --------------
+    Attributes
+    --------------
+        records: list, dict
+            Record of every step, in order
+    --------------
+
+    '''
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    '''
+    Writes one JSON line per step to a file
+
+    --------------
+    Attributes
+    --------------
+        path: str
+            Output file, overwritten when the sink is created
+    --------------
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w')
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class CallbackSink:
+    '''
+    Calls a function with the record of every step
+
+    --------------
+    Attributes
+    --------------
+        callback: function
+            Called as callback(record)
+    --------------
+
+    '''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, record):
+        self.callback(record)
+
+    def close(self):
+        pass
@@ -0,0 +1,273 @@
+import copy
+
+import numpy as np
+
+metric_values = {'packet_rate_mu': 0.91,
+                'packet_rate_std': 0.01,
+                'packet_rate_min': 0.05,
+                'packet_rate_max': 0.1,
+                'bandwidth_mu': 30,
+                'bandwidth_std': 3,
+                'bandwidth_min': 2,
+                'bandwidth_max': 7,
+                'response_time_mu': 130,
+                'response_time_std': 20,
+                'response_time_min': 100,
+                'response_time_max': 300}
+
+metric_names = ('packet_rate', 'bandwidth', 'response_time')
+
+# Direction a compromise moves each metric: packet rate and bandwidth
+# drop, response time rises
+compromise_direction = {'packet_rate': -1, 'bandwidth': -1, 'response_time': 1}
+
+# Largest memory of one block of noise (a normal and a uniform array per
+# metric). Large networks draw fewer timesteps per block instead of
+# holding e.g. 3 GB of noise for 10^6 nodes
+max_block_bytes = 256 * 2 ** 20
+max_block_size = 64
+
+
+class MetricGenerator:
+    '''
+    Draws the performance metrics of every node in the network from a
+    seeded numpy.random.Generator. Healthy nodes draw each metric from a
+    normal distribution; compromised nodes additionally have a uniform
+    offset applied, selected by mask.
+
+    Nodes are split into lanes of lane_size nodes and every lane has its
+    own random streams (one normal and one uniform stream per metric).
+    Noise is drawn a block of timesteps at a time, and a compromise offset
+    is drawn for every node whether or not it is used, so the values a
+    node gets only depend on the seed and not on the block size, the
+    compromise state of other nodes, or which nodes are drawn together.
+
+    --------------
+    Attributes
+    --------------
+        num_nodes: int
+            Number of nodes metrics are drawn for
+        params: dict
+            (metric value name, per-node array) pairs with the mu, stdev
+            and compromise offset min/max of every metric
+        seed_seq: numpy.random.SeedSequence
+            Seed the lane streams are derived from
+        block_size: int
+            Number of timesteps of noise drawn at once. By default as many
+            as fit in max_block_bytes, at most max_block_size
+        lane_size: int
+            Number of nodes sharing one set of random streams
+
+    --------------
+    Methods
+    --------------
+        set_node_params(index, **values)
+            Sets metric values for one node (or several)
+        get_node_params(index)
+            Gets the metric values of one node
+        get_stream_states()
+            Gets the state of every random stream
+        set_stream_states(states)
+            Sets the state of every random stream
+        draw(steps, compromised)
+            Draws the metrics of all nodes for one or more timesteps
+        get_shard(start, stop)
+            Generator for a range of whole lanes, continuing this one
+        merge_shard(start, shard)
+            Takes back the state of a shard after it has drawn
+    --------------
+
+    '''
+
+    def __init__(self, num_nodes, seed=None, block_size=None, lane_size=4096):
+        if block_size is None:
+            block_size = get_block_size(num_nodes)
+        self.num_nodes = num_nodes
+        self.params = {key: np.full(num_nodes, value, dtype=np.float64)
+                       for key, value in metric_values.items()}
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_seq = seed
+        self.block_size = block_size
+        self.lane_size = lane_size
+
+        self._lanes = []
+        for lane, start in enumerate(range(0, num_nodes, lane_size)):
+            streams = [np.random.default_rng(np.random.SeedSequence(seed.entropy,
+                                                                    spawn_key=seed.spawn_key + (lane, stream)))
+                       for stream in range(2 * len(metric_names))]
+            self._lanes.append((slice(start, min(start + lane_size, num_nodes)), streams))
+        self._normal = None
+        self._uniform = None
+        self._position = block_size
+        # Lane stream states the current block was drawn from, so the
+        # block can be drawn again instead of saved (see checkpoint)
+        self._block_states = None
+
+    def set_node_params(self, index, **values):
+        ''' Sets the metric values used for one or more nodes
+
+        --------------
+        Parameters
+        --------------
+            index: int, array or slice
+                Node(s) to update
+            values: float
+                Any of the keys of metric_values, e.g. packet_rate_mu=0.9
+
+        '''
+        for key, value in values.items():
+            if key not in self.params:
+                raise ValueError(f'Unknown metric value: {key}')
+            self.params[key][index] = value
+
+    def get_node_params(self, index):
+        ''' Returns the metric values of one node as a dict shaped like
+        metric_values
+        '''
+        return {key: float(values[index]) for key, values in self.params.items()}
+
+    def _fill_block(self):
+        # Draw the next block of noise for every lane and stream
+        self._block_states = self.get_stream_states()
+        shape = (self.block_size, self.num_nodes)
+        self._normal = [np.empty(shape) for _ in metric_names]
+        self._uniform = [np.empty(shape) for _ in metric_names]
+        for nodes, streams in self._lanes:
+            width = nodes.stop - nodes.start
+            for m in range(len(metric_names)):
+                self._normal[m][:, nodes] = streams[2 * m].standard_normal((self.block_size, width))
+                self._uniform[m][:, nodes] = streams[2 * m + 1].random((self.block_size, width))
+        self._position = 0
+
+    def get_stream_states(self):
+        ''' Returns the bit generator state of every stream of every lane
+        '''
+        return [[rng.bit_generator.state for rng in streams] for _, streams in self._lanes]
+
+    def set_stream_states(self, states):
+        ''' Sets the bit generator state of every stream of every lane,
+        from get_stream_states
+        '''
+        for (_, streams), lane_states in zip(self._lanes, states):
+            for rng, rng_state in zip(streams, lane_states):
+                rng.bit_generator.state = rng_state
+
+    def _take(self, steps):
+        # Next `steps` rows of normal and uniform noise for each metric
+        normal = [[] for _ in metric_names]
+        uniform = [[] for _ in metric_names]
+        while steps > 0:
+            if self._position == self.block_size:
+                self._fill_block()
+            n = min(steps, self.block_size - self._position)
+            rows = slice(self._position, self._position + n)
+            for m in range(len(metric_names)):
+                normal[m].append(self._normal[m][rows])
+                uniform[m].append(self._uniform[m][rows])
+            self._position += n
+            steps -= n
+        return ([np.concatenate(parts) for parts in normal],
+                [np.concatenate(parts) for parts in uniform])
+
+    def draw(self, steps=1, compromised=None):
+        ''' Draws the metrics of every node for a number of timesteps.
+
+        --------------
+        Parameters
+        --------------
+            steps: int
+                Number of timesteps to draw
+            compromised: array
+                Compromise state of the nodes, either (num_nodes,) for all
+                steps or (steps, num_nodes). None means no node is
+                compromised
+        --------------
+        Returns
+        --------------
+            metrics: dict
+                (metric name, (steps, num_nodes) array) pairs
+
+        '''
+        normal, uniform = self._take(steps)
+        metrics = {}
+        for m, name in enumerate(metric_names):
+            p = self.params
+            values = p[f'{name}_mu'] + p[f'{name}_std'] * normal[m]
+            if compromised is not None:
+                low = p[f'{name}_min']
+                offset = low + (p[f'{name}_max'] - low) * uniform[m]
+                values += compromise_direction[name] * np.where(compromised, offset, 0.)
+            metrics[name] = values
+        return metrics
+
+    def get_shard(self, start, stop):
+        ''' Returns a generator for the nodes start..stop-1 that draws
+        exactly the values this generator would draw for them. The range
+        has to be made of whole lanes, since a lane's streams draw for all
+        of its nodes at once.
+
+        --------------
+        Parameters
+        --------------
+            start, stop: int
+                Node range, on lane boundaries
+        --------------
+        Returns
+        --------------
+            shard: MetricGenerator
+
+        '''
+        if start % self.lane_size or (stop % self.lane_size and stop != self.num_nodes):
+            raise ValueError(f'Shard {start}..{stop} does not start and end on lanes of {self.lane_size} nodes')
+        shard = MetricGenerator(0, self.seed_seq, self.block_size, self.lane_size)
+        shard.num_nodes = stop - start
+        shard.params = {key: values[start:stop].copy() for key, values in self.params.items()}
+        shard._lanes = [(slice(nodes.start - start, nodes.stop - start), copy.deepcopy(streams))
+                        for nodes, streams in self._lanes if start <= nodes.start < stop]
+        if self._normal is not None:
+            shard._normal = [values[:, start:stop].copy() for values in self._normal]
+            shard._uniform = [values[:, start:stop].copy() for values in self._uniform]
+            first = start // self.lane_size
+            shard._block_states = copy.deepcopy(self._block_states[first:first + len(shard._lanes)])
+        shard._position = self._position
+        return shard
+
+    def merge_shard(self, start, shard):
+        ''' Copies the random stream and noise buffer state of a shard
+        from get_shard back into this generator, so it continues where the
+        shard stopped. Every shard must have drawn the same number of
+        timesteps.
+
+        --------------
+        Parameters
+        --------------
+            start: int
+                First node of the shard
+            shard: MetricGenerator
+
+        '''
+        lane = start // self.lane_size
+        for i, (_, streams) in enumerate(shard._lanes):
+            self._lanes[lane + i] = (self._lanes[lane + i][0], streams)
+        if shard._normal is not None:
+            if self._normal is None:
+                shape = (self.block_size, self.num_nodes)
+                self._normal = [np.empty(shape) for _ in metric_names]
+                self._uniform = [np.empty(shape) for _ in metric_names]
+            nodes = slice(start, start + shard.num_nodes)
+            for m in range(len(metric_names)):
+                self._normal[m][:, nodes] = shard._normal[m]
+                self._uniform[m][:, nodes] = shard._uniform[m]
+            if self._block_states is None:
+                self._block_states = [None] * len(self._lanes)
+            self._block_states[lane:lane + len(shard._lanes)] = shard._block_states
+        self._position = shard._position
+
+
+def get_block_size(num_nodes, max_bytes=max_block_bytes):
+    ''' Number of timesteps of noise per block for a number of nodes, so
+    that a block takes at most max_bytes (and at least one timestep)
+    '''
+    row_bytes = 2 * len(metric_names) * np.dtype(np.float64).itemsize * max(num_nodes, 1)
+    return int(max(1, min(max_block_size, max_bytes // row_bytes)))
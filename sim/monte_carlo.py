@@ -0,0 +1,264 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import os
+import time
+
+import numpy as np
+
+from .scenario import build_simulation, get_scenario
+from .evaluation import aggregate, confidence_interval, detector_columns, evaluate
+
+
+def summarize_run(state):
+    ''' Reduces the recorded state of one simulation run to a compact
+    per-node summary, small enough to send back from a worker process.
+    The initial row (time -1) is left out.
+
+    --------------
+    Parameters
+    --------------
+        state: SimulationState
+            State of a finished simulation
+    --------------
+    Returns
+    --------------
+        summary: dict
+            (name, (num_nodes,) array) pairs, see evaluation.evaluate
+
+    '''
+    steps = state.get_times() >= 0
+    columns = {name: state[name][:state.rows][steps]
+               for name in ['compromised_truth'] + list(detector_columns.values())}
+    return evaluate(columns, state.get_times()[steps])
+
+
+def run_scenario(scenario, seed):
+    ''' Runs one simulation of a scenario and returns its summary. Used by
+    the worker processes of MonteCarlo.
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Scenario to run, see default_scenario
+        seed: numpy.random.SeedSequence
+            Independent seed for the run
+    --------------
+    Returns
+    --------------
+        summary: dict
+            See summarize_run
+
+    '''
+    sim = build_simulation(scenario, seed)
+    sim.run_simulation(scenario['timesteps'])
+    return summarize_run(sim.state)
+
+
+class MonteCarloResult:
+    '''
+    Per-run summaries of a Monte Carlo experiment and the aggregate
+    statistics computed from them.
+
+    --------------
+    Attributes
+    --------------
+        summaries: dict
+            (name, (runs, num_nodes) array) pairs, stacked from the
+            summaries of the individual runs
+        n_runs: int
+            Number of runs
+        elapsed: float
+            Wall time spent running the simulations, in seconds
+        targets: list, dict
+            Set by MonteCarlo.run_until: each target with its final
+            interval (see get_interval) and whether it was met
+        converged: bool
+            Set by MonteCarlo.run_until: whether every target was met
+
+    --------------
+    Methods
+    --------------
+        merge(other)
+            Combines the runs of two results
+        get_statistics()
+            Aggregate statistics over all runs
+        get_interval(statistic, node, confidence)
+            Confidence interval of one aggregate statistic
+    --------------
+
+    '''
+
+    def __init__(self, summaries, elapsed=0.):
+        if isinstance(summaries, list):
+            summaries = {name: np.stack([s[name] for s in summaries]) for name in summaries[0]}
+        self.summaries = summaries
+        self.n_runs = len(summaries['compromise_time'])
+        self.elapsed = elapsed
+        self.targets = None
+        self.converged = None
+
+    def merge(self, other):
+        ''' Returns a result holding the runs of both results '''
+        summaries = {name: np.concatenate([values, other.summaries[name]])
+                     for name, values in self.summaries.items()}
+        return MonteCarloResult(summaries, self.elapsed + other.elapsed)
+
+    def get_statistics(self):
+        ''' Aggregates the run summaries into per-node statistics, see
+        evaluation.aggregate
+
+        --------------
+        Returns
+        --------------
+            statistics: dict
+                (name, (num_nodes,) array) pairs
+
+        '''
+        return aggregate(self.summaries)
+
+    def get_interval(self, statistic, node=None, confidence=0.95):
+        ''' Confidence interval of a statistic over the runs, see
+        evaluation.confidence_interval
+
+        --------------
+        Parameters
+        --------------
+            statistic: str
+                Name of a statistic of get_statistics, e.g.
+                'fuzzy_false_positive_rate'
+            node: int or None
+                Index of the node, or None to pool over all nodes
+            confidence: float
+        --------------
+        Returns
+        --------------
+            interval: dict
+                'estimate', 'low', 'high', 'width' and 'runs'
+
+        '''
+        return confidence_interval(self.summaries, statistic, node, confidence)
+
+
+class MonteCarlo:
+    '''
+    Runs many independent simulations of the same scenario across a pool
+    of worker processes. Every run gets its own seed spawned from the
+    experiment seed, and workers only send back the compact summary of
+    each run.
+
+    --------------
+    Attributes
+    --------------
+        scenario: dict
+            Scenario that is simulated, see default_scenario
+        seed_seq: numpy.random.SeedSequence
+            Experiment seed the run seeds are spawned from
+        max_workers: int
+            Number of worker processes. 1 runs everything in this process
+
+    --------------
+    Methods
+    --------------
+        run(n_runs)
+            Runs n_runs more simulations and returns their result
+        run_until(targets, max_runs)
+            Runs simulations until confidence intervals are narrow enough
+    --------------
+
+    '''
+
+    def __init__(self, scenario=None, seed=None, max_workers=None):
+        self.scenario = get_scenario(scenario)
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.max_workers = max_workers or os.cpu_count()
+
+    def run(self, n_runs):
+        ''' Runs simulations of the scenario. Each call spawns new seeds, so
+        repeated calls keep adding independent runs.
+
+        --------------
+        Parameters
+        --------------
+            n_runs: int
+                Number of simulations to run
+        --------------
+        Returns
+        --------------
+            result: MonteCarloResult
+
+        '''
+        seeds = self.seed_seq.spawn(n_runs)
+        start = time.perf_counter()
+        if self.max_workers == 1:
+            summaries = [run_scenario(self.scenario, seed) for seed in seeds]
+        else:
+            # Several runs per task so the pool overhead stays small
+            chunksize = max(1, n_runs // (4 * self.max_workers))
+            with ProcessPoolExecutor(self.max_workers) as pool:
+                summaries = list(pool.map(run_scenario, repeat(self.scenario), seeds, chunksize=chunksize))
+        return MonteCarloResult(summaries, time.perf_counter() - start)
+
+    def run_until(self, targets, max_runs=1000, min_runs=10, batch_size=None, confidence=0.95):
+        ''' Sequential sampling: runs simulations in batches until the
+        confidence interval of every target statistic is no wider than its
+        target width, or max_runs have been run. After each batch the
+        number of runs still needed is projected from the widest interval
+        (widths shrink with the square root of the runs), so noisy
+        statistics get larger batches and converged ones stop early.
+        Batches never more than double the runs so far.
+
+        --------------
+        Parameters
+        --------------
+            targets: list, dict
+                'statistic' (a name of MonteCarloResult.get_statistics),
+                'width' (largest interval width) and optionally 'node'
+                (index, or None to pool over all nodes), e.g.
+                {'statistic': 'fuzzy_false_positive_rate', 'width': 0.01}
+                or {'statistic': 'mean_time_to_compromise', 'node': 8,
+                'width': 5}
+            max_runs: int
+                Budget of runs
+            min_runs: int
+                Runs of the first batch, before any interval is trusted
+            batch_size: int
+                Smallest batch after the first, by default one run per
+                worker
+            confidence: float
+                Coverage of the intervals
+        --------------
+        Returns
+        --------------
+            result: MonteCarloResult
+                All runs, with n_runs the number used, targets holding the
+                final interval of each target and converged whether every
+                target was met within the budget
+
+        '''
+        if min(min_runs, max_runs) < 1:
+            raise ValueError(f'min_runs and max_runs must be at least 1, got {min_runs} and {max_runs}')
+        targets = [dict(target, node=target.get('node')) for target in targets]
+        batch_size = batch_size or self.max_workers
+        result = None
+        n_runs = min(min_runs, max_runs)
+        while n_runs > 0:
+            batch = self.run(n_runs)
+            result = batch if result is None else result.merge(batch)
+
+            ratios = []
+            for target in targets:
+                interval = result.get_interval(target['statistic'], target['node'], confidence)
+                target.update(interval=interval, met=interval['width'] <= target['width'])
+                ratios.append(interval['width'] / target['width'])
+            if all(target['met'] for target in targets):
+                break
+            # Runs the widest interval needs, at least batch_size more and
+            # at most doubling the runs, as early intervals are rough
+            needed = result.n_runs * max(ratios) ** 2 if np.isfinite(max(ratios)) else 0
+            n_runs = min(max(int(np.ceil(needed)) - result.n_runs, batch_size), result.n_runs)
+            n_runs = min(n_runs, max_runs - result.n_runs)
+
+        result.targets = targets
+        result.converged = all(target['met'] for target in targets)
+        return result
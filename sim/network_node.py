@@ -1,30 +1,25 @@
 import numpy as np
-import skfuzzy as fuzz
-from skfuzzy import control as ctrl
-import plotly.express as px
 
-import pandas as pd
+from .fuzzy_detector import get_fuzzy_detector
+from .sim_state import SimulationState
+from .detectors import basic_compromise_flags, fuzzy_category
+from .metric_generator import MetricGenerator, compromise_direction, metric_values
+
+def _column_property(column, doc):
+    # Recorded values of one state column for this node
+    return property(lambda self: self.state.get_column(column, self.index), doc=doc)
+
+
+def _current_property(column, doc):
+    # Value of one state column for this node in the latest row
+    return property(lambda self: self.state[column][self.state.rows - 1, self.index], doc=doc)
 
-metric_values = {'packet_rate_mu': 0.91, 
-                'packet_rate_std': 0.01,
-                'packet_rate_min': 0.05,
-                'packet_rate_max': 0.1,
-                'bandwidth_mu': 30,
-                'bandwidth_std': 3,
-                'bandwidth_min': 2,
-                'bandwidth_max': 7,
-                'response_time_mu': 130,
-                'response_time_std': 20,
-                'response_time_min': 100,
-                'response_time_max': 300}
 
 class NetworkNode:
     '''
     A class used to represent an individual node within the network.
-    
-    ****TODO**** 
-        Implement some way to store mu/stdev values for each of the
-        metric calculations
+    The node is a view onto one column of a SimulationState, which holds
+    the recorded metrics and flags of every node in the network.
     
     --------------
     Attributes
@@ -36,19 +31,33 @@ class NetworkNode:
         level: int 
             represents where node falls in network hierarchy
 
-        [*]_array: list
-            stores values at each time step of the simulation
+        state: SimulationState
+            store the node's values are recorded in. A node created on
+            its own gets a single-node store
+        index: int
+            column of the node in the store
+        metric_generator: MetricGenerator
+            holds the mu/stdev and compromise offsets of each metric for
+            every node in the network, and draws the metrics of all nodes
+            at once during a simulation
+
+        [*]_array: array
+            views of the values at each time step of the simulation
             - comproised_array: used for truthing
             - bandwidth, packet_rate, response_time: the metrics that
               underly the "wellness" calculations of the nodes
 
-        parent_nodes: list 
-            node's ancestor nodes
-        child_nodes 
-            node's children nodes
+        topology: Topology
+            structure of the network the node is part of, if any
+        parent_indices: array or list, int
+            indices of the node's parents
+        child_indices: array or list, int
+            indices of the node's children
+        fuzzy_detector: FuzzyDetector
+            shared fuzzy logic system used by fuzzy_compromise_check
 
-        cur_[*]: list 
-            tracks the current values for node metrics
+        cur_[*]: float
+            current values for node metrics
             
     --------------
     Methods
@@ -57,10 +66,16 @@ class NetworkNode:
         get_bandwidth(mu, stdev, min_munivorm, max_uniform)
         get_response_time(mu, stdev, min_munivorm, max_uniform)
             Determines the values of the network metric parameters
-            at the current simulation time step
+            at the current simulation time step, for a single node
+            
+        set_metric_values(**values)
+        get_metric_values()
+        initialize_metric_values()
+            Setters/getter for the node's mu/stdev and compromise
+            offset of each metric
         
         link_nodes(parent_node_list, child_node_list)
-            Establishes parents and children of node
+            Establishes parents and children of node, by index
             
         get_node_metrics(timesteps)
             Calls methods to set the metrics for the node based on
@@ -80,50 +95,137 @@ class NetworkNode:
         fuzzy_compromise_check()
             Uses fuzzy logic to calculate the likelihood that the
             node is compromsied
+        record_fuzzy_result(result)
+            Stores a fuzzy value calculated outside of the node
     --------------
     
     '''
     
-    def __init__(self, name):
+    # Networks can hold 10^5-10^6 nodes, so nodes have no __dict__ and
+    # refer to other nodes by index; history lives in the state
+    __slots__ = ('name', 'level', 'owns_state', 'state', 'index', 'metric_generator',
+                 'fuzzy_detector', 'topology', '_links')
+    
+    packet_rate_array = _column_property('packet_rate', 'Packet rate at each time step')
+    bandwidth_array = _column_property('bandwidth', 'Bandwidth at each time step')
+    response_time_array = _column_property('response_time', 'Response time at each time step')
+    flagged_malicious_array = _column_property('flagged_malicious', 'Basic check flag at each time step')
+    compromised_array = _column_property('compromised_truth', 'Compromise truth at each time step')
+    fuzzy_compromised_value_array = _column_property('fuzzy_compromised_value', 'Fuzzy value at each time step')
+    fuzzy_compromised_cat_array = _column_property('fuzzy_compromised_category', 'Fuzzy category at each time step')
+    
+    cur_packet_rate = _current_property('packet_rate', 'Current packet rate')
+    cur_bandwidth = _current_property('bandwidth', 'Current bandwidth')
+    cur_response_time = _current_property('response_time', 'Current response time')
+    flagged_malicious = _current_property('flagged_malicious', 'Current basic check flag')
+    
+    def __init__(self, name, fuzzy_detector=None, state=None, index=0, metric_generator=None):
         self.name = name
-        self.is_compromised = 0
-        self.flagged_malicious = 0
         self.level = 0
-        self.fuzzy_flagged_malicious = 0
         
-        self.packet_rate_array = []
-        self.bandwidth_array = []
-        self.response_time_array = []
-        self.flagged_malicious_array = [0]
-        self.compromised_array = [0]
-        self.fuzzy_compromised_value_array = [0]
-        self.fuzzy_compromised_cat_array = [0]
-        self.time_step_array = [-1]
-        
-        self.parent_nodes = []
-        self.child_nodes = []
-        
-        self.cur_packet_rate = self.get_packet_rate()
-        self.cur_bandwidth = self.get_bandwidth()
-        self.cur_response_time = self.get_response_time()
+        # A node created outside of a simulation records into its own store,
+        # otherwise the simulation draws the initial metrics for all nodes
+        self.owns_state = state is None
+        if self.owns_state:
+            state = SimulationState(1)
+            state.add_row(-1)
+            metric_generator = MetricGenerator(1)
+        self.state = state
+        self.index = index
+        self.metric_generator = metric_generator
+        
+        # Parents and children come from the topology once the node is
+        # part of one, otherwise from link_nodes
+        self.topology = None
+        self._links = None
+        
+        if self.owns_state:
+            self.get_packet_rate()
+            self.get_bandwidth()
+            self.get_response_time()
+        
+        if fuzzy_detector is None:
+            fuzzy_detector = get_fuzzy_detector()
+        self.fuzzy_detector = fuzzy_detector
+        
+    @property
+    def is_compromised(self):
+        return int(self.state.is_compromised[self.index])
+    
+    @is_compromised.setter
+    def is_compromised(self, value):
+        self.state.is_compromised[self.index] = value
         
-        self.node_dict = {}
+    @property
+    def security_threshold(self):
+        return float(self.state.security_threshold[self.index])
+    
+    @security_threshold.setter
+    def security_threshold(self, value):
+        self.state.security_threshold[self.index] = value
         
-        self.security_threshold= 0.97
+    @property
+    def fuzzy_flagged_malicious(self):
+        return int(self.state.fuzzy_flagged_malicious[self.index])
+    
+    @property
+    def time_step_array(self):
+        return self.state.get_times()
+    
+    @property
+    def parent_indices(self):
+        if self.topology is not None:
+            return self.topology.get_parents(self.index)
+        return self._links[0] if self._links is not None else []
+    
+    @property
+    def child_indices(self):
+        if self.topology is not None:
+            return self.topology.get_children(self.index)
+        return self._links[1] if self._links is not None else []
 
     def get_node_name(self):
         return self.name
         
     def initialize_metric_values(self):
-        pass
+        ''' Resets the node's metric values to the defaults in metric_values
+        
+        '''
+        self.set_metric_values(**metric_values)
+        
+    def set_metric_values(self, **values):
+        ''' Sets the mu/stdev and compromise offset limits used for the
+        node's metrics
+        
+        --------------
+        Parameters
+        --------------
+            values: float
+                Any of the keys of metric_values, e.g. bandwidth_mu=25
+        
+        '''
+        self.metric_generator.set_node_params(self.index, **values)
+        
+    def get_metric_values(self):
+        ''' Getter function for the node's metric values
+        
+        --------------
+        Returns
+        --------------
+            values: dict
+                Metric values, with the same keys as metric_values
+        
+        '''
+        return self.metric_generator.get_node_params(self.index)
     
     def get_security_threshold(self):
         return self.security_threshold
 
         
-    def get_packet_rate(self, mu=0.91, stdev=0.01, min_uniform=0.05, max_uniform=0.1):
+    def get_packet_rate(self, mu=None, stdev=None, min_uniform=None, max_uniform=None):
         ''' Gets the current packet rate of the node. Packet rate is determined
-        based on whether or not the node is compromised
+        based on whether or not the node is compromised. Parameters that
+        are not given use the node's metric values.
         
         --------------
         Parameters
@@ -147,21 +249,14 @@ class NetworkNode:
                 Packet rate of node at time in simulation 
         
         '''
-        # Under normal operation, 
-        if self.is_compromised ==0:
-            packet_rate = np.random.normal(mu, stdev)
-        else:
-            packet_rate = np.random.normal(mu,stdev) - np.random.uniform(min_uniform, max_uniform)
-        self.packet_rate_array.append(packet_rate)
+        packet_rate = self._draw_metric('packet_rate', mu, stdev, min_uniform, max_uniform)
+        self._record('packet_rate', packet_rate)
         return packet_rate
     
-    def get_bandwidth(self, mu=30, stdev=3, min_uniform=2, max_uniform=7):
-        ''' Gets the current bandwidth of the node. Bandwidthis determined
+    def get_bandwidth(self, mu=None, stdev=None, min_uniform=None, max_uniform=None):
+        ''' Gets the current bandwidth of the node. Bandwidth is determined
         based on whether or not the node is compromised
-        
-        *****TODO*****
-            Store mu, stdev values for metric
-        
+
         --------------
         Parameters
         --------------
@@ -184,20 +279,15 @@ class NetworkNode:
                 Bandwidth of node at time in simulation 
         
         '''
-        if self.is_compromised == 0:
-            bandwidth = np.random.normal(mu, stdev)
-        else:
-            bandwidth = np.random.normal(mu, stdev) - np.random.uniform(min_uniform, max_uniform)
-        self.bandwidth_array.append(bandwidth)
+        bandwidth = self._draw_metric('bandwidth', mu, stdev, min_uniform, max_uniform)
+        self._record('bandwidth', bandwidth)
         return bandwidth
     
-    def get_response_time(self, mu=130, stdev=20, min_uniform=100, max_uniform=300):
-        ''' Gets the current response timeof the node. Response time isdetermined
-        based on whether or not the node is compromised
-        
-        *****TODO*****
-            Store mu, stdev values for metric
-        
+    def get_response_time(self, mu=None, stdev=None, min_uniform=None, max_uniform=None):
+        ''' Gets the current response time of the node. Response time is determined
+        based on whether or not the node is compromised. Parameters that
+        are not given use the node's metric values.
+
         --------------
         Parameters
         --------------
@@ -216,19 +306,31 @@ class NetworkNode:
         --------------
         Returns
         --------------
-            - bandwidth: float
-                Bandwidth of node at time in simulation 
+            - response_time: float
+                Response time of node at time in simulation 
         
         '''
-        if self.is_compromised == 0:
-            response_time = np.random.normal(mu, stdev)
-        else:
-            response_time = np.random.normal(mu, stdev) + np.random.uniform(min_uniform, max_uniform)
-        self.response_time_array.append(response_time)
+        response_time = self._draw_metric('response_time', mu, stdev, min_uniform, max_uniform)
+        self._record('response_time', response_time)
         return response_time
         
+    def _draw_metric(self, metric, mu, stdev, min_uniform, max_uniform):
+        # Scalar draw of one metric, filling in the node's metric values
+        values = self.get_metric_values()
+        mu = values[f'{metric}_mu'] if mu is None else mu
+        stdev = values[f'{metric}_std'] if stdev is None else stdev
+        min_uniform = values[f'{metric}_min'] if min_uniform is None else min_uniform
+        max_uniform = values[f'{metric}_max'] if max_uniform is None else max_uniform
+        
+        # Under normal operation, 
+        value = np.random.normal(mu, stdev)
+        if self.is_compromised != 0:
+            value += compromise_direction[metric] * np.random.uniform(min_uniform, max_uniform)
+        return value
+        
     def link_nodes(self, parent_node_list, child_node_list):
-        ''' Establishes nodes relationships to other nodes in network
+        ''' Establishes nodes relationships to other nodes in network. Only
+        the indices of the nodes are kept.
         
         --------------
         Parameters
@@ -239,10 +341,10 @@ class NetworkNode:
                 Children of the node
         
         '''
-        for node in parent_node_list:
-            self.parent_nodes.append(node)
-        for node in child_node_list:
-            self.child_nodes.append(node)
+        if self._links is None:
+            self._links = ([], [])
+        self._links[0].extend(node.index for node in parent_node_list)
+        self._links[1].extend(node.index for node in child_node_list)
             
     def get_node_metrics(self, timestep):
         ''' Calls each of the functions that determine the node's current
@@ -258,10 +360,10 @@ class NetworkNode:
                 Current timestep of the simulation
                 
         '''
-        self.time_step_array.append(timestep)
-        self.cur_packet_rate = self.get_packet_rate()
-        self.cur_bandwidth = self.get_bandwidth()
-        self.cur_response_time = self.get_response_time()
+        self.add_timestep(timestep)
+        self.get_packet_rate()
+        self.get_bandwidth()
+        self.get_response_time()
 
     def set_node_level(self, level):
         ''' Sets the "level" of the node, which represents where the node
@@ -289,7 +391,8 @@ class NetworkNode:
         return self.level
     
     def add_timestep(self, t):
-        ''' Adds timestep to array for node
+        ''' Adds timestep to array for node. Only a node with its own
+        store adds rows; nodes in a simulation share the simulation's rows.
         
         --------------
         Parameters
@@ -298,14 +401,19 @@ class NetworkNode:
             Timestep of simulation
         
         '''
-        self.time_step_array.append(t)
+        if self.owns_state:
+            self.state.add_row(t)
+            
+    def _record(self, column, value):
+        # Stores a value for the node in the latest row of the store
+        self.state[column][self.state.rows - 1, self.index] = value
         
     def truth_compromise_check(self):
         ''' Used to store values as to whether or not the
         node is truly compromised. 
         
         '''
-        self.compromised_array.append(self.is_compromised)
+        self._record('compromised_truth', self.is_compromised)
         
     def basic_compromise_check(self):
         ''' Basic compromise check of whether or not the node is
@@ -325,71 +433,35 @@ class NetworkNode:
             Timestep of simulation
         
         '''
-        self.flagged_malicious = 0
-        if (self.cur_response_time > 130) & (self.cur_bandwidth < 32):
-            if self.cur_packet_rate < 0.905:
-                self.flagged_malicious = 1
-
-            
-        if (self.cur_response_time > 130) & (self.cur_packet_rate < 0.91):
-            if self.cur_bandwidth < 27:
-                self.flagged_malicious = 1
-                
-        self.flagged_malicious_array.append(self.flagged_malicious)
+        flagged_malicious = basic_compromise_flags(self.cur_packet_rate,
+                                                   self.cur_bandwidth,
+                                                   self.cur_response_time)
+        self._record('flagged_malicious', flagged_malicious)
         
     def fuzzy_compromise_check(self):
         '''
-        Sets up fuzzy logic system. Implements antecedents and consequent,
-        establishes universe, calculates fuzzy logic output for 
-        whether or note node is compromised. 
-        
-       *****TODO*****
-            - remove hard-coded values for Antecedents, and base values
-            off of the mu, stdev for each of the metrics
-            - clean this up, potentially move this to another location
+        Calculates fuzzy logic output for whether or not the node is
+        compromised, using the node's shared fuzzy detector. The fuzzy
+        logic system itself is only built once per parameter set.
         '''
-        prev_flag = self.fuzzy_flagged_malicious
-        
-
-        response_time = ctrl.Antecedent(np.arange(0,600,10), 'response_time')
-        packet_rate = ctrl.Antecedent(np.arange(0.83,0.93,0.005), 'packet_rate')
-        bandwidth = ctrl.Antecedent(np.arange(5,35,1), 'bandwidth')
-
-        compromised = ctrl.Consequent(np.arange(0,11), 'compromised')
-
-        response_time.automf(3)
-        packet_rate.automf(3)
-        bandwidth.automf(3)
-
-        compromised['green'] = fuzz.trimf(compromised.universe, [0,0,4])
-        compromised['yellow'] = fuzz.trimf(compromised.universe, [2,8,11])
-        compromised['red'] = fuzz.trimf(compromised.universe, [7,11,11])
-
-        rule2 = ctrl.Rule(response_time['poor'] | packet_rate['poor'] | bandwidth['poor'], compromised['red'])
-        rule3 = ctrl.Rule(packet_rate['average'] & response_time['average'], compromised['yellow'])
-        rule4 = ctrl.Rule(packet_rate['average'] & bandwidth['average'], compromised['yellow'])
-        rule5 = ctrl.Rule(response_time['good'] & bandwidth['good'], compromised['green'])
-        rule6 = ctrl.Rule(response_time['good'] & packet_rate['good'], compromised['green'])
-
-        compromised_ctrl = ctrl.ControlSystem([rule2, rule3, rule4, rule5, rule6])
-
-        compromised_sim = ctrl.ControlSystemSimulation(compromised_ctrl)
-        
-        p = self.cur_packet_rate
-        b = self.cur_bandwidth
-        r = 600 - self.cur_response_time
-
-        compromised_sim.input['packet_rate'] = p
-        compromised_sim.input['bandwidth'] = b
-        compromised_sim.input['response_time'] = r
+        result = self.fuzzy_detector.compute(self.cur_packet_rate,
+                                             self.cur_bandwidth,
+                                             self.cur_response_time)
+        self.record_fuzzy_result(result)
         
-        compromised_sim.compute()
-
-        result = compromised_sim.output['compromised']
-        self.fuzzy_compromised_value_array.append(result)
+    def record_fuzzy_result(self, result):
+        ''' Stores a fuzzy compromised value for the node and updates the
+        fuzzy category. Used directly when the value has been calculated
+        for many nodes at once.
         
-        # Call function to determine the category for the compromised result 
-        # self.calculate_fuzzy_category(float(result))
+        --------------
+        Parameters
+        --------------
+            result: float
+                Resulting value from fuzzy compromised logic
+        '''
+        # Call function to determine the category for the compromised result,
+        # which stores the value and category together
         self.calculate_fuzzy_category(result)
         
     def calculate_fuzzy_category(self, result):
@@ -404,18 +476,5 @@ class NetworkNode:
             result: float
                 Resulting value from fuzzy compromised logic
         '''
-        category = 0
-        prev_flag = self.fuzzy_flagged_malicious
-        
-        if result <= 5:
-            category = 0
-        elif (result >5) & (result <6) & (prev_flag == 1):
-            category = 1
-        elif (result >5) & (result <6) & (prev_flag == 0):
-            category = 0
-        else:
-            category = 1
-            
-        self.fuzzy_flagged_malicious = category
-        self.fuzzy_compromised_cat_array.append(category)
-            
+        category = fuzzy_category(result, self.fuzzy_flagged_malicious)
+        self.state.record_fuzzy(result, category, self.index)
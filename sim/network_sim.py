@@ -1,18 +1,28 @@
 import numpy as np
-import skfuzzy as fuzz
-from skfuzzy import control as ctrl
-import plotly.express as px
 
-from network_node import NetworkNode
-from attacker import Attacker
-
-import pandas as pd
+from .network_node import NetworkNode
+from .attacker import Attacker
+from .fuzzy_detector import get_fuzzy_detector
+from .fuzzy_surface import get_fuzzy_surface
+from .sim_state import SimulationState
+from .detectors import basic_compromise_flags, fuzzy_category
+from .metric_generator import MetricGenerator
+from .propagation import PropagationEngine
+from .topology import from_nodes, v1_tree
+from .instrumentation import null_profiler
+from .baseline import MetricBaseline
+from .rule_compiler import compile_rules
+from .fuzzy_memo import MemoizedFuzzyDetector
 
 
 class Simulation:
     '''
     
-    ****TODO**** 
+    Network of nodes under attack. Each timestep the attacks spread along
+    the network's topology, the metrics of every node are drawn, and the
+    basic and fuzzy compromise checks flag the nodes that look compromised.
+    The metrics, flags and compromise truth of every node are recorded for
+    evaluation.
     
     --------------
     Attributes
@@ -21,20 +31,128 @@ class Simulation:
             Simulation name
         node_list: list, NetworkNode objects
             Stores individual nodes contained in network
+        state: SimulationState
+            Preallocated arrays holding the recorded metrics, flags and
+            truth of every node; each node is a view onto one column
+        fuzzy_detector: FuzzyDetector
+            Fuzzy logic system shared by all nodes in the network
+        fuzzy_mode: str
+            'exact' runs the scikit-fuzzy system node by node, 'batch'
+            runs the vectorized NumPy engine for every node at once and
+            'surface' interpolates a precomputed output surface. The
+            surface is built the first time a parameter set is used and
+            cached on disk; building the default grid takes about 25 s
+        fuzzy_engine: FuzzyDetector, FuzzySurface or CompiledDetector
+            Object used for the vectorized fuzzy check
+        rule_detector: CompiledDetector or None
+            Detectors compiled from a rule file, used for both checks
+            when the simulation is given detector_rules
+        fuzzy_memo: MemoizedFuzzyDetector or None
+            Cache of fuzzy results for rounded inputs, in front of the
+            exact detector or the batch engine when memo_options are
+            given. Trades exactness for speed, see
+            fuzzy_memo.quantization_levels
+        seed: int, numpy.random.SeedSequence or None
+            Seed for the simulation's random streams. Runs with the same
+            seed are reproducible
+        metric_generator: MetricGenerator
+            Draws the metrics of all nodes at each timestep
+        block_size: int or None
+            Timesteps of metric noise drawn at once, by default scaled
+            with the number of nodes (see metric_generator.get_block_size).
+            Doesn't change the metrics drawn, only memory use
+        topology: Topology
+            Network structure as CSR index arrays, shared by attack
+            propagation and node levels. If none is set, it is built from
+            the nodes' links when the simulation first runs
+        attacker_list: list, Attacker objects
+            Attackers added to the network before or during the simulation
+        propagation: PropagationEngine
+            Tracks the attacks that are running and schedules when they
+            succeed. Created when the simulation first runs
+        attack_rng: numpy.random.Generator
+            Generator used for the attacks' times to compromise
+        verbose: bool
+            Print attack propagation while the simulation runs
+        profiler: Profiler
+            Records the time spent in each stage of every timestep.
+            Instrumentation is off when no profiler is given
+        baseline_options: dict or None
+            Options of MetricBaseline. When set, every node keeps running
+            baselines of its metrics and both checks take their cutoffs
+            from them instead of the fixed values
+        baseline: MetricBaseline
+            Running baselines, created when the simulation first runs
+            from the nodes' metric values at that point
             
     --------------
     Methods
     --------------
         run_simulation(t)
             Runs simulation for a given number of time steps
+        set_topology(topology)
+            Sets the network structure
+        get_node_metrics()
+            Draws the metrics of all nodes for the latest state row
+        basic_compromise_check()
+            Runs the basic check for all nodes on the latest state row
+        get_basic_check()
+            Function the basic check runs, built in or from a rule file
+        batch_fuzzy_compromise_check()
+            Runs the fuzzy check for all nodes in one vectorized call
+        update_baseline()
+            Adds the current metrics of healthy nodes to the baselines
         
     
     '''
     
-    def __init__(self, name):
+    def __init__(self, name, fuzzy_mode='exact', fuzzy_params=None, surface_options=None, seed=None, verbose=True,
+                 profiler=None, baseline_options=None, detector_rules=None, memo_options=None, block_size=None):
         self.name = name
         self.node_list = []
         self.attacker_list = []
+        self.state = None
+        self.topology = None
+        self.propagation = None
+        
+        self.seed = seed
+        self.verbose = verbose
+        self.profiler = profiler if profiler is not None else null_profiler
+        self.baseline_options = baseline_options
+        self.baseline = None
+        seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self._metric_seed, attack_seed = seed_seq.spawn(2)
+        self.metric_generator = None
+        self.block_size = block_size
+        self.attack_rng = np.random.default_rng(attack_seed)
+        
+        if fuzzy_mode not in ('exact', 'batch', 'surface'):
+            raise ValueError(f'Unknown fuzzy mode: {fuzzy_mode}')
+        self.fuzzy_mode = fuzzy_mode
+        self.fuzzy_detector = get_fuzzy_detector(fuzzy_params)
+        self.fuzzy_engine = self.fuzzy_detector
+        if fuzzy_mode == 'surface':
+            self.fuzzy_engine = get_fuzzy_surface(fuzzy_params, **(surface_options or {}))
+            
+        # Rule files are compiled into vectorized kernels, so they replace
+        # the batch engine and the basic check
+        self.rule_detector = None
+        if detector_rules is not None:
+            if fuzzy_mode != 'batch':
+                raise ValueError('Detector rule files run in batch mode')
+            self.rule_detector = compile_rules(detector_rules)
+            self.fuzzy_engine = self.rule_detector
+            
+        self.fuzzy_memo = None
+        if memo_options is not None:
+            if fuzzy_mode == 'surface':
+                raise ValueError('The fuzzy surface is already a lookup table and is not memoized')
+            if fuzzy_mode == 'exact':
+                self.fuzzy_memo = MemoizedFuzzyDetector(self.fuzzy_detector, **memo_options)
+                self.fuzzy_detector = self.fuzzy_memo
+            else:
+                self.fuzzy_memo = MemoizedFuzzyDetector(self.fuzzy_engine, **memo_options)
+                self.fuzzy_engine = self.fuzzy_memo
         
     def establish_nodes(self, num_nodes):
         ''' Creates a specified number of nodes to be included in network
@@ -45,90 +163,235 @@ class Simulation:
             num_nodes: int
                 Number of nodes to be created for network
         
-        --------------
-        Returns
-        --------------
-            node_dict: dict
-                Dictionary containing (key, value) pairs, where 
-                pairs are (node_[i], NetworkNode)
-        
         '''
-        node_dict = {}
+        self.state = SimulationState(num_nodes)
+        self.metric_generator = MetricGenerator(num_nodes, self._metric_seed, self.block_size)
+        
         for i in range(0,num_nodes):
-            node_name = f'node_{i}'
-            node = NetworkNode(node_name)
+            node = NetworkNode(f'node_{i}', self.fuzzy_detector, self.state, i, self.metric_generator)
             self.node_list.append(node)
-            node_dict[node_name] = i
-        self.node_dict = node_dict
+        
+        # Initial metrics of the nodes, before the simulation starts
+        self.state.add_row(-1)
+        self.get_node_metrics()
+        
+    def get_node_metrics(self):
+        ''' Draws the metrics of every node for the latest row of the
+        simulation state, applying compromise offsets to the nodes that
+        are compromised.
+        
+        '''
+        metrics = self.metric_generator.draw(1, self.state.is_compromised)
+        for name, values in metrics.items():
+            self.state.get_current(name)[:] = values[0]
     
     def add_attacker(self, attacker):
+        ''' Adds an attacker to the network. Its attack on the target node
+        starts at the next timestep that is run.
+        
+        --------------
+        Parameters
+        --------------
+            attacker: Attacker
+                Attacker with the index of its target node
+        
+        '''
         self.attacker_list.append(attacker)
+        if self.propagation is not None:
+            self.propagation.add_attack(attacker.get_target_node())
+            
+    def get_propagation_engine(self):
+        ''' Creates the propagation engine from the node links the first
+        time the simulation runs, starting the attacks of the attackers
+        that have been added.
+        
+        --------------
+        Returns
+        --------------
+            propagation: PropagationEngine
+        
+        '''
+        if self.propagation is None:
+            if self.topology is None:
+                self.topology = from_nodes(self.node_list)
+            self.propagation = PropagationEngine(self.topology, self.state.security_threshold,
+                                                 self.state.is_compromised, self.attack_rng)
+            self.propagation.timestep = self.state.get_next_timestep()
+            for attacker in self.attacker_list:
+                self.propagation.add_attack(attacker.get_target_node())
+        return self.propagation
+    
+    def get_baseline(self):
+        ''' Creates the metric baselines the first time the simulation
+        runs, if baseline_options are set, starting from the mu and std
+        each node's metrics are drawn with.
         
+        --------------
+        Returns
+        --------------
+            baseline: MetricBaseline or None
         
-    def run_simulation(self, t):
+        '''
+        if self.baseline is None and self.baseline_options is not None:
+            self.baseline = MetricBaseline(len(self.node_list), prior=self.metric_generator.params,
+                                           **self.baseline_options)
+        return self.baseline
+        
+        
+    def run_simulation(self, t, sink=None, checkpointer=None):
         ''' Steps through the simulation for a specified number of time steps.
         Each step is meant to represent one second of time, and network checks
-        are completed at every iteration. 
+        are completed at every iteration. Time continues from the end of
+        any earlier run.
+        
+        With a sink, results are streamed to disk every sink.chunk_rows
+        steps instead of being kept in memory, so memory use stays flat
+        however long the simulation runs.
+        
+        With a checkpointer, a checkpoint is written every
+        checkpointer.every timesteps and at the end of the run. To resume
+        an interrupted run, build the simulation the same way, call
+        checkpointer.restore and run the remaining timesteps.
         
         --------------
         Parameters
         --------------
             t: int
                 Number of timesteps to run the simulation 
+            sink: ColumnarSink
+                Store to stream results into
+            checkpointer: Checkpointer
+                Writes checkpoints the run can be resumed from
         
         --------------
         Returns
         --------------
-            sim_results: dict
+            sim_results: dict or ResultReader
                 Dictionary object containing the results of the simulation, 
                 including the results of compromised node checks at each step,
-                along with metrics recorded at each time step.
+                along with metrics recorded at each time step. When streaming,
+                a lazy reader of the sink with the same layout.
         
         '''
-        for timestep in range(0, t):
-            for a in self.attacker_list:    
-                target_node_ind = a.get_target_node()
-                threshold = self.node_list[target_node_ind].get_security_threshold()
-                success = a.attempt_attack(threshold)
-                
-                if success:
-                    prev_status = self.node_list[target_node_ind].is_compromised
-                    self.node_list[target_node_ind].is_compromised = 1
-                    n = self.node_list[target_node_ind]
-                    if len(n.child_nodes) > 0 and prev_status==0:
-                        for c in n.child_nodes:
-                            # Get the index of the child node
-                            c_node_name = c.get_node_name() 
-                            c_ind = int(c_node_name.strip('node_'))
-
-                            # Add attacker to attacker list
-                            print(f'{n.name} is compromised, adding attacker to {c_node_name}') 
-                            print(f'Number of attackers: {len(self.attacker_list)}')
-                            attacker = Attacker(f'attacker_{c_ind}', c_ind)
-                            self.add_attacker(attacker)
-                    
+        if sink is None:
+            self.state.reserve(self.state.rows + t)
+        else:
+            self.state.reserve(sink.chunk_rows)
+        propagation = self.get_propagation_engine()
+        baseline = self.get_baseline()
+        profiler = self.profiler
+        stage = profiler.stage
+        start = self.state.get_next_timestep()
+        for timestep in range(start, start + t):
+            with stage('propagation'):
+                compromised = propagation.step(timestep)
+                for ind in compromised:
+                    children = self.topology.get_children(ind)
+                    if self.verbose and len(children) > 0:
+                        print(f'{self.node_list[ind].name} is compromised, attacking {[self.node_list[c].name for c in children]}')
+            profiler.count('compromised', len(compromised))
                     
+            with stage('metrics'):
+                self.state.add_row(timestep)
+                self.get_node_metrics()
+            with stage('truth'):
+                self.state.record_truth()
+            with stage('basic_check'):
+                self.basic_compromise_check()
+            
+            with stage('fuzzy_check'):
+                if self.fuzzy_mode == 'exact' and baseline is None:
+                    for n in self.node_list:
+                        n.fuzzy_compromise_check()
+                elif self.fuzzy_mode == 'exact':
+                    for n, inputs in zip(self.node_list, zip(*self.get_fuzzy_inputs())):
+                        n.record_fuzzy_result(self.fuzzy_detector.compute(*inputs))
+                else:
+                    self.batch_fuzzy_compromise_check()
+            profiler.count('fuzzy_evaluations', len(self.node_list))
+            
+            if baseline is not None:
+                with stage('baseline'):
+                    self.update_baseline()
                 
-            for n in self.node_list:
-                n.get_node_metrics(timestep)
-                n.truth_compromise_check()
-                n.basic_compromise_check()
-                n.fuzzy_compromise_check()
+            if sink is not None and self.state.rows == self.state.get_capacity():
+                with stage('flush'):
+                    self.state.flush(sink)
+            profiler.end_step(timestep)
+            
+            if checkpointer is not None and checkpointer.is_due(timestep):
+                with stage('checkpoint'):
+                    checkpointer.write(self, sink)
+                profiler.end_step('checkpoint')
 
+        # Attackers added between runs start at the next timestep
+        propagation.timestep = self.state.get_next_timestep()
         
-        sim_results = {}
-        for n in self.node_list:
-            sim_results[n.name] = {'time': n.time_step_array,
-                                'packet_rate': n.packet_rate_array,
-                                   'bandwidth': n.bandwidth_array,
-                                   'response_time': n.response_time_array,
-                                   'flagged_malicious': n.flagged_malicious_array,
-                                   'fuzzy_compromised_value': n.fuzzy_compromised_value_array,
-                                   'fuzzy_compromised_category': n.fuzzy_compromised_cat_array,
-                                  'compromised_truth': n.compromised_array}
-        return sim_results
+        if sink is not None:
+            with stage('flush'):
+                self.state.flush(sink)
+            profiler.end_step('flush')
+        if checkpointer is not None:
+            checkpointer.write(self, sink)
+            
+        if sink is not None:
+            return sink.get_reader()
+        return self.state.to_results([n.name for n in self.node_list])
 
+    def basic_compromise_check(self):
+        ''' Runs the basic compromise check for every node in the network
+        at once, on the latest row of the simulation state.
+        
+        '''
+        state = self.state
+        thresholds = self.baseline.get_basic_thresholds() if self.baseline is not None else None
+        state.get_current('flagged_malicious')[:] = self.get_basic_check()(state.get_current('packet_rate'),
+                                                                           state.get_current('bandwidth'),
+                                                                           state.get_current('response_time'),
+                                                                           thresholds)
+        
+    def get_basic_check(self):
+        ''' Function running the basic check on arrays of metrics, with the
+        signature of detectors.basic_compromise_flags
+        '''
+        return self.rule_detector.flag if self.rule_detector is not None else basic_compromise_flags
+        
+    def get_fuzzy_inputs(self):
+        ''' Current metrics of every node as inputs to the fuzzy check,
+        mapped through the baselines when they are used.
+        
+        --------------
+        Returns
+        --------------
+            packet_rate, bandwidth, response_time: array, float
+        
+        '''
+        state = self.state
+        inputs = [state.get_current(name) for name in ('packet_rate', 'bandwidth', 'response_time')]
+        if self.baseline is not None:
+            inputs = [self.baseline.normalize(name, values)
+                      for name, values in zip(('packet_rate', 'bandwidth', 'response_time'), inputs)]
+        return inputs
+        
+    def update_baseline(self):
+        ''' Adds the current metrics of the nodes that neither check flags
+        to their baselines, so attacks are not learned as normal behavior.
+        
+        '''
+        state = self.state
+        healthy = (state.get_current('flagged_malicious') == 0) & (state.fuzzy_flagged_malicious == 0)
+        self.baseline.update({name: state.get_current(name) for name in ('packet_rate', 'bandwidth', 'response_time')},
+                             healthy)
+        
+    def batch_fuzzy_compromise_check(self):
+        ''' Runs the fuzzy compromise check for every node in the network
+        with a single call to the vectorized fuzzy engine (exact batch
+        inference or surface lookup), using the current metrics of each node.
         
+        '''
+        state = self.state
+        results = self.fuzzy_engine.compute_batch(*self.get_fuzzy_inputs())
+        state.record_fuzzy(results, fuzzy_category(results, state.fuzzy_flagged_malicious))
             
     def get_node(self, node_name):
         ''' Gets a node based off of the provided node name
@@ -175,30 +438,32 @@ class Simulation:
     def set_attacker(self, attacker):
         self.attacker = attacker
                 
+    def set_topology(self, topology):
+        ''' Sets the structure of the network. Node levels come from the
+        topology's breadth-first levels, and the nodes' parents and
+        children are looked up in the topology.
+        
+        --------------
+        Parameters
+        --------------
+            topology: Topology
+                Structure with one node per node in the network
+        
+        '''
+        if topology.num_nodes != len(self.node_list):
+            raise ValueError(f'Topology has {topology.num_nodes} nodes, network has {len(self.node_list)}')
+        if self.propagation is not None:
+            raise RuntimeError('The topology cannot be changed after the simulation has started')
+        self.topology = topology
+        
+        for n in self.node_list:
+            n.set_node_level(int(topology.level[n.index]))
+            n.topology = topology
+                
     def set_v1_structure(self):
-        '''Sets up the structure of the network. Currently not used, but may later
-        be implimented as a means of increasing the likelihood that a node gets attacked,
-        based on whether or not the node's parent is compromised
+        '''Sets up the structure of the network as the 9-node tree from
+        topology.v1_tree. A node's children are attacked once the node is
+        compromised.
         
         '''
-        self.node_list[0].set_node_level(0)
-        self.node_list[0].link_nodes([], [self.node_list[1], self.node_list[2]])
-
-        self.node_list[1].set_node_level(1)
-        self.node_list[1].link_nodes([self.node_list[0]], [self.node_list[3]])
-        self.node_list[2].set_node_level(1)
-        self.node_list[2].link_nodes([self.node_list[0]], [self.node_list[4],self.node_list[5]])
-
-        self.node_list[3].set_node_level(2)
-        self.node_list[3].link_nodes([self.node_list[1]], [self.node_list[6], self.node_list[7]])
-        self.node_list[4].set_node_level(2)
-        self.node_list[4].link_nodes([self.node_list[2]], [])
-        self.node_list[5].set_node_level(2)
-        self.node_list[5].link_nodes([self.node_list[2]], [self.node_list[8]])
-
-        self.node_list[6].set_node_level(3)
-        self.node_list[6].link_nodes([self.node_list[3]], [])
-        self.node_list[7].set_node_level(3)
-        self.node_list[7].link_nodes([self.node_list[3]], [])
-        self.node_list[8].set_node_level(3)
-        self.node_list[8].link_nodes([self.node_list[5]], [])
+        self.set_topology(v1_tree())
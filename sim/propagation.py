@@ -0,0 +1,113 @@
+import heapq
+
+import numpy as np
+
+
+class PropagationEngine:
+    '''
+    Event-driven model of attacks spreading through the network. An attack
+    on a node succeeds at each timestep with probability
+    1 - security_threshold, so instead of drawing every attempt the engine
+    samples the time until the attack succeeds from a geometric
+    distribution and schedules the compromise as an event. Only attacks on
+    nodes that are not yet compromised are kept, and the work done per
+    step is proportional to the number of compromises that happen.
+
+    As with stepwise attempts, an attack started at a timestep makes its
+    first attempt in that same timestep, and a node attacked from several
+    parents is compromised by whichever attack succeeds first.
+
+    --------------
+    Attributes
+    --------------
+        topology: Topology
+            Network structure; attacks spread from a node to its children
+        security_threshold: array, float
+            Per-node threshold an attack attempt must beat
+        is_compromised: array, int8
+            Compromise state of every node, updated in place
+        rng: numpy.random.Generator
+            Generator the times to compromise are drawn from
+        timestep: int
+            Timestep new attacks start at
+        active: dict
+            (target node index, scheduled compromise timestep) pairs for
+            the attacks that are still running
+
+    --------------
+    Methods
+    --------------
+        add_attack(target)
+            Starts an attack on a node at the current timestep
+        step(timestep)
+            Compromises the nodes whose attacks succeed by this timestep
+    --------------
+
+    '''
+
+    def __init__(self, topology, security_threshold, is_compromised, rng):
+        self.topology = topology
+        self.security_threshold = security_threshold
+        self.is_compromised = is_compromised
+        self.rng = rng
+        self.timestep = 0
+        self.active = {}
+        self._events = []
+
+    def add_attack(self, target):
+        ''' Starts an attack on a node. Attacks on nodes that are already
+        compromised are dropped, and a node that is already under attack
+        keeps whichever attack succeeds first.
+
+        --------------
+        Parameters
+        --------------
+            target: int
+                Index of the attacked node
+
+        '''
+        if self.is_compromised[target]:
+            return
+        success_probability = 1. - self.security_threshold[target]
+        if success_probability <= 0:
+            return
+        time = self.timestep + int(self.rng.geometric(min(success_probability, 1.))) - 1
+
+        if time < self.active.get(target, time + 1):
+            self.active[target] = time
+            heapq.heappush(self._events, (time, target))
+
+    def step(self, timestep):
+        ''' Runs the attacks for one timestep. A compromised node starts
+        attacks on its children straight away, which may succeed within
+        the same timestep.
+
+        --------------
+        Parameters
+        --------------
+            timestep: int
+                Current timestep of the simulation
+        --------------
+        Returns
+        --------------
+            compromised: list, int
+                Indices of the nodes compromised in this timestep
+
+        '''
+        self.timestep = timestep
+        compromised = []
+        events = self._events
+        while events and events[0][0] <= timestep:
+            time, target = heapq.heappop(events)
+            # Skip attacks that were superseded by an earlier one
+            if self.active.get(target) != time:
+                continue
+            del self.active[target]
+            if self.is_compromised[target]:
+                continue
+
+            self.is_compromised[target] = 1
+            compromised.append(target)
+            for child in self.topology.get_children(target):
+                self.add_attack(child)
+        return compromised
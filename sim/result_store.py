@@ -0,0 +1,175 @@
+from collections.abc import Mapping
+import json
+import os
+
+import numpy as np
+
+from .sim_state import state_columns
+
+
+class ColumnarSink:
+    '''
+    Append-only columnar store that simulation results are streamed into
+    while the simulation runs. The store is a directory holding one raw
+    binary file per column, laid out as (rows, nodes) in row order, and a
+    small meta.json with the node names, column types and row count.
+
+    --------------
+    Attributes
+    --------------
+        path: str
+            Directory of the store
+        node_names: list, str
+            Names of the nodes, in column order
+        chunk_rows: int
+            Number of rows the simulation keeps in memory between writes
+        rows: int
+            Number of rows written so far
+
+    --------------
+    Methods
+    --------------
+        append(time, columns)
+            Appends a chunk of rows to every column
+        truncate(rows)
+            Drops the rows after the first rows
+        get_reader()
+            Opens the store for lazy reading
+    --------------
+
+    '''
+
+    def __init__(self, path, node_names, chunk_rows=4096, resume=False):
+        self.path = path
+        self.node_names = list(node_names)
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+
+        # Resuming keeps the rows already in the store and appends after them
+        if resume:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta['node_names'] != self.node_names:
+                raise ValueError(f'{path} holds results of different nodes')
+            self.rows = meta['rows']
+            return
+
+        os.makedirs(path, exist_ok=True)
+        for name in ['time'] + list(state_columns):
+            open(os.path.join(path, f'{name}.bin'), 'wb').close()
+        self._write_meta()
+
+    def _write_meta(self):
+        # Replace meta.json in one step so a reader never sees it half written
+        meta = {'node_names': self.node_names,
+                'rows': self.rows,
+                'columns': {name: np.dtype(dtype).str for name, dtype in state_columns.items()}}
+        tmp_path = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.path, 'meta.json'))
+
+    def append(self, time, columns):
+        ''' Appends a chunk of rows to the end of every column file
+
+        --------------
+        Parameters
+        --------------
+            time: array, int
+                Simulation time of each row in the chunk
+            columns: dict
+                (column name, (rows, nodes) array) pairs for the chunk
+
+        '''
+        with open(os.path.join(self.path, 'time.bin'), 'ab') as f:
+            np.ascontiguousarray(time, dtype=np.int64).tofile(f)
+        for name, dtype in state_columns.items():
+            with open(os.path.join(self.path, f'{name}.bin'), 'ab') as f:
+                np.ascontiguousarray(columns[name], dtype=dtype).tofile(f)
+        self.rows += len(time)
+        self._write_meta()
+
+    def truncate(self, rows):
+        ''' Drops every row after the first rows, e.g. rows written after
+        the checkpoint a simulation is resumed from
+
+        --------------
+        Parameters
+        --------------
+            rows: int
+                Number of rows to keep
+
+        '''
+        if rows > self.rows:
+            raise ValueError(f'Store has {self.rows} rows, cannot keep {rows}')
+        num_nodes = len(self.node_names)
+        os.truncate(os.path.join(self.path, 'time.bin'), rows * np.dtype(np.int64).itemsize)
+        for name, dtype in state_columns.items():
+            os.truncate(os.path.join(self.path, f'{name}.bin'), rows * num_nodes * np.dtype(dtype).itemsize)
+        self.rows = rows
+        self._write_meta()
+
+    def get_reader(self):
+        return ResultReader(self.path)
+
+
+class ResultReader(Mapping):
+    '''
+    Lazy, read-only view of a columnar result store. It behaves like the
+    sim_results dictionary returned by run_simulation: indexing it with a
+    node name gives a dict of that node's columns. Columns are memory
+    mapped, so nothing is read from disk until the values are used.
+
+    --------------
+    Attributes
+    --------------
+        path: str
+            Directory of the store
+        node_names: list, str
+            Names of the nodes, in column order
+        rows: int
+            Number of rows in the store
+
+    --------------
+    Methods
+    --------------
+        get_times()
+            Simulation time of each row
+        get_column(name)
+            (rows, nodes) array of one column for all nodes
+    --------------
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.node_names = meta['node_names']
+        self.rows = meta['rows']
+        self._dtypes = {name: np.dtype(dtype) for name, dtype in meta['columns'].items()}
+        self._index = {name: i for i, name in enumerate(self.node_names)}
+
+    def _map(self, name, dtype, shape):
+        if self.rows == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, f'{name}.bin'), dtype=dtype, mode='r', shape=shape)
+
+    def get_times(self):
+        return self._map('time', np.int64, (self.rows,))
+
+    def get_column(self, name):
+        return self._map(name, self._dtypes[name], (self.rows, len(self.node_names)))
+
+    def __getitem__(self, node_name):
+        index = self._index[node_name]
+        node_results = {'time': self.get_times()}
+        for name in self._dtypes:
+            node_results[name] = self.get_column(name)[:, index]
+        return node_results
+
+    def __iter__(self):
+        return iter(self.node_names)
+
+    def __len__(self):
+        return len(self.node_names)
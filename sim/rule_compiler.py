@@ -0,0 +1,321 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .fuzzy_detector import _automf3, _defuzzify, _trimf
+from .metric_generator import metric_names
+
+# Rule files that can be referred to by name, e.g. 'default'
+rules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules')
+
+crisp_operators = ('<', '<=', '>', '>=')
+
+# Detectors that have already been compiled, keyed by their rule hash
+_compiled_cache = {}
+
+
+class CompiledDetector:
+    '''
+    Basic (crisp) and fuzzy compromise checks declared in a rule file and
+    compiled into NumPy kernels. A rule file is JSON with:
+
+        - inputs: for each metric the fuzzy rules use, its universe as
+          [start, stop, step], an optional 'invert' value the metric is
+          subtracted from (so that higher is better), and its terms,
+          either "automf3" (poor/average/good, as Antecedent.automf(3))
+          or {term: [a, b, c]} trimf breakpoints
+        - output: the universe and {term: [a, b, c]} trimf terms of the
+          compromised consequent
+        - rules: list of {"if": condition, "then": output term}. A
+          condition is [input, term], {"any": [conditions]} (max) or
+          {"all": [conditions]} (min)
+        - cutoffs: named cutoffs of the crisp check
+        - crisp: condition flagging a node, made of
+          [metric, operator, cutoff name or number], "any" and "all"
+
+    Input and term names must be Python identifiers.
+
+    Each part is turned into the source of one Python function of
+    straight-line array expressions, which is compiled once. The fuzzy
+    kernel computes only the memberships the rules use and hands the
+    firing strengths to the same centroid defuzzification as
+    FuzzyDetector.compute_batch, so the default rules give the same
+    results as FuzzyDetector and basic_compromise_flags.
+
+    --------------
+    Attributes
+    --------------
+        rules: dict
+            Rule file contents
+        key: str
+            Hash of the rules
+        tables: dict
+            (universe, {term: membership}) of every input and of the
+            'compromised' output
+        fuzzy_source, crisp_source: str
+            Generated source of the kernels
+
+    --------------
+    Methods
+    --------------
+        compute_batch(packet_rate, bandwidth, response_time)
+            Fuzzy compromised values for arrays of metrics
+        compute(packet_rate, bandwidth, response_time)
+            Fuzzy compromised value for one set of metrics
+        get_tables()
+            Universes and memberships, as FuzzyDetector.get_tables
+        flag(packet_rate, bandwidth, response_time, thresholds)
+            Crisp check for arrays of metrics
+    --------------
+
+    '''
+
+    def __init__(self, rules):
+        check_names(rules)
+        self.rules = rules
+        self.key = rules_key(rules)
+        self.tables = _build_tables(rules)
+        self.fuzzy_source, fuzzy_namespace = _fuzzy_source(rules, self.tables)
+        self.crisp_source = _crisp_source(rules)
+        self._fuzzy_kernel = _compile(self.fuzzy_source, 'fuzzy_kernel', fuzzy_namespace, self.key)
+        self._crisp_kernel = _compile(self.crisp_source, 'crisp_kernel', {}, self.key)
+
+    def __reduce__(self):
+        # Generated functions can't be pickled, so worker processes compile
+        # the rules again
+        return compile_rules, (self.rules,)
+
+    def compute_batch(self, packet_rate, bandwidth, response_time, chunk_size=65536):
+        ''' Calculates the fuzzy compromised values for arrays of metrics
+
+        --------------
+        Parameters
+        --------------
+            packet_rate, bandwidth, response_time: array
+                Metrics, all of the same shape
+            chunk_size: int
+                Number of values evaluated together
+        --------------
+        Returns
+        --------------
+            result: array
+                Defuzzified compromised values, same shape as the inputs.
+                NaN where no rule fires
+
+        '''
+        inputs = [np.asarray(values, dtype=float) for values in (packet_rate, bandwidth, response_time)]
+        shape = inputs[0].shape
+        inputs = [values.ravel() for values in inputs]
+        result = np.empty(inputs[0].size)
+        output = self.tables['compromised']
+        for start in range(0, result.size, chunk_size):
+            chunk = [values[start:start + chunk_size] for values in inputs]
+            result[start:start + chunk_size] = _defuzzify(output, self._fuzzy_kernel(*chunk))
+        return result.reshape(shape)
+
+    def get_tables(self):
+        return self.tables
+
+    def compute(self, packet_rate, bandwidth, response_time):
+        return float(self.compute_batch([packet_rate], [bandwidth], [response_time])[0])
+
+    def flag(self, packet_rate, bandwidth, response_time, thresholds=None):
+        ''' Crisp compromise check, like detectors.basic_compromise_flags
+
+        --------------
+        Parameters
+        --------------
+            packet_rate, bandwidth, response_time: float or array
+                Metrics of the node(s)
+            thresholds: dict
+                Values overriding the rule file's cutoffs, either single
+                values or one per node, e.g. from
+                MetricBaseline.get_basic_thresholds
+        --------------
+        Returns
+        --------------
+            flagged_malicious: int or array, int8
+
+        '''
+        cutoffs = dict(self.rules.get('cutoffs', {}))
+        if thresholds is not None:
+            cutoffs.update(thresholds)
+        return self._crisp_kernel(packet_rate, bandwidth, response_time, cutoffs)
+
+
+def load_rules(rules=None):
+    ''' Reads a rule file
+
+    --------------
+    Parameters
+    --------------
+        rules: str, dict or None
+            Name of a file in rules_dir (without .json), path of a rule
+            file, or the rules themselves. None is 'default'
+    --------------
+    Returns
+    --------------
+        rules: dict
+
+    '''
+    if rules is None:
+        rules = 'default'
+    if isinstance(rules, dict):
+        check_names(rules)
+        return rules
+    path = rules if os.path.exists(rules) else os.path.join(rules_dir, f'{rules}.json')
+    if not os.path.exists(path):
+        raise ValueError(f'No rule file {rules}')
+    with open(path) as f:
+        rules = json.load(f)
+    check_names(rules)
+    return rules
+
+
+def check_names(rules):
+    ''' Rejects input, output term and input term names that are not
+    Python identifiers. The names end up in generated source, so rule
+    files, which can come inline from scenario and batch files, can't
+    inject code.
+    '''
+    names = list(rules.get('inputs', {})) + list(rules.get('output', {}).get('terms', {}))
+    for spec in rules.get('inputs', {}).values():
+        if isinstance(spec, dict) and isinstance(spec.get('terms'), dict):
+            names.extend(spec['terms'])
+    for name in names:
+        if not isinstance(name, str) or not name.isidentifier():
+            raise ValueError(f'Invalid name in rule file: {name!r}')
+
+
+def rules_key(rules):
+    ''' Hash of a rule set, ignoring formatting and key order '''
+    return hashlib.sha256(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def compile_rules(rules=None):
+    ''' Returns the compiled detector of a rule set, compiling it the first
+    time its hash is seen
+
+    --------------
+    Parameters
+    --------------
+        rules: str, dict or None
+            See load_rules
+    --------------
+    Returns
+    --------------
+        detector: CompiledDetector
+
+    '''
+    rules = load_rules(rules)
+    key = rules_key(rules)
+    detector = _compiled_cache.get(key)
+    if detector is None:
+        detector = CompiledDetector(rules)
+        _compiled_cache[key] = detector
+    return detector
+
+
+def _build_tables(rules):
+    # Universes and sampled memberships of the inputs and output
+    tables = {}
+    for name, spec in rules['inputs'].items():
+        if name not in metric_names:
+            raise ValueError(f'Unknown fuzzy input: {name}')
+        universe = np.arange(*spec['universe'])
+        terms = spec['terms']
+        if terms == 'automf3':
+            terms = _automf3(universe)
+        elif isinstance(terms, dict):
+            terms = {term: _trimf(universe, abc) for term, abc in terms.items()}
+        else:
+            raise ValueError(f'Unknown terms for {name}: {terms}')
+        tables[name] = (universe, terms)
+    universe = np.arange(*rules['output']['universe'])
+    tables['compromised'] = (universe, {term: _trimf(universe, abc)
+                                        for term, abc in rules['output']['terms'].items()})
+    return tables
+
+
+def _fuzzy_source(rules, tables):
+    # Source of fuzzy_kernel(packet_rate, bandwidth, response_time), which
+    # returns the firing strength of each output term, and the arrays it
+    # refers to
+    namespace = {}
+    lines = ['def fuzzy_kernel(packet_rate, bandwidth, response_time):']
+    for name, spec in rules['inputs'].items():
+        universe = tables[name][0]
+        namespace[f'{name}_universe'] = universe
+        value = f"{spec['invert']!r} - {name}" if 'invert' in spec else name
+        lines.append(f'    {name} = np.clip({value}, {float(universe.min())!r}, {float(universe.max())!r})')
+
+    memberships = {}
+
+    def condition(node):
+        if isinstance(node, dict) and len(node) == 1 and ('any' in node or 'all' in node):
+            combine = 'np.fmax' if 'any' in node else 'np.fmin'
+            parts = [condition(child) for child in next(iter(node.values()))]
+            expression = parts[0]
+            for part in parts[1:]:
+                expression = f'{combine}({expression}, {part})'
+            return expression
+        name, term = node
+        if name not in tables or name == 'compromised' or term not in tables[name][1]:
+            raise ValueError(f'Unknown fuzzy term: {name} {term}')
+        if (name, term) not in memberships:
+            variable = f'm{len(memberships)}'
+            memberships[(name, term)] = variable
+            namespace[f'{variable}_mf'] = tables[name][1][term]
+            lines.append(f'    {variable} = np.interp({name}, {name}_universe, {variable}_mf)  # {name!r} {term!r}')
+        return memberships[(name, term)]
+
+    cuts = []
+    for i, rule in enumerate(rules['rules']):
+        term = rule['then']
+        if term not in tables['compromised'][1]:
+            raise ValueError(f'Unknown output term: {term}')
+        lines.append(f'    r{i} = {condition(rule["if"])}')
+        if term in cuts:
+            lines.append(f'    cut{cuts.index(term)} = np.fmax(r{i}, cut{cuts.index(term)})')
+        else:
+            cuts.append(term)
+            lines.append(f'    cut{len(cuts) - 1} = r{i}')
+    if not cuts:
+        raise ValueError('The rule file has no fuzzy rules')
+    lines.append('    return {' + ', '.join(f'{term!r}: cut{j}' for j, term in enumerate(cuts)) + '}')
+    return '\n'.join(lines) + '\n', namespace
+
+
+def _crisp_source(rules):
+    # Source of crisp_kernel(packet_rate, bandwidth, response_time, cutoffs)
+    cutoffs = rules.get('cutoffs', {})
+
+    def condition(node):
+        if isinstance(node, dict) and len(node) == 1 and ('any' in node or 'all' in node):
+            combine = ' | ' if 'any' in node else ' & '
+            return '(' + combine.join(condition(child) for child in next(iter(node.values()))) + ')'
+        name, op, cutoff = node
+        if name not in metric_names or op not in crisp_operators:
+            raise ValueError(f'Unknown crisp condition: {node}')
+        if isinstance(cutoff, str):
+            if cutoff not in cutoffs:
+                raise ValueError(f'Unknown cutoff: {cutoff}')
+            return f'({name} {op} cutoffs[{cutoff!r}])'
+        return f'({name} {op} {float(cutoff)!r})'
+
+    if 'crisp' not in rules:
+        raise ValueError('The rule file has no crisp check')
+    lines = ['def crisp_kernel(packet_rate, bandwidth, response_time, cutoffs):']
+    for name in metric_names:
+        lines.append(f'    {name} = np.asarray({name})')
+    lines.append(f"    return {condition(rules['crisp'])}.astype(np.int8)")
+    return '\n'.join(lines) + '\n'
+
+
+def _compile(source, name, namespace, key):
+    # Compiles generated source and returns the function it defines
+    namespace = dict(namespace, np=np)
+    exec(compile(source, f'<rules {key}: {name}>', 'exec'), namespace)
+    return namespace[name]
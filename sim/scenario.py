@@ -0,0 +1,104 @@
+from .network_sim import Simulation
+from .attacker import Attacker
+from . import topology
+
+# Description of a simulation, e.g. one entry of a run_batch.py batch
+# file. Scenarios are plain dicts so they can be sent to worker processes
+# and stored as JSON
+#
+# structure is 'v1', None (no links) or the name of a generator in
+# topology_builders, called with num_nodes and structure_options.
+# baseline is None for the fixed detector cutoffs or a dict of
+# MetricBaseline options, e.g. {'method': 'ewma', 'alpha': 0.01}.
+# detector_rules is None for the built-in detectors, or the name of a
+# rule file in sim/rules, the path of one or the rules themselves (see
+# rule_compiler.CompiledDetector); rule files need the 'batch' fuzzy mode.
+# fuzzy_memo is None or a dict of MemoizedFuzzyDetector options, e.g.
+# {'resolution': 2, 'max_size': 65536}.
+# fuzzy_mode 'surface' builds the fuzzy surface the first time it is used
+# (about 25 s for the default grid, see fuzzy_surface), then loads it from
+# the cache directory
+default_scenario = {'num_nodes': 9,
+                    'structure': 'v1',
+                    'structure_options': {},
+                    'attackers': [0],
+                    'timesteps': 200,
+                    'fuzzy_mode': 'batch',
+                    'security_threshold': None,
+                    'baseline': None,
+                    'detector_rules': None,
+                    'fuzzy_memo': None}
+
+
+topology_builders = {'kary_tree': topology.kary_tree,
+                     'random_dag': topology.random_dag,
+                     'scale_free': topology.scale_free,
+                     'edge_list': lambda num_nodes, path: topology.from_edge_list(path, num_nodes)}
+
+
+def get_scenario(scenario=None):
+    ''' Fills in the values a scenario does not set with default_scenario
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Scenario values, any of the keys of default_scenario
+    --------------
+    Returns
+    --------------
+        scenario: dict
+            Complete scenario
+
+    '''
+    full_scenario = dict(default_scenario)
+    if scenario is not None:
+        unknown = set(scenario) - set(default_scenario)
+        if unknown:
+            raise ValueError(f'Unknown scenario values: {sorted(unknown)}')
+        full_scenario.update(scenario)
+    return full_scenario
+
+
+def build_simulation(scenario=None, seed=None, name='sim', verbose=False):
+    ''' Creates a simulation with the nodes, structure and attackers of a
+    scenario, ready for run_simulation.
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Scenario to build, see default_scenario
+        seed: int or numpy.random.SeedSequence
+            Seed of the simulation
+        name: str
+            Simulation name
+        verbose: bool
+            Print attack propagation while the simulation runs
+    --------------
+    Returns
+    --------------
+        sim: Simulation
+
+    '''
+    scenario = get_scenario(scenario)
+    sim = Simulation(name, fuzzy_mode=scenario['fuzzy_mode'], seed=seed, verbose=verbose,
+                     baseline_options=scenario['baseline'], detector_rules=scenario['detector_rules'],
+                     memo_options=scenario['fuzzy_memo'])
+    sim.establish_nodes(scenario['num_nodes'])
+
+    structure = scenario['structure']
+    if structure == 'v1':
+        sim.set_v1_structure()
+    elif structure in topology_builders:
+        sim.set_topology(topology_builders[structure](scenario['num_nodes'], **scenario['structure_options']))
+    elif structure is not None:
+        raise ValueError(f'Unknown structure: {structure}')
+
+    if scenario['security_threshold'] is not None:
+        for n in sim.node_list:
+            n.security_threshold = scenario['security_threshold']
+
+    for target in scenario['attackers']:
+        sim.add_attacker(Attacker(f'attacker_{target}', target))
+    return sim
@@ -0,0 +1,308 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import traceback
+
+import numpy as np
+
+from .detectors import fuzzy_category, fuzzy_category_scan
+from .metric_generator import metric_names
+from .sim_state import state_columns
+
+# Compromise times of nodes that were compromised before the run started
+# and of nodes that are not compromised
+already_compromised = np.iinfo(np.int64).min
+never_compromised = np.iinfo(np.int64).max
+
+
+class ShardedSimulation:
+    '''
+    Runs one large simulation across several worker processes. The nodes
+    are split into shards of whole metric lanes (see MetricGenerator), and
+    every worker draws the metrics of its shard and runs the basic check,
+    the fuzzy check and the baselines for it, writing its columns of each
+    chunk of timesteps straight into shared memory.
+
+    Attacks only depend on the compromise state and the attack generator,
+    not on the metrics or detectors, so the coordinator runs the
+    propagation engine for the whole run first and shares the timestep
+    each node was compromised at. That is the only state passed between
+    shards. Nodes of a shard are independent of each other apart from
+    that, so the results are identical to Simulation.run_simulation with
+    the same seed.
+
+    The simulation's generator, baselines and fuzzy flags are updated at
+    the end of the run, so runs can continue in a single process or in
+    another sharded run.
+
+    --------------
+    Attributes
+    --------------
+        sim: Simulation
+            Simulation that is run, built as usual
+        num_shards: int
+            Number of worker processes. Capped at the number of lanes
+        chunk_rows: int
+            Timesteps run by the workers between exchanges with the
+            coordinator. Shared memory holds one chunk of every column
+        shards: list, tuple
+            (start, stop) node range of every shard
+
+    --------------
+    Methods
+    --------------
+        run_simulation(t, sink)
+            Runs the simulation for a number of timesteps
+    --------------
+
+    '''
+
+    def __init__(self, sim, num_shards=None, chunk_rows=1024):
+        self.sim = sim
+        self.num_shards = num_shards or multiprocessing.cpu_count()
+        self.chunk_rows = chunk_rows
+        self.shards = get_shard_bounds(len(sim.node_list), sim.metric_generator.lane_size, self.num_shards)
+
+    def run_simulation(self, t, sink=None):
+        ''' Runs the simulation for t timesteps, like
+        Simulation.run_simulation
+
+        --------------
+        Parameters
+        --------------
+            t: int
+                Number of timesteps to run the simulation
+            sink: ColumnarSink
+                Store to stream results into. Chunks are then the sink's
+                chunk_rows
+        --------------
+        Returns
+        --------------
+            sim_results: dict or ResultReader
+                As returned by Simulation.run_simulation
+
+        '''
+        sim = self.sim
+        state = sim.state
+        num_nodes = state.num_nodes
+        profiler = sim.profiler
+        stage = profiler.stage
+        chunk_rows = sink.chunk_rows if sink is not None else self.chunk_rows
+        if sink is None:
+            state.reserve(state.rows + t)
+        else:
+            state.reserve(1 + chunk_rows)
+        propagation = sim.get_propagation_engine()
+        baseline = sim.get_baseline()
+        start = state.get_next_timestep()
+
+        blocks = []
+        workers = []
+        try:
+            compromise_time = _shared_array(blocks, num_nodes, np.int64)
+            compromise_time[:] = np.where(state.is_compromised, already_compromised, never_compromised)
+            with stage('propagation'):
+                for timestep in range(start, start + t):
+                    compromised = propagation.step(timestep)
+                    compromise_time[compromised] = timestep
+                    for ind in compromised:
+                        children = sim.topology.get_children(ind)
+                        if sim.verbose and len(children) > 0:
+                            print(f'{sim.node_list[ind].name} is compromised, attacking {[sim.node_list[c].name for c in children]}')
+                    profiler.count('compromised', len(compromised))
+            propagation.timestep = start + t
+            profiler.end_step('propagation')
+
+            columns = {name: _shared_array(blocks, (chunk_rows, num_nodes), dtype)
+                       for name, dtype in state_columns.items()}
+            engine = sim.fuzzy_detector if sim.fuzzy_mode == 'exact' else sim.fuzzy_engine
+            names = {name: (block.name, values.shape, values.dtype.str)
+                     for (name, values), block in zip(columns.items(), blocks[1:])}
+            names['compromise_time'] = (blocks[0].name, compromise_time.shape, compromise_time.dtype.str)
+
+            context = multiprocessing.get_context()
+            for first, last in self.shards:
+                connection, worker_connection = context.Pipe()
+                setup = {'start': first,
+                         'stop': last,
+                         'arrays': names,
+                         'fuzzy_mode': sim.fuzzy_mode,
+                         'engine': engine,
+                         'basic_check': sim.get_basic_check(),
+                         'generator': sim.metric_generator.get_shard(first, last),
+                         'baseline': baseline.get_shard(first, last) if baseline is not None else None,
+                         'fuzzy_flag': state.fuzzy_flagged_malicious[first:last].copy()}
+                worker = context.Process(target=_run_shard, args=(worker_connection, setup), daemon=True)
+                worker.start()
+                worker_connection.close()
+                workers.append((worker, connection))
+
+            for step in range(start, start + t, chunk_rows):
+                rows = min(chunk_rows, start + t - step)
+                with stage('shards'):
+                    for _, connection in workers:
+                        connection.send(('run', step, rows))
+                    for _, connection in workers:
+                        _receive(connection)
+                with stage('collect'):
+                    if sink is not None and state.rows + rows > state.get_capacity():
+                        state.flush(sink)
+                    row = state.rows
+                    state.time[row:row + rows] = np.arange(step, step + rows)
+                    for name, values in columns.items():
+                        state.columns[name][row:row + rows] = values[:rows]
+                    state.rows += rows
+                profiler.count('fuzzy_evaluations', rows * num_nodes)
+                profiler.end_step(step + rows - 1)
+
+            for (first, _), (_, connection) in zip(self.shards, workers):
+                connection.send(('finish',))
+                generator, shard_baseline, fuzzy_flag = _receive(connection)
+                sim.metric_generator.merge_shard(first, generator)
+                if baseline is not None:
+                    baseline.merge_shard(first, shard_baseline)
+                state.fuzzy_flagged_malicious[first:first + len(fuzzy_flag)] = fuzzy_flag
+        finally:
+            for worker, connection in workers:
+                connection.close()
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        if sink is not None:
+            with stage('flush'):
+                state.flush(sink)
+            profiler.end_step('flush')
+            return sink.get_reader()
+        return state.to_results([n.name for n in sim.node_list])
+
+
+def get_shard_bounds(num_nodes, lane_size, num_shards):
+    ''' Splits the nodes into contiguous shards of whole lanes with close
+    to the same number of lanes each
+
+    --------------
+    Parameters
+    --------------
+        num_nodes: int
+            Number of nodes
+        lane_size: int
+            Number of nodes per lane of the metric generator
+        num_shards: int
+            Largest number of shards
+    --------------
+    Returns
+    --------------
+        shards: list, tuple
+            (start, stop) node range of every shard
+
+    '''
+    num_lanes = -(-num_nodes // lane_size)
+    lanes = np.array_split(np.arange(num_lanes), min(num_shards, num_lanes))
+    return [(int(l[0]) * lane_size, min(int(l[-1] + 1) * lane_size, num_nodes)) for l in lanes if len(l)]
+
+
+def _shared_array(blocks, shape, dtype):
+    # Array in a new shared memory block, kept in blocks so it is released
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _receive(connection):
+    # Reply of a worker, raising the worker's error if it failed
+    kind, value = connection.recv()
+    if kind == 'error':
+        raise RuntimeError(f'Shard worker failed:\n{value}')
+    return value
+
+
+def _run_shard(connection, setup):
+    # Worker process: runs the chunks of one shard until told to finish
+    blocks = []
+    try:
+        _serve_shard(connection, setup, blocks)
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        # The arrays on the blocks were released with _serve_shard's frame
+        for block in blocks:
+            block.close()
+        connection.close()
+
+
+def _serve_shard(connection, setup, blocks):
+    arrays = {}
+    for name, (block_name, shape, dtype) in setup['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    shard = _Shard(setup, arrays)
+    while True:
+        message = connection.recv()
+        if message[0] == 'finish':
+            connection.send(('state', (shard.generator, shard.baseline, shard.fuzzy_flag)))
+            return
+        shard.run(*message[1:])
+        connection.send(('done', None))
+
+
+class _Shard:
+    # State of one shard inside its worker process
+
+    def __init__(self, setup, arrays):
+        self.nodes = slice(setup['start'], setup['stop'])
+        self.fuzzy_mode = setup['fuzzy_mode']
+        self.engine = setup['engine']
+        self.basic_check = setup['basic_check']
+        self.generator = setup['generator']
+        self.baseline = setup['baseline']
+        self.fuzzy_flag = setup['fuzzy_flag']
+        self.compromise_time = arrays.pop('compromise_time')[self.nodes]
+        self.columns = {name: values[:, self.nodes] for name, values in arrays.items()}
+
+    def run(self, step, rows):
+        # Fills rows of the shared columns for timesteps step..step+rows-1
+        columns = self.columns
+        times = np.arange(step, step + rows)
+        compromised = (self.compromise_time <= times[:, None]).astype(np.int8)
+        metrics = self.generator.draw(rows, compromised)
+        for name in metric_names:
+            columns[name][:rows] = metrics[name]
+        columns['compromised_truth'][:rows] = compromised
+        pr, bw, rt = [metrics[name] for name in ('packet_rate', 'bandwidth', 'response_time')]
+
+        if self.baseline is None and self.fuzzy_mode != 'exact':
+            # Without baselines every timestep is checked the same way,
+            # so the whole chunk is checked at once
+            columns['flagged_malicious'][:rows] = self.basic_check(pr, bw, rt)
+            values = self.engine.compute_batch(pr.ravel(), bw.ravel(), rt.ravel()).reshape(pr.shape)
+            category = fuzzy_category_scan(values, self.fuzzy_flag)
+            columns['fuzzy_compromised_value'][:rows] = values
+            columns['fuzzy_compromised_category'][:rows] = category
+            self.fuzzy_flag = category[-1].copy()
+            return
+
+        baseline = self.baseline
+        for row in range(rows):
+            inputs = [pr[row], bw[row], rt[row]]
+            thresholds = baseline.get_basic_thresholds() if baseline is not None else None
+            flagged = self.basic_check(*inputs, thresholds)
+            if baseline is not None:
+                inputs = [baseline.normalize(name, values)
+                          for name, values in zip(('packet_rate', 'bandwidth', 'response_time'), inputs)]
+            if self.fuzzy_mode == 'exact':
+                values = np.array([self.engine.compute(*node_inputs) for node_inputs in zip(*inputs)])
+            else:
+                values = self.engine.compute_batch(*inputs)
+            self.fuzzy_flag = fuzzy_category(values, self.fuzzy_flag)
+
+            columns['flagged_malicious'][row] = flagged
+            columns['fuzzy_compromised_value'][row] = values
+            columns['fuzzy_compromised_category'][row] = self.fuzzy_flag
+            if baseline is not None:
+                healthy = (flagged == 0) & (self.fuzzy_flag == 0)
+                baseline.update({name: metrics[name][row] for name in metric_names}, healthy)
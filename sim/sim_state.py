@@ -0,0 +1,230 @@
+import numpy as np
+
+# Recorded columns and their storage types. Each column is stored as one
+# (timesteps, nodes) array
+state_columns = {'packet_rate': np.float64,
+                 'bandwidth': np.float64,
+                 'response_time': np.float64,
+                 'flagged_malicious': np.int8,
+                 'fuzzy_compromised_value': np.float64,
+                 'fuzzy_compromised_category': np.int8,
+                 'compromised_truth': np.int8}
+
+
+class SimulationState:
+    '''
+    Struct-of-arrays store for everything recorded during a simulation.
+    Every metric, flag and truth column is a preallocated NumPy array
+    shaped (timesteps, nodes); NetworkNode objects are views onto one
+    column of the store.
+
+    Row 0 holds the initial state of the nodes (time -1), and one row is
+    added for each timestep of the simulation. When results are streamed
+    to a sink, rows that have been written out are dropped from memory
+    and only the latest row is kept.
+
+    --------------
+    Attributes
+    --------------
+        num_nodes: int
+            Number of nodes (columns) in the store
+        rows: int
+            Number of rows that have been filled
+        persisted: int
+            Number of leading rows that have already been written to a sink
+        time: array, int
+            Simulation time of each row
+        columns: dict
+            (column name, (capacity, num_nodes) array) pairs
+        is_compromised: array, int8
+            Current truth of whether or not each node is compromised
+        fuzzy_flagged_malicious: array, int8
+            Latest fuzzy category of each node, carried between timesteps
+            by the fuzzy category hysteresis
+        security_threshold: array, float
+            Threshold an attack attempt on each node has to beat
+
+    --------------
+    Methods
+    --------------
+        reserve(capacity)
+            Grows the arrays so at least capacity rows fit
+        add_row(timestep)
+            Starts a new row for a timestep and returns its index
+        get_column(name, index)
+            Recorded values of one column for one node
+        get_current(name)
+            Values of a column for all nodes in the latest row
+        record_truth()
+            Stores the current compromise truth in the latest row
+        record_fuzzy(values, category, index)
+            Stores fuzzy values and categories in the latest row
+        flush(sink, keep_last)
+            Writes the rows not yet persisted to a sink and frees them
+        to_results(node_names)
+            Builds the nested sim_results dictionary
+    --------------
+
+    '''
+
+    def __init__(self, num_nodes, capacity=1):
+        self.num_nodes = num_nodes
+        self.rows = 0
+        self.persisted = 0
+        self.time = np.zeros(capacity, dtype=np.int64)
+        self.columns = {name: np.zeros((capacity, num_nodes), dtype=dtype)
+                        for name, dtype in state_columns.items()}
+        self.is_compromised = np.zeros(num_nodes, dtype=np.int8)
+        self.fuzzy_flagged_malicious = np.zeros(num_nodes, dtype=np.int8)
+        self.security_threshold = np.full(num_nodes, 0.97)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def get_capacity(self):
+        return len(self.time)
+
+    def reserve(self, capacity):
+        ''' Makes sure the store can hold at least capacity rows, so that a
+        whole simulation run can be recorded without reallocating.
+
+        --------------
+        Parameters
+        --------------
+            capacity: int
+                Number of rows needed
+
+        '''
+        if capacity <= self.get_capacity():
+            return
+        time = np.zeros(capacity, dtype=self.time.dtype)
+        time[:self.rows] = self.time[:self.rows]
+        self.time = time
+        for name, values in self.columns.items():
+            grown = np.zeros((capacity, self.num_nodes), dtype=values.dtype)
+            grown[:self.rows] = values[:self.rows]
+            self.columns[name] = grown
+
+    def add_row(self, timestep):
+        ''' Starts the row for a new timestep. Flags and values in the row
+        start at zero until they are recorded.
+
+        --------------
+        Parameters
+        --------------
+            timestep: int
+                Current timestep of the simulation
+        --------------
+        Returns
+        --------------
+            row: int
+                Index of the new row
+
+        '''
+        if self.rows == self.get_capacity():
+            self.reserve(max(1, 2 * self.rows))
+        row = self.rows
+        self.time[row] = timestep
+        self.rows += 1
+        return row
+
+    def get_column(self, name, index):
+        ''' Returns a view of the recorded values of a column for one node
+
+        --------------
+        Parameters
+        --------------
+            name: str
+                Column name, one of state_columns
+            index: int
+                Index of the node
+
+        '''
+        return self.columns[name][:self.rows, index]
+
+    def get_times(self):
+        return self.time[:self.rows]
+
+    def get_next_timestep(self):
+        return int(self.time[self.rows - 1]) + 1 if self.rows else 0
+
+    def get_current(self, name):
+        ''' Returns a view of the values of a column for all nodes in the
+        latest row
+        '''
+        return self.columns[name][self.rows - 1]
+
+    def record_truth(self):
+        ''' Stores whether or not each node is truly compromised in the
+        latest row, used for truthing.
+        '''
+        self.columns['compromised_truth'][self.rows - 1] = self.is_compromised
+
+    def record_fuzzy(self, values, category, index=slice(None)):
+        ''' Stores fuzzy compromised values and categories in the latest
+        row, and keeps the categories as the nodes' current fuzzy flags.
+
+        --------------
+        Parameters
+        --------------
+            values: float or array
+                Fuzzy compromised values
+            category: int or array
+                Fuzzy categories for the values
+            index: int, array or slice
+                Node(s) the values belong to, all nodes by default
+
+        '''
+        row = self.rows - 1
+        self.columns['fuzzy_compromised_value'][row, index] = values
+        self.columns['fuzzy_compromised_category'][row, index] = category
+        self.fuzzy_flagged_malicious[index] = category
+
+    def flush(self, sink, compact=True):
+        ''' Appends the rows that have not been persisted yet to a sink. With
+        compact, the in-memory rows are then released, keeping only the
+        latest row so the nodes' current values stay available.
+
+        --------------
+        Parameters
+        --------------
+            sink: ColumnarSink
+                Store the rows are written to
+            compact: bool
+                Drop the written rows from memory
+
+        '''
+        rows = slice(self.persisted, self.rows)
+        sink.append(self.time[rows], {name: values[rows] for name, values in self.columns.items()})
+        if compact and self.rows > 1:
+            last = self.rows - 1
+            self.time[0] = self.time[last]
+            for values in self.columns.values():
+                values[0] = values[last]
+            self.rows = 1
+        self.persisted = self.rows
+
+    def to_results(self, node_names):
+        ''' Builds the sim_results dictionary returned by run_simulation,
+        with one entry per node holding views of that node's columns.
+
+        --------------
+        Parameters
+        --------------
+            node_names: list, str
+                Names of the nodes, in column order
+        --------------
+        Returns
+        --------------
+            sim_results: dict
+                (node name, {column name: values}) pairs
+
+        '''
+        time = self.get_times()
+        sim_results = {}
+        for index, name in enumerate(node_names):
+            node_results = {'time': time}
+            for column in state_columns:
+                node_results[column] = self.get_column(column, index)
+            sim_results[name] = node_results
+        return sim_results
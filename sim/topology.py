@@ -0,0 +1,267 @@
+import numpy as np
+
+
+class Topology:
+    '''
+    Directed network structure stored as CSR-style index arrays. The
+    children of node i are child_idx[child_ptr[i]:child_ptr[i + 1]], and
+    parents are stored the same way, so neighbours are found with two
+    array lookups and whole frontiers can be expanded at once.
+
+    --------------
+    Attributes
+    --------------
+        num_nodes: int
+            Number of nodes in the network
+        child_ptr, child_idx: array, int64
+            Offsets into and indices of each node's children
+        parent_ptr, parent_idx: array, int64
+            Offsets into and indices of each node's parents
+        level: array, int64
+            Depth of each node below the roots (nodes without parents),
+            found by breadth-first search. -1 for nodes that can't be
+            reached from a root
+
+    --------------
+    Methods
+    --------------
+        get_children(ind) / get_parents(ind)
+            Indices of a node's children or parents
+        get_edges()
+            (sources, targets) arrays of all links
+        get_roots()
+            Indices of the nodes without parents
+        expand(frontier)
+            Children of all nodes in a frontier
+    --------------
+
+    '''
+
+    def __init__(self, num_nodes, sources, targets):
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        if len(sources) and (min(sources.min(), targets.min()) < 0
+                             or max(sources.max(), targets.max()) >= num_nodes):
+            raise ValueError(f'Edge list refers to nodes outside 0..{num_nodes - 1}')
+
+        self.num_nodes = num_nodes
+        self.child_ptr, self.child_idx = _csr(num_nodes, sources, targets)
+        self.parent_ptr, self.parent_idx = _csr(num_nodes, targets, sources)
+        self.level = self._compute_levels()
+
+    def get_children(self, ind):
+        return self.child_idx[self.child_ptr[ind]:self.child_ptr[ind + 1]]
+
+    def get_parents(self, ind):
+        return self.parent_idx[self.parent_ptr[ind]:self.parent_ptr[ind + 1]]
+
+    def get_num_edges(self):
+        return len(self.child_idx)
+
+    def get_edges(self):
+        sources = np.repeat(np.arange(self.num_nodes), np.diff(self.child_ptr))
+        return sources, self.child_idx.copy()
+
+    def get_roots(self):
+        return np.flatnonzero(np.diff(self.parent_ptr) == 0)
+
+    def expand(self, frontier):
+        ''' Returns the children of every node in a frontier, with repeats
+        where nodes share children
+
+        --------------
+        Parameters
+        --------------
+            frontier: array, int
+                Node indices
+        --------------
+        Returns
+        --------------
+            children: array, int64
+
+        '''
+        return _gather(self.child_ptr, self.child_idx, np.asarray(frontier, dtype=np.int64))
+
+    def _compute_levels(self):
+        # Breadth-first search from all roots, one frontier at a time
+        level = np.full(self.num_nodes, -1, dtype=np.int64)
+        frontier = self.get_roots()
+        depth = 0
+        while len(frontier):
+            level[frontier] = depth
+            children = self.expand(frontier)
+            frontier = np.unique(children[level[children] < 0])
+            depth += 1
+        return level
+
+
+def _csr(num_nodes, sources, targets):
+    # Group targets by source; stable so neighbours keep their edge order
+    order = np.argsort(sources, kind='stable')
+    ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_nodes), out=ptr[1:])
+    return ptr, targets[order]
+
+
+def _gather(ptr, idx, nodes):
+    # Concatenation of idx[ptr[n]:ptr[n + 1]] for every n in nodes
+    starts = ptr[nodes]
+    lengths = ptr[nodes + 1] - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+    return idx[offsets]
+
+
+def _unique_edges(num_nodes, sources, targets):
+    # Drop repeated links
+    keys = np.unique(sources * num_nodes + targets)
+    return keys // num_nodes, keys % num_nodes
+
+
+def v1_tree():
+    ''' The 9-node tree used by Simulation.set_v1_structure:
+
+        0 -> 1, 2;  1 -> 3;  2 -> 4, 5;  3 -> 6, 7;  5 -> 8
+
+    '''
+    sources = [0, 0, 1, 2, 2, 3, 3, 5]
+    targets = [1, 2, 3, 4, 5, 6, 7, 8]
+    return Topology(9, sources, targets)
+
+
+def kary_tree(num_nodes, k=2):
+    ''' Complete k-ary tree with nodes numbered in breadth-first order
+
+    --------------
+    Parameters
+    --------------
+        num_nodes: int
+            Number of nodes in the tree
+        k: int
+            Number of children of every internal node
+    --------------
+    Returns
+    --------------
+        topology: Topology
+
+    '''
+    targets = np.arange(1, num_nodes, dtype=np.int64)
+    return Topology(num_nodes, (targets - 1) // k, targets)
+
+
+def random_dag(num_nodes, max_parents=2, seed=None):
+    ''' Random directed acyclic graph. Every node except node 0 links from
+    between 1 and max_parents distinct, uniformly chosen lower-numbered
+    nodes, so node 0 is the only root.
+
+    --------------
+    Parameters
+    --------------
+        num_nodes: int
+            Number of nodes
+        max_parents: int
+            Number of parents drawn for each node before repeats are removed
+        seed: int
+            Seed for the random graph
+    --------------
+    Returns
+    --------------
+        topology: Topology
+
+    '''
+    rng = np.random.default_rng(seed)
+    targets = np.repeat(np.arange(1, num_nodes, dtype=np.int64), max_parents)
+    sources = (rng.random(len(targets)) * targets).astype(np.int64)
+    return Topology(num_nodes, *_unique_edges(num_nodes, sources, targets))
+
+
+def scale_free(num_nodes, m=2, seed=None):
+    ''' Scale-free directed acyclic graph grown by preferential attachment.
+    Each new node links from m earlier nodes (fewer where repeats are
+    removed). Half of the links pick a uniformly random earlier node and
+    half copy the parent of a random earlier link, which picks parents in
+    proportion to how many children they already have, giving a power-law
+    number of children per node.
+
+    --------------
+    Parameters
+    --------------
+        num_nodes: int
+            Number of nodes
+        m: int
+            Links made by each new node
+        seed: int
+            Seed for the random graph
+    --------------
+    Returns
+    --------------
+        topology: Topology
+
+    '''
+    rng = np.random.default_rng(seed)
+    targets = np.repeat(np.arange(1, num_nodes, dtype=np.int64), m)
+    n_edges = len(targets)
+    uniform = (rng.random(n_edges) * targets).astype(np.int64)
+
+    # Links of node i are numbered from (i - 1) * m, so a link can copy any
+    # link made by an earlier node. Node 1 has nothing to copy
+    first_link = (targets - 1) * m
+    copied = (rng.random(n_edges) * first_link).astype(np.int64)
+    pointer = np.where((rng.random(n_edges) < 0.5) | (first_link == 0),
+                       np.arange(n_edges), copied)
+
+    # Follow the copy chains to the link whose parent was chosen uniformly
+    while True:
+        jumped = pointer[pointer]
+        if np.array_equal(jumped, pointer):
+            break
+        pointer = jumped
+    return Topology(num_nodes, *_unique_edges(num_nodes, uniform[pointer], targets))
+
+
+def from_edge_list(path, num_nodes=None):
+    ''' Loads a topology from a text file with one "parent child" pair of
+    node indices per line. Lines starting with # are ignored.
+
+    --------------
+    Parameters
+    --------------
+        path: str
+            Edge list file
+        num_nodes: int
+            Number of nodes, by default one more than the largest index
+    --------------
+    Returns
+    --------------
+        topology: Topology
+
+    '''
+    edges = np.loadtxt(path, dtype=np.int64, comments='#', ndmin=2)
+    if edges.size and edges.shape[1] != 2:
+        raise ValueError(f'{path} has {edges.shape[1]} values per line, expected "parent child"')
+    # An empty or comment-only file loads as shape (0, 0)
+    edges = edges.reshape(-1, 2)
+    if num_nodes is None:
+        num_nodes = int(edges.max()) + 1 if len(edges) else 0
+    return Topology(num_nodes, edges[:, 0], edges[:, 1])
+
+
+def from_nodes(node_list):
+    ''' Builds a topology from NetworkNode objects linked with link_nodes
+
+    --------------
+    Parameters
+    --------------
+        node_list: list, NetworkNode objects
+            Nodes of the network, in index order
+    --------------
+    Returns
+    --------------
+        topology: Topology
+
+    '''
+    sources = [n.index for n in node_list for c in n.child_indices]
+    targets = [int(c) for n in node_list for c in n.child_indices]
+    return Topology(len(node_list), sources, targets)
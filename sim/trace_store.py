@@ -0,0 +1,300 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from .scenario import build_simulation, get_scenario
+from .detectors import basic_compromise_flags, fuzzy_category_scan
+from .fuzzy_detector import get_fuzzy_detector
+from .fuzzy_surface import default_cache_dir, get_fuzzy_surface
+from .rule_compiler import compile_rules
+from .evaluation import aggregate, evaluate
+from .batch_runner import get_code_version, get_file_hashes
+
+# Columns captured from a run. They only depend on the scenario and seed,
+# not on the detectors
+trace_columns = ('packet_rate', 'bandwidth', 'response_time', 'compromised_truth')
+
+# Scenario values the traces depend on. The others only configure the
+# detectors, so scenarios differing in them share traces
+trace_fields = ('num_nodes', 'structure', 'structure_options', 'attackers', 'timesteps',
+                'security_threshold')
+
+# Detector settings a sweep can vary. fuzzy_params overrides
+# fuzzy_detector.fuzzy_values, basic_thresholds is passed to
+# detectors.basic_compromise_flags and category_cutoffs are the low and
+# high edges of the fuzzy category's questionable band. Settings that
+# change the truth, such as security_threshold, belong to the scenario
+# and get their own traces. Replays use the detectors without running
+# baselines. rules replaces both detectors with a rule file (see
+# rule_compiler.load_rules), in which case fuzzy_params and fuzzy_mode are
+# not used and basic_thresholds overrides the file's cutoffs
+default_detector_config = {'fuzzy_params': None,
+                           'fuzzy_mode': 'batch',
+                           'basic_thresholds': None,
+                           'category_cutoffs': (5, 6),
+                           'rules': None}
+
+
+def get_trace_scenario(scenario):
+    ''' The scenario with default detectors, keeping only trace_fields '''
+    scenario = get_scenario(scenario)
+    return get_scenario({name: scenario[name] for name in trace_fields})
+
+
+def trace_key(scenario, seed):
+    ''' Hash identifying the traces of a scenario and seed, from the
+    scenario's trace_fields, the edge list it reads and the code version
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Scenario, completed with default_scenario
+        seed: int or numpy.random.SeedSequence
+    --------------
+    Returns
+    --------------
+        key: str
+
+    '''
+    if seed is None:
+        raise ValueError('Traces can only be cached for a fixed seed')
+    if isinstance(seed, np.random.SeedSequence):
+        seed = [seed.entropy, list(seed.spawn_key)]
+    scenario = get_trace_scenario(scenario)
+    payload = json.dumps({'scenario': scenario, 'seed': seed, 'version': get_code_version(),
+                          'files': get_file_hashes(scenario)}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+class Trace:
+    '''
+    Metric and truth traces of one simulation run, stored as .npy files in
+    a directory and opened as read-only memory maps. Processes that open
+    the same trace share the operating system's page cache instead of each
+    holding a copy.
+
+    --------------
+    Attributes
+    --------------
+        path: str
+            Directory of the trace
+        meta: dict
+            Scenario, seed and size of the run
+        time: array, int
+            Simulation time of each timestep
+        columns: dict
+            (column name, (timesteps, nodes) memmap) pairs for
+            trace_columns
+
+    --------------
+    Methods
+    --------------
+        replay(config)
+            Runs detectors with given settings on the trace
+    --------------
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.time = np.load(os.path.join(path, 'time.npy'), mmap_mode='r')
+        self.columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                        for name in trace_columns}
+
+    def replay(self, config=None):
+        ''' Runs the basic and fuzzy checks on the trace, as the simulation
+        would have with the given detector settings
+
+        --------------
+        Parameters
+        --------------
+            config: dict
+                Detector settings, any keys of default_detector_config
+        --------------
+        Returns
+        --------------
+            columns: dict
+                (column name, (timesteps, nodes) array) pairs for the
+                truth and both detectors' flags and the fuzzy values
+
+        '''
+        config = get_detector_config(config)
+        pr, bw, rt = [self.columns[name] for name in ('packet_rate', 'bandwidth', 'response_time')]
+        if config['rules'] is not None:
+            engine = compile_rules(config['rules'])
+            flagged = engine.flag(pr, bw, rt, config['basic_thresholds'])
+        else:
+            flagged = basic_compromise_flags(pr, bw, rt, config['basic_thresholds'])
+            if config['fuzzy_mode'] == 'surface':
+                engine = get_fuzzy_surface(config['fuzzy_params'])
+            else:
+                engine = get_fuzzy_detector(config['fuzzy_params'])
+        values = engine.compute_batch(pr.ravel(), bw.ravel(), rt.ravel()).reshape(pr.shape)
+
+        low, high = config['category_cutoffs']
+        category = fuzzy_category_scan(values, 0, low, high)
+
+        return {'compromised_truth': self.columns['compromised_truth'],
+                'flagged_malicious': flagged,
+                'fuzzy_compromised_value': values,
+                'fuzzy_compromised_category': category}
+
+
+def get_detector_config(config=None):
+    ''' Fills in the settings a detector config does not set '''
+    full_config = dict(default_detector_config)
+    if config is not None:
+        unknown = set(config) - set(default_detector_config)
+        if unknown:
+            raise ValueError(f'Unknown detector settings: {sorted(unknown)}')
+        full_config.update(config)
+    return full_config
+
+
+def capture_trace(scenario=None, seed=0, cache_dir=default_cache_dir):
+    ''' Runs a scenario once and stores its metric and truth traces, or
+    returns the stored traces if the scenario and seed were captured
+    before.
+
+    --------------
+    Parameters
+    --------------
+        scenario: dict
+            Scenario to run, see default_scenario
+        seed: int or numpy.random.SeedSequence
+            Seed of the run
+        cache_dir: str
+            Directory traces are stored in, under traces/
+    --------------
+    Returns
+    --------------
+        trace: Trace
+
+    '''
+    scenario = get_trace_scenario(scenario)
+    path = os.path.join(cache_dir, 'traces', trace_key(scenario, seed))
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return Trace(path)
+
+    # The detectors don't change the traces, so the default detectors and
+    # fast engine are used
+    sim = build_simulation(scenario, seed)
+    sim.run_simulation(scenario['timesteps'])
+    state = sim.state
+    steps = state.get_times() >= 0
+
+    # Write to a temporary directory and rename it, so a trace that is
+    # being written is never opened
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'time.npy'), state.get_times()[steps])
+    for name in trace_columns:
+        np.save(os.path.join(tmp_path, f'{name}.npy'), state[name][:state.rows][steps])
+    seed_value = [seed.entropy, list(seed.spawn_key)] if isinstance(seed, np.random.SeedSequence) else seed
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'scenario': scenario, 'seed': seed_value,
+                   'timesteps': int(steps.sum()), 'num_nodes': state.num_nodes}, f, default=str)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same trace first
+        shutil.rmtree(tmp_path)
+    return Trace(path)
+
+
+def replay_trace(path, config):
+    ''' Evaluates one detector config on one stored trace. Used by the
+    worker processes of ParameterSweep, which open the trace by path.
+
+    --------------
+    Returns
+    --------------
+        summary: dict
+            See evaluation.evaluate
+
+    '''
+    trace = Trace(path)
+    return evaluate(trace.replay(config), trace.time)
+
+
+class ParameterSweep:
+    '''
+    Evaluates many detector configs on the same captured runs. Traces are
+    captured once per scenario and seed, and worker processes open them
+    by path, so only the config and the small summaries are sent between
+    processes.
+
+    --------------
+    Attributes
+    --------------
+        scenario: dict
+            Scenario whose runs are replayed
+        seeds: list, int
+            Seed of each captured run
+        cache_dir: str
+            Directory the traces are stored in
+        max_workers: int
+            Number of worker processes. 1 runs everything in this process
+        traces: list, Trace
+            Captured runs, one per seed
+
+    --------------
+    Methods
+    --------------
+        run(configs)
+            Evaluates every config on every trace
+    --------------
+
+    '''
+
+    def __init__(self, scenario=None, seeds=(0,), cache_dir=default_cache_dir, max_workers=None):
+        self.scenario = get_scenario(scenario)
+        self.seeds = list(seeds)
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers or os.cpu_count()
+        self.traces = [capture_trace(self.scenario, seed, cache_dir) for seed in self.seeds]
+
+    def run(self, configs):
+        ''' Replays every trace through every detector config
+
+        --------------
+        Parameters
+        --------------
+            configs: list, dict
+                Detector settings, see default_detector_config
+        --------------
+        Returns
+        --------------
+            results: list, dict
+                For each config: 'config', 'statistics' pooled over the
+                traces (see evaluation.aggregate) and 'elapsed' seconds
+
+        '''
+        jobs = [(trace.path, config) for config in configs for trace in self.traces]
+        if not jobs:
+            return []
+        start = time.perf_counter()
+        if self.max_workers == 1:
+            summaries = [replay_trace(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(self.max_workers) as pool:
+                summaries = list(pool.map(replay_trace, *zip(*jobs)))
+        elapsed = time.perf_counter() - start
+
+        results = []
+        n = len(self.traces)
+        for i, config in enumerate(configs):
+            runs = summaries[i * n:(i + 1) * n]
+            stacked = {name: np.stack([s[name] for s in runs]) for name in runs[0]}
+            results.append({'config': get_detector_config(config),
+                            'statistics': aggregate(stacked),
+                            'elapsed': elapsed})
+        return results
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Tests import sim and utils from the repository root, like the run_*.py
+# scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
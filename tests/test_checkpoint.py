@@ -0,0 +1,76 @@
+import numpy as np
+
+from sim.checkpoint import Checkpointer, _read_records
+from sim.scenario import build_simulation
+
+scenario = {'num_nodes': 40,
+            'structure': 'kary_tree',
+            'structure_options': {'k': 3},
+            'baseline': {'method': 'ewma', 'alpha': 0.05}}
+timesteps = 150
+
+
+def get_rows(sim):
+    state = sim.state
+    return state.time[:state.rows], {name: values[:state.rows] for name, values in state.columns.items()}
+
+
+def assert_same_rows(sim, expected):
+    time, columns = get_rows(sim)
+    np.testing.assert_array_equal(time, expected[0])
+    for name, values in expected[1].items():
+        np.testing.assert_array_equal(columns[name], values, err_msg=name)
+
+
+def run_interrupted(path, stop):
+    # Runs until stop, as if the process ended there, then resumes in a
+    # freshly built simulation
+    sim = build_simulation(scenario, seed=3)
+    sim.run_simulation(stop, checkpointer=Checkpointer(path, every=20))
+    sim = build_simulation(scenario, seed=3)
+    checkpointer = Checkpointer(path, every=20)
+    done = checkpointer.restore(sim)
+    sim.run_simulation(timesteps - done, checkpointer=checkpointer)
+    return sim, done
+
+
+def test_resume_matches_uninterrupted_run(tmp_path):
+    sim = build_simulation(scenario, seed=3)
+    sim.run_simulation(timesteps)
+    expected = get_rows(sim)
+
+    # 70 timesteps stops partway through the second noise block
+    resumed, done = run_interrupted(tmp_path / 'run.ckpt', 70)
+    assert done == 70
+    assert_same_rows(resumed, expected)
+
+
+def test_damaged_record_resumes_from_previous(tmp_path):
+    path = tmp_path / 'run.ckpt'
+    sim = build_simulation(scenario, seed=3)
+    sim.run_simulation(timesteps)
+    expected = get_rows(sim)
+
+    sim = build_simulation(scenario, seed=3)
+    sim.run_simulation(70, checkpointer=Checkpointer(path, every=20))
+    # Cut the last record short, as if the run stopped while writing it
+    data = path.read_bytes()
+    path.write_bytes(data[:-10])
+
+    sim = build_simulation(scenario, seed=3)
+    checkpointer = Checkpointer(path, every=20)
+    done = checkpointer.restore(sim)
+    assert done == 60
+    sim.run_simulation(timesteps - done, checkpointer=checkpointer)
+    assert_same_rows(sim, expected)
+
+
+def test_records_hold_no_noise_block(tmp_path):
+    path = tmp_path / 'run.ckpt'
+    sim = build_simulation(scenario, seed=3)
+    sim.run_simulation(70, checkpointer=Checkpointer(path, every=20))
+    records, _ = _read_records(path)
+    saved = records[-1]['metric_generator']
+    assert set(saved) == {'params', 'streams', 'position'}
+    # 71 rows of noise drawn, counting the initial row
+    assert saved['position'] == 71 - sim.metric_generator.block_size
@@ -0,0 +1,6 @@
+from utils.benchmark import measure_node_footprint, node_byte_budget
+
+
+def test_bytes_per_node():
+    record = measure_node_footprint(100000)
+    assert record['bytes_per_node'] <= node_byte_budget, f"{record['bytes_per_node']:.0f} bytes per node"
@@ -0,0 +1,44 @@
+import numpy as np
+
+from sim.fuzzy_detector import get_fuzzy_detector
+from sim.fuzzy_memo import MemoizedFuzzyDetector
+from sim.metric_generator import MetricGenerator
+
+
+def draw(nodes, steps, seed=0):
+    metrics = MetricGenerator(nodes, seed).draw(steps, np.arange(nodes) % 2)
+    return [metrics[name] for name in ('packet_rate', 'bandwidth', 'response_time')]
+
+
+def test_values_are_the_engine_at_grid_points():
+    detector = get_fuzzy_detector()
+    memo = MemoizedFuzzyDetector(detector, resolution=2)
+    inputs = draw(500, 4)
+    for step in range(4):
+        values = memo.compute_batch(*[metric[step] for metric in inputs])
+        grid = [np.rint(metric[step] / quantum) * quantum for metric, quantum in zip(inputs, memo.quanta)]
+        np.testing.assert_allclose(values, detector.compute_batch(*grid))
+    stats = memo.get_statistics()
+    assert stats['hits'] + stats['misses'] == 2000
+    assert stats['size'] == stats['misses']
+
+
+def test_cache_stays_within_max_size():
+    detector = get_fuzzy_detector()
+    bounded = MemoizedFuzzyDetector(detector, resolution=2, max_size=300)
+    unbounded = MemoizedFuzzyDetector(detector, resolution=2)
+    inputs = draw(1000, 5, seed=1)
+    for step in range(5):
+        step_inputs = [metric[step] for metric in inputs]
+        np.testing.assert_array_equal(bounded.compute_batch(*step_inputs), unbounded.compute_batch(*step_inputs))
+        assert bounded.get_statistics()['size'] <= 300
+    assert bounded.evictions > 0
+
+
+def test_inputs_outside_the_key_range_are_not_cached():
+    detector = get_fuzzy_detector()
+    memo = MemoizedFuzzyDetector(detector)
+    values = memo.compute_batch(np.array([np.nan, 0.9, 0.9]), np.array([30., 30., 30.]),
+                                np.array([130., 130., 1e12]))
+    np.testing.assert_array_equal(values[[0, 2]], detector.compute_batch([np.nan, 0.9], [30., 30.], [130., 1e12]))
+    assert memo.get_statistics()['size'] == 1
@@ -0,0 +1,12 @@
+from utils.benchmark import check_surface_accuracy
+
+# A quarter of the default grid's points per step, which builds in about a
+# second and changes 0.3% of the categories of these draws, against 0.018%
+# for the default grid (see fuzzy_surface.default_surface_shape)
+reduced_shape = (61, 21, 31)
+
+
+def test_surface_keeps_categories():
+    record = check_surface_accuracy(reduced_shape, n=50000, budget=0.005, cache_dir=None)
+    assert record['category_changes'] <= record['budget'], f"{record['category_changes']:.4%} changed"
+    assert record['max_error'] < 0.5
@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from utils.benchmark import import_budgets, lazy_packages, measure_import_times
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('module', sorted(import_budgets))
+def test_import_budget(module):
+    # Best of a few cold imports, each in a fresh interpreter
+    record, = measure_import_times({module: import_budgets[module]}, repeats=3)
+    assert record['seconds'] <= record['budget'], f"{module} took {record['seconds']:.3f} s"
+    assert not record['loaded'], f"{module} loaded {record['loaded']}"
+
+
+def test_sim_loads_no_lazy_packages():
+    code = ('import sys\n'
+            'import sim\n'
+            f'print(*[m for m in {lazy_packages!r} if m in sys.modules])')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=root, check=True).stdout.split()
+    assert output == []
@@ -0,0 +1,31 @@
+import pytest
+
+from sim.monte_carlo import MonteCarlo
+
+scenario = {'num_nodes': 9, 'timesteps': 40}
+target = {'statistic': 'basic_false_positive_rate'}
+
+
+def test_stops_when_targets_are_met():
+    result = MonteCarlo(scenario, seed=0, max_workers=1).run_until([dict(target, width=0.5)],
+                                                                   max_runs=50, min_runs=4)
+    assert result.converged
+    assert result.n_runs < 50
+    interval, = [t['interval'] for t in result.targets]
+    assert interval['width'] <= 0.5
+    assert interval['runs'] == result.n_runs
+
+
+def test_stops_at_the_budget():
+    result = MonteCarlo(scenario, seed=0, max_workers=1).run_until([dict(target, width=1e-6)],
+                                                                   max_runs=12, min_runs=4)
+    assert not result.converged
+    assert result.n_runs == 12
+    assert not result.targets[0]['met']
+
+
+@pytest.mark.parametrize('min_runs, max_runs', [(0, 10), (10, 0), (-1, 10)])
+def test_rejects_empty_budget(min_runs, max_runs):
+    with pytest.raises(ValueError):
+        MonteCarlo(scenario, seed=0, max_workers=1).run_until([dict(target, width=0.5)],
+                                                              max_runs=max_runs, min_runs=min_runs)
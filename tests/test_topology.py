@@ -0,0 +1,34 @@
+import warnings
+
+import pytest
+
+from sim.topology import from_edge_list
+
+
+def load(tmp_path, text, num_nodes=None):
+    path = tmp_path / 'edges.txt'
+    path.write_text(text)
+    with warnings.catch_warnings():
+        # numpy warns when a file holds no data
+        warnings.simplefilter('ignore', UserWarning)
+        return from_edge_list(str(path), num_nodes)
+
+
+def test_edge_list(tmp_path):
+    topology = load(tmp_path, '# parent child\n0 1\n0 2\n2 3\n')
+    assert topology.num_nodes == 4
+    assert list(topology.get_children(0)) == [1, 2]
+    assert list(topology.get_roots()) == [0]
+
+
+@pytest.mark.parametrize('text', ['', '# no edges yet\n'])
+def test_edge_list_without_edges(tmp_path, text):
+    assert load(tmp_path, text).num_nodes == 0
+    topology = load(tmp_path, text, num_nodes=3)
+    assert topology.get_num_edges() == 0
+    assert list(topology.get_roots()) == [0, 1, 2]
+
+
+def test_edge_list_with_extra_columns(tmp_path):
+    with pytest.raises(ValueError):
+        load(tmp_path, '0 1 5\n1 2 5\n')
@@ -0,0 +1,469 @@
+from datetime import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from sim.metric_generator import MetricGenerator
+from sim.network_node import NetworkNode
+from sim.detectors import basic_compromise_flags, fuzzy_category
+from sim.fuzzy_detector import get_fuzzy_detector
+from sim.fuzzy_surface import default_cache_dir, default_surface_shape, get_fuzzy_surface
+from sim.rule_compiler import compile_rules
+from sim.fuzzy_memo import MemoizedFuzzyDetector
+from sim.propagation import PropagationEngine
+from sim.topology import kary_tree
+from sim.scenario import build_simulation
+from sim.sharded import ShardedSimulation
+from .generate_report import Report
+
+default_grid = {'nodes': [9, 100, 1000],
+                'timesteps': [100, 1000],
+                'attackers': [1, 10]}
+
+benchmark_stages = ('metrics', 'basic_check', 'fuzzy_batch', 'fuzzy_rules', 'fuzzy_memo', 'fuzzy_exact',
+                    'propagation', 'simulation', 'sharded', 'report')
+
+# Cold import time allowed for each module, in seconds, most of which is
+# numpy. None of them may load the heavy optional packages on import
+import_budgets = {'sim.network_sim': 0.4,
+                  'sim.scenario': 0.4,
+                  'sim.monte_carlo': 0.4,
+                  'utils.generate_report': 0.4}
+
+lazy_packages = ('skfuzzy', 'plotly', 'pandas')
+
+# Largest memory of one NetworkNode object, with its name and links
+node_byte_budget = 256
+
+# Largest fraction of metric draws whose fuzzy category the default
+# surface may change, see fuzzy_surface.default_surface_shape
+surface_category_budget = 0.0005
+
+
+class Benchmark:
+    '''
+    Times the stages of the simulation pipeline over a grid of node
+    counts, timesteps and attacker counts. Every stage is run on its own,
+    its best wall time over a number of repeats is kept and its peak
+    traced memory is recorded. Results are written to a JSON file together
+    with the code version, so runs can be compared with compare_benchmarks.
+
+    --------------
+    Attributes
+    --------------
+        grid: dict
+            Lists of 'nodes', 'timesteps' and 'attackers' to combine
+        stages: list, str
+            Stages to run, from benchmark_stages
+        repeats: int
+            Number of times each stage is timed
+        exact_limit: int
+            Largest number of scikit-fuzzy evaluations timed by the
+            fuzzy_exact stage; its time is scaled up to all evaluations
+        seed: int
+            Seed for generated metrics, topologies and simulations
+        shards: int
+            Number of worker processes of the sharded stage. Networks
+            smaller than a metric lane (4096 nodes) only get one
+        records: list, dict
+            One record per stage and grid point
+
+    --------------
+    Methods
+    --------------
+        run()
+            Runs every stage at every grid point
+        save(path)
+            Writes the records and environment to a JSON file
+    --------------
+
+    '''
+
+    def __init__(self, grid=None, stages=benchmark_stages, repeats=3, exact_limit=200, seed=0, shards=None):
+        self.grid = dict(default_grid)
+        if grid is not None:
+            self.grid.update(grid)
+        unknown = set(stages) - set(benchmark_stages)
+        if unknown:
+            raise ValueError(f'Unknown benchmark stages: {sorted(unknown)}')
+        self.stages = list(stages)
+        self.repeats = repeats
+        self.exact_limit = exact_limit
+        self.seed = seed
+        self.shards = shards or os.cpu_count()
+        self.records = []
+
+    def run(self):
+        ''' Runs the selected stages for every combination in the grid
+
+        --------------
+        Returns
+        --------------
+            records: list, dict
+                Grid point, stage, best time in seconds, time per node
+                per timestep, and peak traced memory in bytes. The
+                sharded stage also records its speedup over the
+                simulation stage when both are run
+
+        '''
+        for nodes, timesteps, attackers in itertools.product(self.grid['nodes'],
+                                                             self.grid['timesteps'],
+                                                             self.grid['attackers']):
+            seconds_by_stage = {}
+            for stage in self.stages:
+                stage_func = getattr(self, f'_stage_{stage}')
+                seconds, peak, extra = self._measure(stage_func, nodes, timesteps, attackers)
+                record = {'nodes': nodes,
+                          'timesteps': timesteps,
+                          'attackers': attackers,
+                          'stage': stage,
+                          'seconds': seconds,
+                          'seconds_per_node_step': seconds / (nodes * timesteps),
+                          'peak_bytes': peak}
+                record.update(extra)
+                if stage == 'sharded' and 'simulation' in seconds_by_stage:
+                    record['speedup'] = seconds_by_stage['simulation'] / seconds
+                seconds_by_stage[stage] = seconds
+                self.records.append(record)
+                print(f"{stage:>12} nodes={nodes:<8} timesteps={timesteps:<6} attackers={attackers:<4} "
+                      f"{seconds:9.4f} s  peak {peak / 2**20:8.1f} MiB")
+        return self.records
+
+    def _measure(self, stage_func, nodes, timesteps, attackers):
+        # Best wall time over the repeats. Tracing allocations slows Python
+        # code down a lot, so peak memory comes from one extra traced run
+        best = None
+        try:
+            for _ in range(self.repeats):
+                start = time.perf_counter()
+                extra = stage_func(nodes, timesteps, attackers) or {}
+                seconds = extra.pop('seconds', time.perf_counter() - start)
+                best = seconds if best is None else min(best, seconds)
+
+            tracemalloc.start()
+            try:
+                stage_func(nodes, timesteps, attackers)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        except Exception as error:
+            return float('nan'), 0, {'error': f'{type(error).__name__}: {error}'}
+        return best, peak, extra
+
+    def _metrics(self, nodes, timesteps):
+        # Metric traces with the first tenth of the nodes compromised
+        compromised = np.arange(nodes) < max(1, nodes // 10)
+        return MetricGenerator(nodes, self.seed).draw(timesteps, compromised)
+
+    def _stage_metrics(self, nodes, timesteps, attackers):
+        generator = MetricGenerator(nodes, self.seed)
+        compromised = np.zeros(nodes, dtype=np.int8)
+        for _ in range(timesteps):
+            generator.draw(1, compromised)
+
+    def _stage_basic_check(self, nodes, timesteps, attackers):
+        metrics = self._metrics(nodes, timesteps)
+        start = time.perf_counter()
+        basic_compromise_flags(metrics['packet_rate'], metrics['bandwidth'], metrics['response_time'])
+        return {'seconds': time.perf_counter() - start}
+
+    def _stage_fuzzy_batch(self, nodes, timesteps, attackers, detector=None):
+        metrics = self._metrics(nodes, timesteps)
+        detector = detector or get_fuzzy_detector()
+        start = time.perf_counter()
+        flags = np.zeros(nodes, dtype=np.int8)
+        for step in range(timesteps):
+            values = detector.compute_batch(metrics['packet_rate'][step],
+                                            metrics['bandwidth'][step],
+                                            metrics['response_time'][step])
+            flags = fuzzy_category(values, flags)
+        return {'seconds': time.perf_counter() - start}
+
+    def _stage_fuzzy_rules(self, nodes, timesteps, attackers):
+        # The default rule file compiles to the same inference as the
+        # batch engine, so the two stages should take the same time
+        return self._stage_fuzzy_batch(nodes, timesteps, attackers, compile_rules())
+
+    def _stage_fuzzy_memo(self, nodes, timesteps, attackers):
+        # Memoized batch engine at the default resolution, from a cold cache
+        detector = MemoizedFuzzyDetector(get_fuzzy_detector())
+        extra = self._stage_fuzzy_batch(nodes, timesteps, attackers, detector)
+        extra.update({name: detector.get_statistics()[name] for name in ('hit_rate', 'evictions')})
+        return extra
+
+    def _stage_fuzzy_exact(self, nodes, timesteps, attackers):
+        metrics = self._metrics(nodes, timesteps)
+        detector = get_fuzzy_detector()
+        detector.get_simulation()
+        count = min(nodes * timesteps, self.exact_limit)
+        inputs = zip(*(metrics[name].ravel()[:count] for name in ('packet_rate', 'bandwidth', 'response_time')))
+        start = time.perf_counter()
+        for p, b, r in inputs:
+            detector.compute(p, b, r)
+        per_call = (time.perf_counter() - start) / count
+        return {'seconds': per_call * nodes * timesteps, 'evaluations_timed': count}
+
+    def _stage_propagation(self, nodes, timesteps, attackers):
+        topology = kary_tree(nodes, 2)
+        rng = np.random.default_rng(self.seed)
+        is_compromised = np.zeros(nodes, dtype=np.int8)
+        engine = PropagationEngine(topology, np.full(nodes, 0.97), is_compromised, rng)
+        for target in rng.choice(nodes, size=min(attackers, nodes), replace=False):
+            engine.add_attack(target)
+        start = time.perf_counter()
+        for timestep in range(timesteps):
+            engine.step(timestep)
+        return {'seconds': time.perf_counter() - start,
+                'compromised': int(is_compromised.sum())}
+
+    def _scenario(self, nodes, attackers):
+        structure = 'v1' if nodes == 9 else 'kary_tree'
+        return {'num_nodes': nodes,
+                'structure': structure,
+                'structure_options': {} if structure == 'v1' else {'k': 2},
+                'attackers': list(range(min(attackers, nodes)))}
+
+    def _stage_simulation(self, nodes, timesteps, attackers):
+        sim = build_simulation(self._scenario(nodes, attackers), self.seed)
+        sim.run_simulation(timesteps)
+
+    def _stage_sharded(self, nodes, timesteps, attackers):
+        sim = build_simulation(self._scenario(nodes, attackers), self.seed)
+        sharded = ShardedSimulation(sim, self.shards)
+        sharded.run_simulation(timesteps)
+        return {'shards': len(sharded.shards)}
+
+    def _stage_report(self, nodes, timesteps, attackers):
+        sim = build_simulation(self._scenario(nodes, attackers), self.seed)
+        results = sim.run_simulation(timesteps)
+        with tempfile.TemporaryDirectory() as results_dir:
+            start = time.perf_counter()
+            Report('benchmark', results).generate_report(results_dir)
+            return {'seconds': time.perf_counter() - start}
+
+    def save(self, path):
+        ''' Writes the benchmark records to a JSON file
+
+        --------------
+        Parameters
+        --------------
+            path: str
+                Output file
+
+        '''
+        output = {'environment': get_environment(),
+                  'grid': self.grid,
+                  'repeats': self.repeats,
+                  'records': self.records}
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=1)
+
+
+def measure_import_times(budgets=None, repeats=5):
+    ''' Times a cold import of each module in a fresh interpreter and
+    checks it against its budget. A module fails if its best time is over
+    budget or if importing it loads one of lazy_packages.
+
+    --------------
+    Parameters
+    --------------
+        budgets: dict
+            (module name, seconds) pairs, by default import_budgets
+        repeats: int
+            Number of fresh interpreters each module is timed in
+    --------------
+    Returns
+    --------------
+        records: list, dict
+            Module, best import time, budget, lazy packages that were
+            loaded, and whether the module passed
+
+    '''
+    budgets = import_budgets if budgets is None else budgets
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    records = []
+    for module, budget in budgets.items():
+        code = ('import sys, time\n'
+                'start = time.perf_counter()\n'
+                f'import {module}\n'
+                'seconds = time.perf_counter() - start\n'
+                f'print(seconds, *[m for m in {lazy_packages!r} if m in sys.modules])')
+        best = None
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                    cwd=root, check=True).stdout.split()
+            seconds, loaded = float(output[0]), output[1:]
+            best = seconds if best is None else min(best, seconds)
+        records.append({'module': module,
+                        'seconds': best,
+                        'budget': budget,
+                        'loaded': loaded,
+                        'passed': best <= budget and not loaded})
+    return records
+
+
+def measure_node_footprint(num_nodes=100000, budget=None, seed=0):
+    ''' Traces the memory of the node objects of a simulation, created and
+    linked as Simulation.establish_nodes and set_topology do, and checks
+    the bytes per node against a budget. The state, metric and topology
+    arrays the nodes are views onto are not counted.
+
+    --------------
+    Parameters
+    --------------
+        num_nodes: int
+            Number of nodes in the network
+        budget: int
+            Largest bytes per node, by default node_byte_budget
+        seed: int
+    --------------
+    Returns
+    --------------
+        record: dict
+            Number of nodes, bytes per node, budget and whether the nodes
+            passed
+
+    '''
+    budget = node_byte_budget if budget is None else budget
+    sim = build_simulation({'num_nodes': num_nodes,
+                            'structure': 'kary_tree',
+                            'structure_options': {'k': 2},
+                            'attackers': [0]}, seed)
+    topology = sim.topology
+    sim.node_list = []
+    tracemalloc.start()
+    try:
+        for i in range(num_nodes):
+            sim.node_list.append(NetworkNode(f'node_{i}', sim.fuzzy_detector, sim.state, i, sim.metric_generator))
+        sim.set_topology(topology)
+        per_node = tracemalloc.get_traced_memory()[0] / num_nodes
+    finally:
+        tracemalloc.stop()
+    return {'nodes': num_nodes,
+            'bytes_per_node': per_node,
+            'budget': budget,
+            'passed': per_node <= budget}
+
+
+def check_surface_accuracy(shape=default_surface_shape, n=200000, budget=None, seed=0,
+                           cache_dir=default_cache_dir):
+    ''' Checks that interpolating the fuzzy surface agrees with exact
+    inference on the fuzzy category, not only on the value, for draws of
+    the default metrics with half of the nodes compromised
+
+    --------------
+    Parameters
+    --------------
+        shape: tuple, int
+            Grid shape of the surface
+        n: int
+            Number of metric draws
+        budget: float
+            Largest fraction of draws whose category may differ for
+            either previous category, by default surface_category_budget
+        seed: int
+        cache_dir: str
+            Directory the surface is stored in, None to only build it in
+            memory
+    --------------
+    Returns
+    --------------
+        record: dict
+            Shape, max error and category changes on the draws, the
+            surface's own max_error, the budget and whether it passed
+
+    '''
+    budget = surface_category_budget if budget is None else budget
+    surface = get_fuzzy_surface(shape=shape, cache_dir=cache_dir)
+    metrics = MetricGenerator(n, seed).draw(1, np.arange(n) % 2)
+    inputs = [metrics[name][0] for name in ('packet_rate', 'bandwidth', 'response_time')]
+    exact = surface.detector.compute_batch(*inputs)
+    approx = surface.compute_batch(*inputs)
+
+    changed = np.zeros(n, dtype=bool)
+    for previous in (0, 1):
+        changed |= fuzzy_category(exact, previous) != fuzzy_category(approx, previous)
+    return {'shape': list(surface.shape),
+            'max_error': float(np.nanmax(np.abs(approx - exact))),
+            'category_changes': float(changed.mean()),
+            'grid_max_error': surface.max_error,
+            'budget': budget,
+            'passed': changed.mean() <= budget}
+
+
+def get_environment():
+    ''' Code version and machine details stored with benchmark results '''
+    try:
+        version = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True,
+                                 text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        version = ''
+    return {'version': version or 'unknown',
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+def compare_benchmarks(baseline_path, current_path, tolerance=0.25):
+    ''' Compares two benchmark result files and finds the stages that got
+    slower or used more memory than the tolerance allows.
+
+    --------------
+    Parameters
+    --------------
+        baseline_path: str
+            Results of the reference version
+        current_path: str
+            Results of the version being checked
+        tolerance: float
+            Allowed relative increase, e.g. 0.25 for 25%
+    --------------
+    Returns
+    --------------
+        regressions: list, dict
+            Grid point, stage, metric and the baseline and current values
+            of every regression. A stage that fails now but did not in
+            the baseline is a regression of metric 'error', with the
+            error message
+
+    '''
+    with open(baseline_path) as f:
+        baseline = json.load(f)['records']
+    with open(current_path) as f:
+        current = json.load(f)['records']
+
+    def key(record):
+        return (record['stage'], record['nodes'], record['timesteps'], record['attackers'])
+
+    baseline = {key(r): r for r in baseline}
+    regressions = []
+    for record in current:
+        reference = baseline.get(key(record))
+        if reference is None:
+            continue
+        point = {'stage': record['stage'],
+                 'nodes': record['nodes'],
+                 'timesteps': record['timesteps'],
+                 'attackers': record['attackers']}
+        # A stage that started failing is a regression, whatever its
+        # (NaN) time compares as
+        if 'error' in record and 'error' not in reference:
+            regressions.append(dict(point, metric='error', baseline=reference['seconds'],
+                                    current=float('nan'), error=record['error']))
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            old, new = reference[metric], record[metric]
+            if old and old == old and (new != new or new > old * (1 + tolerance)):
+                regressions.append(dict(point, metric=metric, baseline=old, current=new))
+    return regressions
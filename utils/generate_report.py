@@ -1,74 +1,272 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import os
-import plotly.express as px
-import pandas as pd
+
+import numpy as np
+
+from sim.result_store import ResultReader
+from sim.sim_state import state_columns
+from sim.instrumentation import null_profiler
+
+# Plotted columns, with their titles and y axis ranges (None to autoscale)
+plot_columns = {'fuzzy_compromised_category': ('Fuzzy Compromised, Category', [-1.1, 1.1]),
+                'fuzzy_compromised_value': ('Fuzzy Compromised, Pure Value', None)}
+
 
 class Report:
     '''
     Class used to store the results of the simulation. Results
-    will be stored within ./results/[date_and_time]
-    
-    
+    will be stored within [results_dir]/[date_and_time]_[name]:
+
+        results.npz      every column of every node as (rows, nodes)
+                         arrays, written in one go
+        dashboard.html   interactive plot of all nodes, using WebGL
+                         scatter traces
+        [node]_*.png     optional per-node images, rendered in a
+                         process pool
+        [node].csv       optional per-node tables
+
+
     --------------
     Attributes
     --------------
-        name: str 
+        name: str
             Name of the simulation
-        results: dict
-            Results of the simulation
-            
+        results: dict or ResultReader
+            Results of the simulation. A path to a streamed result store
+            is opened as a ResultReader, which is read column by column
+            as the report is written
+        profiler: Profiler
+            Records the time spent on each part of the report.
+            Instrumentation is off when no profiler is given
+
     --------------
     Methods
     --------------
-        get_packet_rate(mu, stdev, min_munivorm, max_uniform)
-    
+        generate_report(results_dir, dashboard, images, node_csv, max_workers)
+            Writes the report
+        get_columns()
+            Times and (rows, nodes) arrays of every column
+        write_dashboard(path, time, columns)
+            Writes the multi-node HTML dashboard
+        write_images(rpath, time, columns, max_workers)
+            Writes per-node PNG plots in a worker pool
+
     '''
-    
-    def __init__(self, name, results):
-        
+
+    def __init__(self, name, results, profiler=None):
+
         self.name = name
+        self.profiler = profiler if profiler is not None else null_profiler
+        if isinstance(results, str):
+            results = ResultReader(results)
         self.results = results
-        
-    def generate_plots(self, df, nodename, rpath):
-        y_var_list = {'fuzzy_compromised_category': 'Fuzzy Compromised, Category', 
-                      'fuzzy_compromised_value': 'Fuzzy Compromised, Pure Value'}
-        
-        for y_var in y_var_list:
-            n = f'{y_var_list[y_var]}'
-            
-            fig1 = px.scatter(df, x='time', y=y_var, 
-                              width=600, height=400, 
-                              range_y=[-1.1, 1.1], 
-                              range_x=[-0.5,100.5],
-                      title=f'{n}',
-                     labels={'fuzzy_compromised':'Compromised Rating',
-                            'time': 'Simulation Time (s)'})
-            try:
-                fig1.to_image(os.path.join(rpath, f'{nodename}_{y_var}.png'))
-            except ValueError:
-                print('')
-        
-    
-    def generate_report(self, results_dir):
-        
+        self.node_names = list(results)
+
+    def get_columns(self):
+        ''' Gathers the results of all nodes into one array per column
+
+        --------------
+        Returns
+        --------------
+            time: array, int
+                Simulation time of each row
+            columns: dict
+                (column name, (rows, nodes) array) pairs
+
+        '''
         results = self.results
-        
+        if isinstance(results, ResultReader):
+            return results.get_times(), {name: results.get_column(name) for name in state_columns}
+
+        time = results[self.node_names[0]]['time'] if self.node_names else np.zeros(0, dtype=np.int64)
+        columns = {name: np.column_stack([results[n][name] for n in self.node_names])
+                   if self.node_names else np.zeros((len(time), 0), dtype=dtype)
+                   for name, dtype in state_columns.items()}
+        return time, columns
+
+    def write_dashboard(self, path, time, columns):
+        ''' Writes one HTML page plotting every node, with one row of
+        plots per plotted column. Each node's traces share a legend entry,
+        so clicking a node shows or hides it in all plots.
+
+        --------------
+        Parameters
+        --------------
+            path: str
+                Output HTML file
+            time: array, int
+                Simulation time of each row
+            columns: dict
+                (column name, (rows, nodes) array) pairs
+
+        '''
+        import plotly.graph_objects as go
+        from plotly.subplots import make_subplots
+
+        fig = make_subplots(rows=len(plot_columns), cols=1, shared_xaxes=True,
+                            subplot_titles=[title for title, _ in plot_columns.values()])
+        for row, (y_var, (title, range_y)) in enumerate(plot_columns.items(), start=1):
+            values = columns[y_var]
+            for index, node_name in enumerate(self.node_names):
+                fig.add_trace(go.Scattergl(x=time, y=values[:, index], mode='markers',
+                                           name=node_name, legendgroup=node_name,
+                                           showlegend=(row == 1)),
+                              row=row, col=1)
+            fig.update_yaxes(range=range_y, row=row, col=1)
+        fig.update_xaxes(range=get_range_x(time), title_text='Simulation Time (s)', row=len(plot_columns), col=1)
+        fig.update_layout(title=self.name, height=400 * len(plot_columns))
+        fig.write_html(path, include_plotlyjs=True)
+
+    def write_images(self, rpath, time, columns, max_workers=None):
+        ''' Writes PNG plots of every node in a pool of worker processes.
+        Image export needs the kaleido package.
+
+        --------------
+        Parameters
+        --------------
+            rpath: str
+                Report directory
+            time: array, int
+                Simulation time of each row
+            columns: dict
+                (column name, (rows, nodes) array) pairs
+            max_workers: int
+                Number of worker processes, by default one per CPU
+        --------------
+        Returns
+        --------------
+            errors: list, tuple
+                (file name, reason) of each image that could not be
+                written
+
+        '''
+        range_x = get_range_x(time)
+        jobs = [(node_name, rpath, time, {y_var: np.asarray(columns[y_var][:, index]) for y_var in plot_columns}, range_x)
+                for index, node_name in enumerate(self.node_names)]
+        errors = []
+        with ProcessPoolExecutor(max_workers) as executor:
+            for node_errors in executor.map(_write_node_images, jobs):
+                errors.extend(node_errors)
+        return errors
+
+    def generate_report(self, results_dir, dashboard=True, images=False, node_csv=False, max_workers=None):
+        ''' Writes the report into a new directory of results_dir
+
+        --------------
+        Parameters
+        --------------
+            results_dir: str
+                Directory the report directory is created in
+            dashboard: bool
+                Write the interactive HTML dashboard
+            images: bool
+                Write PNG plots of each node
+            node_csv: bool
+                Write a CSV table for each node as well as results.npz
+            max_workers: int
+                Number of processes rendering images
+        --------------
+        Returns
+        --------------
+            rpath: str
+                Report directory
+
+        '''
+        stage = self.profiler.stage
+
         # Get date and time
         dt_str = datetime.now().strftime("%Y-%m-%d_%H%M")
         dt_str = dt_str + f'_{self.name}'
-        
+
         # Make directory
-        os.mkdir(f'{results_dir}/{dt_str}')
         rpath = os.path.join(results_dir, dt_str)
-        
-        
-        # Write the csv results to output
-        for node_name in results:
-            node_results = results[node_name]
-            df = pd.DataFrame(node_results)
-            df.to_csv(f'{rpath}/{node_name}.csv')
-            
-            # Generate the plots
-            self.generate_plots(df, node_name, rpath)
-        
-        
+        os.makedirs(rpath)
+
+        # Write all columns of all nodes in one file
+        with stage('report_store'):
+            time, columns = self.get_columns()
+            np.savez(os.path.join(rpath, 'results.npz'), time=time,
+                     node_names=np.array(self.node_names), **columns)
+        self.profiler.end_step('report_store')
+
+        if node_csv:
+            import pandas as pd
+            with stage('report_csv'):
+                for index, node_name in enumerate(self.node_names):
+                    df = pd.DataFrame({'time': time, **{name: values[:, index] for name, values in columns.items()}})
+                    df.to_csv(os.path.join(rpath, f'{node_name}.csv'))
+            self.profiler.end_step('report_csv')
+
+        if dashboard:
+            with stage('report_dashboard'):
+                self.write_dashboard(os.path.join(rpath, 'dashboard.html'), time, columns)
+            self.profiler.end_step('report_dashboard')
+
+        if images:
+            with stage('report_images'):
+                errors = self.write_images(rpath, time, columns, max_workers)
+            self.profiler.end_step('report_images')
+            if errors:
+                print(f'{len(errors)} images could not be written:')
+                for reason in sorted({reason for _, reason in errors}):
+                    print(f'    {reason}')
+        return rpath
+
+
+def get_range_x(time):
+    ''' x axis range covering the simulation times, with half a step of margin '''
+    if len(time) == 0:
+        return [-0.5, 0.5]
+    return [float(time[0]) - 0.5, float(time[-1]) + 0.5]
+
+
+def load_results(rpath):
+    ''' Loads the results.npz of a report as a sim_results dictionary
+
+    --------------
+    Parameters
+    --------------
+        rpath: str
+            Report directory
+    --------------
+    Returns
+    --------------
+        sim_results: dict
+            (node name, {column name: values}) pairs
+
+    '''
+    with np.load(os.path.join(rpath, 'results.npz')) as data:
+        time = data['time']
+        columns = {name: data[name] for name in data.files if name not in ('time', 'node_names')}
+        node_names = [str(n) for n in data['node_names']]
+    return {node_name: {'time': time, **{name: values[:, index] for name, values in columns.items()}}
+            for index, node_name in enumerate(node_names)}
+
+
+def _write_node_images(job):
+    # Runs in a worker process; returns error messages instead of raising
+    # so one failed image doesn't stop the others
+    import plotly.express as px
+
+    node_name, rpath, time, values, range_x = job
+    errors = []
+    for y_var, (title, range_y) in plot_columns.items():
+        fig = px.scatter(x=time, y=values[y_var],
+                         width=600, height=400,
+                         range_y=range_y,
+                         range_x=range_x,
+                         title=title,
+                         labels={'x': 'Simulation Time (s)', 'y': title})
+        path = os.path.join(rpath, f'{node_name}_{y_var}.png')
+        try:
+            fig.write_image(path)
+        except Exception as error:
+            errors.append((os.path.basename(path), _describe_error(error)))
+    return errors
+
+
+def _describe_error(error):
+    # Error type and the first line of its message, if it has one
+    lines = str(error).strip().splitlines()
+    return f'{type(error).__name__}: {lines[0]}' if lines else type(error).__name__